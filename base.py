@@ -1,15 +1,97 @@
 #!/usr/bin/env python
 
-from troposphere import FindInMap, GetAZs, Ref, Select, Template, Parameter, Join, Equals, If
-from constants import *
-import troposphere.ec2 as ec2
-import troposphere.elasticloadbalancing as elb
-import troposphere.cloudwatch as cloudwatch
-import troposphere.iam as iam
+from troposphere import FindInMap, GetAZs, Ref, Select, Template, Parameter, Join, Equals, If, Not, ImportValue, Sub, Output, Export
 import abc
+import json
 from constants import *
+from lazy import LazyModule, lazy_attribute
+import ir
+from fragments import Fragment
+
+# Resource modules are only imported once a builder touches them
+ec2 = LazyModule("troposphere.ec2")
+elb = LazyModule("troposphere.elasticloadbalancing")
+cloudwatch = LazyModule("troposphere.cloudwatch")
+iam = LazyModule("troposphere.iam")
+autoscaling = LazyModule("troposphere.autoscaling")
+
+# Trust policy shared by every EC2 instance role, serialized once
+EC2_ASSUME_ROLE_POLICY = Fragment({
+    "Statement": [{
+        "Effect": "Allow",
+        "Principal": {
+            "Service": [ "ec2.amazonaws.com" ]
+        },
+        "Action": [ "sts:AssumeRole" ]
+    }]
+})
+
+# Patterns of the network inputs that have none of their own, by parameter
+# type, so they stay validated once add_network_stack_parameter relaxes them.
+# Any length of ID, the typed parameters accepted the 17 digit ones too
+NETWORK_INPUT_PATTERNS = {
+    "AWS::EC2::VPC::Id": ("vpc-[0-9a-f]+", INVALID_VPC_MSG),
+    "AWS::EC2::Subnet::Id": ("subnet-[0-9a-f]+", INVALID_SUBNET_MSG),
+}
+
+# Fragments built by shared_fragment(), keyed on (stack class, name)
+_shared_fragments = {}
+
+try:
+    basestring
+except NameError:
+    basestring = str
+
+def _intrinsic_data(obj):
+    # json default hook giving the raw data of troposphere intrinsics, which
+    # is enough to tell two of them apart when used as a cache key
+    return getattr(obj, "data", None) or obj.title
+
+def validate_volume(volume_type, size, iops=None, throughput=None, boot=False):
+    """ Raises ValueError unless the volume is within VOLUME_LIMITS """
+    if volume_type not in VOLUME_LIMITS:
+        raise ValueError(INVALID_VOLUME_TYPE_MSG)
+    limits = VOLUME_LIMITS[volume_type]
+    low, high = limits["size"]
+    if not low <= size <= high:
+        raise ValueError("%s volumes must be %i-%i GiB, not %i" % (volume_type, low, high, size))
+    if boot and not limits.get("bootable", True):
+        raise ValueError("%s volumes can not be boot volumes" % volume_type)
+    if iops is None:
+        if limits.get("iops_required"):
+            raise ValueError("%s volumes need provisioned IOPS" % volume_type)
+    else:
+        if "iops" not in limits:
+            raise ValueError("%s volumes do not take provisioned IOPS" % volume_type)
+        low, high = limits["iops"]
+        high = min(high, max(limits.get("iops_baseline", 0), size * limits["iops_per_gb"]))
+        if not low <= iops <= high:
+            raise ValueError("%s volumes of %i GiB take %i-%i IOPS, not %i" % (volume_type, size, low, high, iops))
+    if throughput is not None:
+        if "throughput" not in limits:
+            raise ValueError("%s volumes do not take provisioned throughput" % volume_type)
+        low, high = limits["throughput"]
+        high = min(high, max(low, int((iops or limits["iops_baseline"]) * limits["throughput_per_iops"])))
+        if not low <= throughput <= high:
+            raise ValueError("%s volumes with these IOPS take %i-%i MiB/s, not %i" % (volume_type, low, high, throughput))
+
+
+class BuildHook(object):
+
+    """ Observer for the stack build lifecycle. Subclass and override the
+        callbacks of interest, then pass instances to the stack constructor """
+
+    def start_build(self, stack):
+        return
+
+    def before_phase(self, stack, phase):
+        return
 
-USER_TAG_COUNT=0
+    def after_phase(self, stack, phase):
+        return
+
+    def finish_build(self, stack):
+        return
 
 class CloudformationAbstractBaseClass:
 
@@ -17,26 +99,99 @@ class CloudformationAbstractBaseClass:
 
     __metaclass__ = abc.ABCMeta
 
-    template = Template()
-
     DEFAULT_TAGS = []
 
-    SSH_FROM_ANYWHERE = ec2.SecurityGroupRule(
-        IpProtocol="tcp",
-        FromPort="22",
-        ToPort="22",
-        CidrIp=QUAD_ZERO_CIDR
-    )
+    # Property overrides for the parameters a stack defines, keyed on
+    # parameter name, e.g. {"NatSize": {"Default": "m3.medium"}}
+    PARAMETER_OVERRIDES = {}
 
-    ELB_HTTP_LISTENER = elb.Listener(
-        LoadBalancerPort="80",
-        Protocol="HTTP",
-        InstancePort="80",
-        InstanceProtocol="HTTP"  
-    )
+    # Optional UserTagKeyN/UserTagValueN parameter pairs, see
+    # add_user_tag_parameters. Stacks opt in, e.g. USER_TAG_COUNT = 7, as
+    # every pair adds two parameters, a condition and a tag to every tag list
+    USER_TAG_COUNT = 0
 
-    def __init__(self):
-        self.add_mappings()
+    # Shared rule and listener, wrapped as fragments so they are serialized once
+
+    @lazy_attribute
+    def SSH_FROM_ANYWHERE():
+        return Fragment(ec2.SecurityGroupRule(
+            IpProtocol="tcp",
+            FromPort="22",
+            ToPort="22",
+            CidrIp=QUAD_ZERO_CIDR
+        ))
+
+    @lazy_attribute
+    def ELB_HTTP_LISTENER():
+        return Fragment(elb.Listener(
+            LoadBalancerPort="80",
+            Protocol="HTTP",
+            InstancePort="80",
+            InstanceProtocol="HTTP"
+        ))
+
+    def __init__(self, hooks=()):
+        # Each stack renders into its own template so several stacks can be
+        # built (and profiled) within the same process
+        self.template = Template()
+        self.hooks = list(hooks)
+        self.user_tags = []
+        self._tag_cache = {}
+        self._info_tags = None
+        self._az_names = {}
+
+    def build(self, *phases):
+        """ Runs each builder method in order, notifying the registered hooks
+            before and after every phase so the build can be observed. Every
+            started hook gets finish_build, even when a phase or another hook
+            fails, so hooks can always undo what start_build set up """
+        started = []
+        try:
+            for hook in self.hooks:
+                hook.start_build(self)
+                started.append(hook)
+            for phase in phases:
+                for hook in self.hooks:
+                    hook.before_phase(self, phase.__name__)
+                phase()
+                for hook in reversed(self.hooks):
+                    hook.after_phase(self, phase.__name__)
+            self.apply_parameter_overrides()
+        except Exception:
+            # The build error is the one worth reporting
+            self._finish_hooks(started)
+            raise
+        error = self._finish_hooks(started)
+        if error is not None:
+            raise error
+
+    def _finish_hooks(self, hooks):
+        # Calls finish_build on every hook, returns the first error raised
+        error = None
+        for hook in reversed(hooks):
+            try:
+                hook.finish_build(self)
+            except Exception as e:
+                error = error or e
+        return error
+
+    def shared_fragment(self, name, factory):
+        """ Returns the Fragment called name for this stack class, calling
+            factory to build it the first time. Every stack of the same class
+            reuses the fragment and its serialized JSON, so factory must only
+            depend on the class (logical names, class attributes), not on
+            per-instance state """
+        key = (type(self), name)
+        if key not in _shared_fragments:
+            _shared_fragments[key] = Fragment(factory())
+        return _shared_fragments[key]
+
+    def apply_parameter_overrides(self):
+        for name, properties in self.PARAMETER_OVERRIDES.items():
+            if name not in self.template.parameters:
+                raise ValueError("%s has no parameter %s to override" % (type(self).__name__, name))
+            for key, value in properties.items():
+                setattr(self.template.parameters[name], key, value)
 
     def add_default_parameters(self):
         self.environment_type = self.template.add_parameter(Parameter(
@@ -88,6 +243,8 @@ class CloudformationAbstractBaseClass:
                     Type="String",
                     MinLength="1"
         ))
+        self.add_user_tag_parameters()
+
     def add_default_windows_parameters(self):
         self.S3BinariesBucket = self.template.add_parameter(Parameter(
                     "S3BinariesBucket",
@@ -121,34 +278,90 @@ class CloudformationAbstractBaseClass:
             NoEcho= True
         ))
 
-    def get_tags_as_list(self, az_index, *name_joins):
-
-        # Added a switch to allow us to create names that do not have the az_index specified. Could be cleaned up
-        # 'None' sohuld be 
-        if az_index is None:
-            return [
-            ec2.Tag("Name", Join("",["ti-", FindInMap("REGIONNAMEMAPPINGS", Ref("AWS::Region"), "Name"), 
-                    ] + [e for e in name_joins] )),
-            ec2.Tag("gl_dept", Ref(self.department_information)),
-            ec2.Tag("gl_bu", Ref(self.business_unit_information)),
-            ec2.Tag("app_info", Ref(self.application_information)),
-            ec2.Tag("infra_info", Ref(self.infrastructure_information)),
-            ec2.Tag("sec_info", Ref(self.security_information))
-            ]
-        else:
-            return [
-            ec2.Tag("Name", Join("",["ti-", FindInMap("REGIONNAMEMAPPINGS", Ref("AWS::Region"), "Name"), 
-                Select(az_index, FindInMap("AZNAMEMAPPINGS", 
-                            Ref(self.account_name),
-                            FindInMap("REGIONNAMEMAPPINGS", Ref("AWS::Region"), "Name"))
-                            ), 
-                    ] + [e for e in name_joins] )),
-            ec2.Tag("gl_dept", Ref(self.department_information)),
-            ec2.Tag("gl_bu", Ref(self.business_unit_information)),
-            ec2.Tag("app_info", Ref(self.application_information)),
-            ec2.Tag("infra_info", Ref(self.infrastructure_information)),
-            ec2.Tag("sec_info", Ref(self.security_information))
+    def add_user_tag_parameters(self, count=None):
+        """ Adds count optional UserTagKeyN/UserTagValueN parameter pairs and
+            appends them to every tag list built by get_tags_as_list. A pair
+            left with an empty key adds no tag. count defaults to the class'
+            USER_TAG_COUNT """
+        if count is None:
+            count = self.USER_TAG_COUNT
+        for i in range(1, count + 1):
+            key = self.template.add_parameter(Parameter(
+                "UserTagKey%i" % i,
+                Description="Key of user defined tag %i, leave empty for none" % i,
+                Type="String",
+                Default="",
+            ))
+            value = self.template.add_parameter(Parameter(
+                "UserTagValue%i" % i,
+                Description="Value of user defined tag %i" % i,
+                Type="String",
+                Default="",
+            ))
+            condition = "HasUserTag%i" % i
+            self.template.add_condition(condition, Not(Equals(Ref(key), "")))
+            self.add_user_tags([If(condition, ec2.Tag(Ref(key), Ref(value)), Ref("AWS::NoValue"))])
+
+    def add_user_tags(self, tags):
+        """ Appends extra ec2.Tag objects to every tag list from get_tags_as_list """
+        self.user_tags = self.user_tags + list(tags)
+        self._tag_cache = {}
+
+    def _tag_key(self, part):
+        # Name parts are usually strings, but Refs and other intrinsics are
+        # created fresh by each caller so they are keyed on their JSON form
+        if isinstance(part, basestring):
+            return part
+        return json.dumps(part, default=_intrinsic_data, sort_keys=True)
+
+    def _shared_tags(self):
+        # The tags that are identical on every resource, built once per stack
+        if self._info_tags is None:
+            self._info_tags = [
+                ec2.Tag("gl_dept", Ref(self.department_information)),
+                ec2.Tag("gl_bu", Ref(self.business_unit_information)),
+                ec2.Tag("app_info", Ref(self.application_information)),
+                ec2.Tag("infra_info", Ref(self.infrastructure_information)),
+                ec2.Tag("sec_info", Ref(self.security_information))
             ]
+            self._region_name = FindInMap("REGIONNAMEMAPPINGS", Ref("AWS::Region"), "Name")
+        return self._info_tags
+
+    def get_tags_as_list(self, az_index, *name_joins):
+        """ Returns the standard tag set for a resource. Tag lists are memoized
+            on (az_index, name_joins) and share their tag and intrinsic objects,
+            so only the list itself is new on each call """
+
+        key = (az_index,) + tuple(self._tag_key(e) for e in name_joins)
+        tags = self._tag_cache.get(key)
+        if tags is None:
+            shared = self._shared_tags()
+            # Added a switch to allow us to create names that do not have the az_index specified. Could be cleaned up
+            # 'None' sohuld be
+            if az_index is None:
+                prefix = ["ti-", self._region_name]
+            else:
+                if az_index not in self._az_names:
+                    self._az_names[az_index] = Select(az_index, FindInMap("AZNAMEMAPPINGS",
+                                Ref(self.account_name),
+                                self._region_name)
+                                )
+                prefix = ["ti-", self._region_name, self._az_names[az_index]]
+            tags = [ec2.Tag("Name", Join("", prefix + list(name_joins)))] + shared + self.user_tags
+            self._tag_cache[key] = tags
+        return list(tags)
+
+    def get_asg_tags(self, tags):
+        """ The tags from get_tags_as_list as Auto Scaling group tags, which
+            also propagate to the instances """
+        asg_tags = []
+        for tag in map(ir.lower, tags):
+            if "Fn::If" in tag:
+                condition, tag, _ = tag["Fn::If"]
+                asg_tags.append(If(condition, autoscaling.Tag(tag["Key"], tag["Value"], True), Ref("AWS::NoValue")))
+            else:
+                asg_tags.append(autoscaling.Tag(tag["Key"], tag["Value"], True))
+        return asg_tags
 
     """def add_default_cloudwatch_alarms(self, hostname, instance, postfix = ''):
 
@@ -197,15 +410,7 @@ class CloudformationAbstractBaseClass:
         # Creatng default role and default policy for templates
         self.instance_role = self.template.add_resource(iam.Role(
             "%sInstanceRole" % prefix,
-            AssumeRolePolicyDocument={
-              "Statement": [{
-                "Effect": "Allow",
-                "Principal": {
-                  "Service": [ "ec2.amazonaws.com" ]
-                },
-                "Action": [ "sts:AssumeRole" ]
-              }]
-            },
+            AssumeRolePolicyDocument=EC2_ASSUME_ROLE_POLICY,
             Path="/"
         ))
 
@@ -239,6 +444,163 @@ class CloudformationAbstractBaseClass:
           Roles=[ Ref(self.instance_role) ]
         ))
 
+    def make_nat_instance_role(self, bucketref, condition=None):
+        """ Returns the NAT role, its EC2 takeover and S3 policies and the
+            NatInstanceProfile, used by NATStack or once per account by
+            identity.IdentityStack. A role created under condition belongs to
+            one stack and may only describe that stack """
+        kwargs = {"Condition": condition} if condition else {}
+        if condition:
+            stacks = Ref("AWS::StackId")
+        else:
+            stacks = Join("", [ "arn:aws:cloudformation:", Ref("AWS::Region"), ":",
+                                Ref("AWS::AccountId"), ":stack/*" ])
+        # FIXME: Going to need to be able to grab and set own EIP
+        role = iam.Role(
+            "NatInstanceRole",
+            AssumeRolePolicyDocument=EC2_ASSUME_ROLE_POLICY,
+            Path="/",
+            **kwargs
+        )
+
+        ec2_policy = iam.PolicyType(
+          "NatInstanceEC2Policy",
+          PolicyName="NAT_Takeover",
+          PolicyDocument={
+            # to allow us to update things
+            "Statement": [{
+              "Effect": "Allow",
+              "Action": [
+                "ec2:AssociateAddress",
+                "ec2:DescribeInstances",
+                "ec2:DescribeRouteTables",
+                "ec2:CreateRoute",
+                "ec2:ReplaceRoute",
+                "ec2:StartInstances",
+                "ec2:StopInstances",
+                "ec2:AttachNetworkInterface",
+                "ec2:DescribeNetworkInterfaces"
+              ], 
+              "Resource": "*", # Perhaps come and change this, and use waitcondition handles to prevent other stuff happening
+            },{
+              # Boot timeline metrics
+              "Effect": "Allow",
+              "Action": [ "cloudwatch:PutMetricData" ],
+              "Resource": "*",
+            },{
+              # cfn-init/cfn-hup read the NAT metadata, of any stack when shared
+              "Effect": "Allow",
+              "Action": [ "cloudformation:DescribeStackResource" ],
+              "Resource": stacks,
+            }]
+          },
+          Roles=[ Ref(role) ],
+          **kwargs
+        )
+
+        s3_policy = iam.PolicyType(
+          "NatInstanceS3Policy",
+          PolicyName="NAT_S3_Pull",
+          PolicyDocument={
+            # to allow us to update things
+            "Statement": [{
+                "Effect": "Allow",
+                "Action": [ "s3:GetObject" ],
+                "Resource": [
+                    Join("", [ "arn:aws:s3:::", bucketref, "" ]),
+                    Join("", [ "arn:aws:s3:::", bucketref, "/*" ]),
+                ]
+                },{
+                "Effect": "Allow",
+                "Action": [ "s3:PutObject" ],
+                "Resource": [
+                    Join("", [ "arn:aws:s3:::", bucketref, "" ]),
+                    Join("", [ "arn:aws:s3:::", bucketref, "/*" ]),
+                ]},
+            ]
+          },
+          Roles=[ Ref(role) ],
+          **kwargs
+        )
+
+        profile = iam.InstanceProfile(
+          "NatInstanceProfile",
+          Path="/",
+          Roles=[ Ref(role) ],
+          **kwargs
+        )
+        return (role, ec2_policy, s3_policy, profile)
+
+    def add_network_stack_parameter(self, *inputs):
+        """ NetworkStackName: the inputs (parameters) can then be left empty
+            and are imported from that stack's exports instead, named
+            <NetworkStackName>-<parameter name>. Their type is relaxed to
+            String so that an empty value validates, their pattern still
+            applies to a non-empty value and a rule requires them all when
+            NetworkStackName is empty """
+        self.network_stack_name = self.template.add_parameter(Parameter(
+            "NetworkStackName",
+            Description="Name of the stack exporting the network inputs, "
+                        "leave empty to pass them as parameters",
+            Type="String",
+            Default="",
+        ))
+        self.template.add_condition("UseNetworkStack", Not(Equals(Ref(self.network_stack_name), "")))
+        for param in inputs:
+            if "AllowedPattern" not in param.properties and param.Type in NETWORK_INPUT_PATTERNS:
+                param.AllowedPattern, param.ConstraintDescription = NETWORK_INPUT_PATTERNS[param.Type]
+            param.Type = "String"
+            param.properties.pop("MinLength", None)
+            if "AllowedPattern" in param.properties:
+                param.AllowedPattern = "(%s)?" % param.AllowedPattern
+            param.Default = ""
+        self.template.add_rule("NetworkInputsRequired", {
+            "RuleCondition": Equals(Ref(self.network_stack_name), ""),
+            "Assertions": [{
+                "Assert": Not(Equals(Ref(param), "")),
+                "AssertDescription": "%s is required when NetworkStackName is empty" % param.title,
+            } for param in inputs],
+        })
+
+    def get_network_input(self, param):
+        """ The network stack's export for param if NetworkStackName is set,
+            else a Ref to the parameter """
+        name = param if isinstance(param, basestring) else param.title
+        return If("UseNetworkStack", ImportValue(Sub("${NetworkStackName}-%s" % name)), Ref(name))
+
+    def make_output(self, name, description, value, **kwargs):
+        """ An output exported as <stack name>-<output name>, so other stacks
+            can ImportValue it instead of looking it up with describe-stacks """
+        return Output(
+            name,
+            Description=description,
+            Value=value,
+            Export=Export(Sub("${AWS::StackName}-%s" % name)),
+            **kwargs
+        )
+
+    def add_identity_parameters(self):
+        """ IdentityStackName: instance profiles are imported from that
+            identity.IdentityStack instead of being created by this stack,
+            which keeps IAM propagation off the stack's critical path. The
+            shared NAT role only reads and writes the identity stack's
+            UploadBucketName, so every stack importing it has to use that
+            bucket as its own UploadBucketName """
+        self.identity_stack_name = self.template.add_parameter(Parameter(
+            "IdentityStackName",
+            Description="Name of the identity stack exporting the instance profiles, "
+                        "leave empty to create them in this stack. Its NAT role only has "
+                        "access to the identity stack's UploadBucketName, use the same bucket here",
+            Type="String",
+            Default="",
+        ))
+        self.template.add_condition("UseSharedIdentity", Not(Equals(Ref(self.identity_stack_name), "")))
+
+    def get_identity_ref(self, export, local):
+        """ The identity stack's export (<IdentityStackName>-<export>) if one
+            is used, else a Ref to the local resource """
+        return If("UseSharedIdentity", ImportValue(Sub("${IdentityStackName}-%s" % export)), Ref(local))
+
     def add_mappings(self):
         self.region_to_az = self.template.add_mapping('RegionToAz', REGION_TO_AZ)
         self.base_sgs = self.template.add_mapping('BASESGS', BASE_SGS)
@@ -273,6 +635,69 @@ class CloudformationAbstractBaseClass:
 
 
 
+    def get_cfn_init_command(self, resource_name):
+        """ Join parts of the cfn-init call that applies resource_name's metadata """
+        return [
+            "/opt/aws/bin/cfn-init -v --stack ", Ref("AWS::StackName"),
+            " --resource ", resource_name,
+            " --region ", Ref("AWS::Region"),
+        ]
+
+    def get_cfn_signal_command(self, resource_name, exit_code="0"):
+        """ Join parts of the cfn-signal call answering resource_name's CreationPolicy """
+        return [
+            "/opt/aws/bin/cfn-signal -e ", exit_code, " --stack ", Ref("AWS::StackName"),
+            " --resource ", resource_name,
+            " --region ", Ref("AWS::Region"),
+        ]
+
+    def make_cfn_hup_metadata(self, resource_name, config, hook_action=None, interval="1"):
+        """ Returns AWS::CloudFormation::Init metadata applying the cfn-init
+            config dict (files, commands, services...) and running cfn-hup, so
+            a stack update that only changes the metadata is applied in place:
+            cfn-hup re-runs cfn-init and then hook_action (shell command) """
+        action = self.get_cfn_init_command(resource_name)
+        if hook_action:
+            action = action + [" && ", hook_action]
+        config = dict(config)
+        files = dict(config.get("files", {}))
+        files["/etc/cfn/cfn-hup.conf"] = {
+            "content": Join("", [
+                "[main]\n",
+                "stack=", Ref("AWS::StackId"), "\n",
+                "region=", Ref("AWS::Region"), "\n",
+                "interval=", interval, "\n",
+            ]),
+            "mode": "000400",
+            "owner": "root",
+            "group": "root",
+        }
+        files["/etc/cfn/hooks.d/cfn-auto-reloader.conf"] = {
+            "content": Join("", [
+                "[cfn-auto-reloader-hook]\n",
+                "triggers=post.update\n",
+                "path=Resources.%s.Metadata.AWS::CloudFormation::Init\n" % resource_name,
+                "action=",
+            ] + action + [
+                "\n",
+                "runas=root\n",
+            ]),
+            "mode": "000400",
+            "owner": "root",
+            "group": "root",
+        }
+        config["files"] = files
+        services = dict(config.get("services", {}))
+        sysvinit = dict(services.get("sysvinit", {}))
+        sysvinit["cfn-hup"] = {
+            "enabled": "true",
+            "ensureRunning": "true",
+            "files": [ "/etc/cfn/cfn-hup.conf", "/etc/cfn/hooks.d/cfn-auto-reloader.conf" ],
+        }
+        services["sysvinit"] = sysvinit
+        config["services"] = services
+        return { "AWS::CloudFormation::Init": { "config": config } }
+
     def make_subnet_with_tags(self, name, description, azindex, cidrblockref, vpcref, taglist=[]):
         return ec2.Subnet(
             name, 
@@ -284,8 +709,10 @@ class CloudformationAbstractBaseClass:
 
 
     def make_subnet_association(self, name, subnetref, routetableref):
-        return ec2.SubnetRouteTableAssociation(
+        # Associations are created per subnet, so they are compact ir records
+        return ir.Resource(
             name,
+            "AWS::EC2::SubnetRouteTableAssociation",
             SubnetId=subnetref,
             RouteTableId=routetableref
         )
@@ -300,8 +727,9 @@ class CloudformationAbstractBaseClass:
 
 
     def make_acl_subnet_association(self, name, subnetref, ntwaclref ):
-        return ec2.SubnetNetworkAclAssociation(
+        return ir.Resource(
             name,
+            "AWS::EC2::SubnetNetworkAclAssociation",
             SubnetId=subnetref,
             NetworkAclId=ntwaclref
             )
@@ -389,6 +817,175 @@ class CloudformationAbstractBaseClass:
         private = self.add_route_table(vpcref, "PrivateRouteTable", self.DEFAULT_TAGS)
         return (public, private)
 
+    def add_gateway_endpoints(self, vpcref, route_table_refs, buckets, condition=None):
+        """ Creates S3 and DynamoDB gateway endpoints on the given route tables
+            so that traffic to them bypasses any NAT. The S3 endpoint policy
+            only allows the given buckets (names or Refs), anything else in
+            S3 is denied from these route tables """
+        bucket_arns = []
+        for bucket in buckets:
+            bucket_arns.append(Join("", [ "arn:aws:s3:::", bucket, "" ]))
+            bucket_arns.append(Join("", [ "arn:aws:s3:::", bucket, "/*" ]))
+
+        attributes = {"Condition": condition} if condition else {}
+        s3_endpoint = ec2.VPCEndpoint(
+            "S3Endpoint",
+            VpcId=vpcref,
+            ServiceName=Join("", [ "com.amazonaws.", Ref("AWS::Region"), ".s3" ]),
+            RouteTableIds=route_table_refs,
+            PolicyDocument={
+                "Statement": [{
+                    "Effect": "Allow",
+                    "Principal": "*",
+                    "Action": [ "s3:GetObject", "s3:PutObject", "s3:ListBucket" ],
+                    "Resource": bucket_arns
+                }]
+            },
+            **attributes
+        )
+        dynamodb_endpoint = ec2.VPCEndpoint(
+            "DynamoDBEndpoint",
+            VpcId=vpcref,
+            ServiceName=Join("", [ "com.amazonaws.", Ref("AWS::Region"), ".dynamodb" ]),
+            RouteTableIds=route_table_refs,
+            **attributes
+        )
+        return (s3_endpoint, dynamodb_endpoint)
+
+    def make_block_device(self, device_name, size, volume_type="gp3", iops=None, throughput=None,
+                          encrypted=None, delete_on_termination=True, boot=False, mapping=None):
+        """ Returns an EBS block device mapping checked by validate_volume.
+            mapping is the class to build, ec2.BlockDeviceMapping (instances,
+            the default) or ec2.LaunchTemplateBlockDeviceMapping """
+        validate_volume(volume_type, size, iops, throughput, boot)
+        mapping = mapping or ec2.BlockDeviceMapping
+        ebs = {"VolumeSize": size, "VolumeType": volume_type, "DeleteOnTermination": delete_on_termination}
+        if iops is not None:
+            ebs["Iops"] = iops
+        if throughput is not None:
+            ebs["Throughput"] = throughput
+        if encrypted is not None:
+            ebs["Encrypted"] = encrypted
+        return mapping(DeviceName=device_name, Ebs=ec2.EBSBlockDevice(**ebs))
+
+    def add_elb_parameters(self):
+        """ Tuning parameters for make_load_balancer. IdleTimeout has to stay
+            above the backends' keepalive timeout, otherwise the ELB reuses
+            connections the backend is closing and clients see 504s """
+        self.elb_idle_timeout = self.template.add_parameter(Parameter(
+            "ElbIdleTimeout",
+            Description="Seconds an idle front/back end connection is kept open (1-4000)",
+            Type="Number",
+            Default="60",
+            MinValue="1",
+            MaxValue="4000",
+        ))
+        self.elb_draining_timeout = self.template.add_parameter(Parameter(
+            "ElbConnectionDrainingTimeout",
+            Description="Seconds in-flight requests get to finish on a deregistering instance",
+            Type="Number",
+            Default="300",
+            MinValue="1",
+            MaxValue="3600",
+        ))
+        self.elb_cross_zone = self.template.add_parameter(Parameter(
+            "ElbCrossZone",
+            Description="Balance evenly across all instances rather than across AZs",
+            Type="String",
+            Default="true",
+            AllowedValues=VALID_TRUE_FALSE_VALUES,
+        ))
+        self.elb_health_check_target = self.template.add_parameter(Parameter(
+            "ElbHealthCheckTarget",
+            Description="Health check target, e.g. HTTP:80/health",
+            Type="String",
+            Default="HTTP:80/",
+        ))
+        self.elb_health_check_interval = self.template.add_parameter(Parameter(
+            "ElbHealthCheckInterval",
+            Description="Seconds between health checks of each instance (10-300)",
+            Type="Number",
+            Default="10",
+            MinValue="10",
+            MaxValue="300",
+        ))
+        # The ELB rejects a timeout that is not less than the interval, the
+        # ranges do not overlap so every accepted pair is valid
+        self.elb_health_check_timeout = self.template.add_parameter(Parameter(
+            "ElbHealthCheckTimeout",
+            Description="Seconds before a health check counts as failed (2-9)",
+            Type="Number",
+            Default="5",
+            MinValue="2",
+            MaxValue="9",
+        ))
+        self.elb_healthy_threshold = self.template.add_parameter(Parameter(
+            "ElbHealthyThreshold",
+            Description="Consecutive passing checks before an instance receives traffic",
+            Type="Number",
+            Default="2",
+            MinValue="2",
+            MaxValue="10",
+        ))
+        self.elb_unhealthy_threshold = self.template.add_parameter(Parameter(
+            "ElbUnhealthyThreshold",
+            Description="Consecutive failing checks before an instance is taken out",
+            Type="Number",
+            Default="3",
+            MinValue="2",
+            MaxValue="10",
+        ))
+        self.elb_access_log_bucket = self.template.add_parameter(Parameter(
+            "ElbAccessLogBucket",
+            Description="Bucket for access logs (needs a policy allowing ELB log delivery), "
+                        "leave empty to disable access logging",
+            Type="String",
+            Default="",
+        ))
+        self.elb_access_log_interval = self.template.add_parameter(Parameter(
+            "ElbAccessLogInterval",
+            Description="Minutes between access log deliveries",
+            Type="Number",
+            Default="60",
+            AllowedValues=[ "5", "60" ],
+        ))
+        self.template.add_condition("EnableElbAccessLogs", Not(Equals(Ref(self.elb_access_log_bucket), "")))
+
+    def make_load_balancer(self, name, subnetrefs, sgrefs, listeners=None, scheme="internet-facing", taglist=[]):
+        """ Returns a classic ELB tuned by the add_elb_parameters parameters:
+            connection draining, cross-zone balancing, idle timeout, access
+            logs and health checks. Listens with ELB_HTTP_LISTENER unless
+            listeners are given """
+        return elb.LoadBalancer(
+            name,
+            Scheme=scheme,
+            Subnets=subnetrefs,
+            SecurityGroups=sgrefs,
+            Listeners=listeners or [self.ELB_HTTP_LISTENER],
+            CrossZone=Ref(self.elb_cross_zone),
+            ConnectionDrainingPolicy=elb.ConnectionDrainingPolicy(
+                Enabled=True,
+                Timeout=Ref(self.elb_draining_timeout),
+            ),
+            ConnectionSettings=elb.ConnectionSettings(
+                IdleTimeout=Ref(self.elb_idle_timeout),
+            ),
+            HealthCheck=elb.HealthCheck(
+                Target=Ref(self.elb_health_check_target),
+                Interval=Ref(self.elb_health_check_interval),
+                Timeout=Ref(self.elb_health_check_timeout),
+                HealthyThreshold=Ref(self.elb_healthy_threshold),
+                UnhealthyThreshold=Ref(self.elb_unhealthy_threshold),
+            ),
+            AccessLoggingPolicy=If("EnableElbAccessLogs", elb.AccessLoggingPolicy(
+                Enabled=True,
+                S3BucketName=Ref(self.elb_access_log_bucket),
+                S3BucketPrefix=Join("", [ Ref("AWS::StackName"), "/", name ]),
+                EmitInterval=Ref(self.elb_access_log_interval),
+            ), Ref("AWS::NoValue")),
+            Tags=taglist,
+        )
+
     def get_name_tag(self, name):
         return ec2.Tag("Name", name)
 
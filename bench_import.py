@@ -0,0 +1,65 @@
+#!/usr/bin/env python
+
+# Import/startup benchmark. Every run starts a fresh interpreter so the
+# numbers include module imports exactly as a script invocation pays them.
+#
+#   python bench_import.py                       # import base, render BaseSGs
+#   python bench_import.py --budget-ms 50        # non-zero exit when over budget
+#   python bench_import.py --importtime          # slowest imports (python -X importtime)
+
+import argparse
+import os
+import subprocess
+import sys
+import time
+
+SCENARIOS = [
+    ("interpreter", "pass"),
+    ("import base", "import base"),
+    ("render BaseSGs", "import securitygroups; securitygroups.BaseSGs().template.to_json()"),
+]
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+
+def time_snippet(snippet, runs):
+    """ Returns the wall time in ms of each fresh-interpreter run of snippet """
+    timings = []
+    for _ in range(runs):
+        started = time.time()
+        subprocess.check_call([sys.executable, "-c", snippet], cwd=HERE)
+        timings.append((time.time() - started) * 1000)
+    return sorted(timings)
+
+
+def slowest_imports(snippet, count):
+    """ Returns the count slowest modules (cumulative us, name) reported by -X importtime """
+    output = subprocess.run([sys.executable, "-X", "importtime", "-c", snippet],
+                            cwd=HERE, stderr=subprocess.PIPE, universal_newlines=True).stderr
+    rows = []
+    for line in output.splitlines()[1:]:
+        _, cumulative, name = line.split("|")
+        rows.append((int(cumulative), name.strip()))
+    return sorted(rows, reverse=True)[:count]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Measure interpreter startup plus import/render cost")
+    parser.add_argument("--runs", type=int, default=10)
+    parser.add_argument("--budget-ms", type=float, help="fail if the median of the last scenario exceeds this")
+    parser.add_argument("--importtime", action="store_true", help="list the slowest imports of the last scenario")
+    args = parser.parse_args()
+
+    median = 0
+    for label, snippet in SCENARIOS:
+        timings = time_snippet(snippet, args.runs)
+        median = timings[len(timings) // 2]
+        print("%-16s min %7.1f ms  median %7.1f ms" % (label, timings[0], median))
+
+    if args.importtime:
+        for cumulative, name in slowest_imports(SCENARIOS[-1][1], 15):
+            print("%10.1f ms  %s" % (cumulative / 1000.0, name))
+
+    if args.budget_ms is not None and median > args.budget_ms:
+        print("median %.1f ms exceeds budget of %.1f ms" % (median, args.budget_ms))
+        sys.exit(1)
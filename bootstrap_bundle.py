@@ -0,0 +1,92 @@
+#!/usr/bin/env python
+
+# Builds the versioned bootstrap bundle used by NATStack's BootstrapMode=bundle:
+#
+#   python bootstrap_bundle.py --version 3 --monitor nat_monitor.sh \
+#       --exporter nat_stats_exporter.sh --cfn-bootstrap aws-cfn-bootstrap-latest.tar.gz --wheels wheels/
+#   aws s3 cp nat-bootstrap-3.tar.gz s3://<UploadBucketName>/
+#
+# then update the stack with BootstrapBundleVersion=3. The NATs extract the
+# bundle to /opt/nat-bootstrap and run install.sh, which installs everything
+# from the bundle without touching yum or the internet. A NAT that already
+# has the same VERSION (e.g. a prebaked AMI or a reboot) skips the download.
+#
+# The bundle is reproducible: timestamps (tar members and the gzip header)
+# are SOURCE_DATE_EPOCH, or 0 when it is not set, and owners are root, so
+# building the same version from the same files gives the same bytes.
+
+import argparse
+import gzip
+import io
+import os
+import tarfile
+
+BUNDLE_NAME = "nat-bootstrap-%s.tar.gz"
+
+INSTALL_SCRIPT = """#!/bin/bash -e
+# Generated by bootstrap_bundle.py
+cd "$(dirname "$0")"
+for CFN in cfn-bootstrap/*.tar.gz; do
+  [ -f "$CFN" ] || continue
+  easy_install "$CFN"
+done
+if [ -d wheels ]; then
+  pip install --no-index --find-links wheels awscli
+fi
+[ -f nat_monitor.sh ] && chmod a+x nat_monitor.sh
+[ -f nat_stats_exporter.sh ] && chmod a+x nat_stats_exporter.sh
+echo "%(version)s" > VERSION
+"""
+
+
+def _mtime():
+    return int(os.environ.get("SOURCE_DATE_EPOCH", 0))
+
+
+def _normalize(info):
+    # tar.add filter dropping what differs between build hosts and checkouts
+    info.mtime = _mtime()
+    info.uid = info.gid = 0
+    info.uname = info.gname = "root"
+    return info
+
+
+def _add_bytes(tar, name, data, mode=0o644):
+    info = tarfile.TarInfo(name)
+    info.size = len(data)
+    info.mode = mode
+    tar.addfile(_normalize(info), io.BytesIO(data))
+
+
+def build_bundle(version, output_dir=".", monitor=None, cfn_bootstrap=(), wheels=None, include=(), exporter=None):
+    """ Writes nat-bootstrap-<version>.tar.gz to output_dir and returns its path.
+        VERSION is written by install.sh once everything is installed, so an
+        interrupted install is retried on the next boot """
+    path = os.path.join(output_dir, BUNDLE_NAME % version)
+    with gzip.GzipFile(path, "wb", mtime=_mtime()) as gz, tarfile.open(fileobj=gz, mode="w") as tar:
+        _add_bytes(tar, "install.sh", (INSTALL_SCRIPT % {"version": version}).encode("utf-8"), 0o755)
+        if monitor:
+            tar.add(monitor, "nat_monitor.sh", filter=_normalize)
+        if exporter:
+            tar.add(exporter, "nat_stats_exporter.sh", filter=_normalize)
+        for archive in cfn_bootstrap:
+            tar.add(archive, "cfn-bootstrap/" + os.path.basename(archive), filter=_normalize)
+        if wheels:
+            tar.add(wheels, "wheels", filter=_normalize)
+        for extra in include:
+            tar.add(extra, os.path.basename(extra), filter=_normalize)
+    return path
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Build the NAT bootstrap bundle for BootstrapMode=bundle")
+    parser.add_argument("--version", required=True, help="value to pass as BootstrapBundleVersion")
+    parser.add_argument("--output-dir", default=".")
+    parser.add_argument("--monitor", help="nat_monitor.sh to ship in the bundle")
+    parser.add_argument("--exporter", help="nat_stats_exporter.sh to ship in the bundle")
+    parser.add_argument("--cfn-bootstrap", action="append", default=[], help="aws-cfn-bootstrap tarball")
+    parser.add_argument("--wheels", help="directory of awscli wheels for an offline pip install")
+    parser.add_argument("--include", action="append", default=[], help="extra file to ship in the bundle")
+    args = parser.parse_args()
+
+    print(build_bundle(args.version, args.output_dir, args.monitor, args.cfn_bootstrap, args.wheels, args.include, args.exporter))
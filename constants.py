@@ -11,7 +11,7 @@
 
 
 # Migration specific constants
-USER_TAG_COUNT            = 7           # The number of user generated tags for each instance
+USER_TAG_COUNT            = 7           # The number of user generated tags for stacks that opt in
 INTERNAL_IP_RANGE         = "10.0.0.0/8"
 VPCID                     = "" # prod VCP
 DEFAULT_VPC_CIDR          = "10.0.0.0/18"
@@ -97,8 +97,48 @@ QUAD_ZERO_CIDR            = "0.0.0.0/0"
 
 VALID_TRUE_FALSE_VALUES   = [ "true", "false" ]
 
+# S3 buckets behind the Amazon Linux yum repos, <prefix>.<region>.amazonaws.com.
+# Must be allowed by any S3 endpoint policy on routes used by instances
+
+AMAZON_LINUX_REPO_BUCKET_PREFIXES = [ "packages", "repo" ]
+
 # Unable to make this AZ dynamic at the moment without big complication
 
+# NatEngine values: HA pair of NAT instances, managed NAT Gateways, or a
+# self-healing NAT per AZ (Auto Scaling group of 1 with a floating ENI)
+
+NAT_ENGINES               = [ "instance", "gateway", "asg" ]
+
+# CloudWatch namespace of the NAT boot timeline metrics
+
+NAT_BOOT_METRICS_NAMESPACE = "NAT/Boot"
+
+# CloudWatch namespace of the nat_stats_exporter.sh flow metrics
+
+NAT_FLOW_METRICS_NAMESPACE = "NAT/Flows"
+
+# BootstrapMode values, see the bootstrap section in NATStack.get_nat_script_sections
+
+BOOTSTRAP_MODES           = [ "install", "bundle", "prebaked" ]
+
+# Largest template that can be passed inline as TemplateBody
+
+CFN_TEMPLATE_BODY_BYTES   = 51200
+
+# CloudFormation quotas per template, checked at build time by limits.py.
+# template_bytes is the limit for templates uploaded to S3 (TemplateURL),
+# template_body_bytes only applies to templates passed inline
+
+CFN_LIMITS = {
+    "resources": 500,
+    "parameters": 200,
+    "outputs": 200,
+    "mappings": 200,
+    "mapping_attributes": 200,
+    "template_bytes": 1048576,
+    "template_body_bytes": CFN_TEMPLATE_BODY_BYTES,
+}
+
 NAT_AZ                    = "AZa"
 NAT_CREATE_TIMEOUT        = "500"
 NAT_AZ2                    = "AZb"
@@ -228,8 +268,22 @@ INVALID_ENI_MSG           = "Must be valid network intf = eni-xxxxxxxx"
 # eg ebs vol types
 
 VOLUME_MSG                = "Enter volume type"
-VOLUME_TYPES              = [ "standard", "io1" ]
-INVALID_VOLUME_TYPE_MSG   = "Must be valid EBS vol type - standard or io1"
+VOLUME_TYPES              = [ "standard", "gp2", "gp3", "io1", "io2", "st1" ]
+INVALID_VOLUME_TYPE_MSG   = "Must be valid EBS vol type - " + ", ".join(VOLUME_TYPES)
+
+# Per type limits checked by base.validate_volume: size in GiB, provisioned
+# IOPS (with the IOPS per GiB ratio, gp3 gets its baseline at any size) and
+# gp3 throughput in MiB/s (at most 0.25 MiB/s per provisioned IOPS)
+
+VOLUME_LIMITS = {
+    "standard" : { "size": (1, 1024) },
+    "gp2"      : { "size": (1, 16384) },
+    "gp3"      : { "size": (1, 16384), "iops": (3000, 16000), "iops_per_gb": 500, "iops_baseline": 3000,
+                   "throughput": (125, 1000), "throughput_per_iops": 0.25 },
+    "io1"      : { "size": (4, 16384), "iops": (100, 64000), "iops_per_gb": 50, "iops_required": True },
+    "io2"      : { "size": (4, 16384), "iops": (100, 64000), "iops_per_gb": 500, "iops_required": True },
+    "st1"      : { "size": (125, 16384), "bootable": False },
+}
 
 # db snapshots can pretty much be any string
 
@@ -264,6 +318,13 @@ DB_IOPS_DEFAULT           = ""
 VALID_DB_IOPS_REGEX       = OPTIONAL_NUMBER_STRING
 INVALID_DB_IOPS_MSG       = "Must be number in multiple of 1000 or blank for no IOPS"
 
+# Provisioned IOPS limits, checked against the storage size by database.py
+
+DB_IOPS_MIN               = 1000
+DB_IOPS_STEP              = 1000
+DB_IOPS_MIN_STORAGE       = 100
+DB_IOPS_MAX_RATIO         = 50   # IOPS per GB of storage
+
 # How long to retain automated backups
 
 DB_BACKUP_RETENTION_PERIOD_MSG         = "Number of dats which automatic backups are retained"
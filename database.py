@@ -0,0 +1,319 @@
+#!/usr/bin/env python
+
+from troposphere import GetAtt, Parameter, Ref, FindInMap, If, Not, Equals
+import troposphere.ec2 as ec2
+import troposphere.rds as rds
+
+from base import CloudformationAbstractBaseClass
+import fragments
+from constants import *
+
+
+def validate_storage(storage, iops):
+    """ Raises ValueError unless iops (None for gp2) can be provisioned on
+        storage GB """
+    if not int(MIN_DB_STORAGE) <= int(storage) <= int(MAX_DB_STORAGE):
+        raise ValueError("DB storage of %s GB is outside %s-%s GB" % (storage, MIN_DB_STORAGE, MAX_DB_STORAGE))
+    if iops is None:
+        return
+    if int(iops) < DB_IOPS_MIN or int(iops) % DB_IOPS_STEP:
+        raise ValueError("DB IOPS must be a multiple of %i, at least %i, not %s" % (DB_IOPS_STEP, DB_IOPS_MIN, iops))
+    if int(storage) < DB_IOPS_MIN_STORAGE:
+        raise ValueError("Provisioned IOPS need at least %i GB of storage, not %s" % (DB_IOPS_MIN_STORAGE, storage))
+    if int(iops) > int(storage) * DB_IOPS_MAX_RATIO:
+        raise ValueError("%s IOPS on %s GB exceeds %i IOPS per GB, raise the storage to %i GB" % (
+            iops, storage, DB_IOPS_MAX_RATIO, -(-int(iops) // DB_IOPS_MAX_RATIO)))
+
+
+class DatabaseStack(CloudformationAbstractBaseClass):
+
+    DESCRIPTION = "Template which creates the data tier RDS instance, its read replicas and parameter group"
+
+    # Storage is sized in code so IOPS can be checked against it before the
+    # template is rendered. DB_IOPS None means gp2, otherwise io1
+    DB_STORAGE = DEFAULT_DB_STORAGE
+    DB_IOPS = None
+
+    DB_READ_REPLICAS = 1
+
+    # Engines DB_PARAMETERS applies to, the settings are MySQL (InnoDB) ones
+    DB_ENGINES = ["MySQL"]
+
+    # Parameter group families DB_PARAMETERS is valid in, mysql8.0 has no
+    # query cache settings
+    DB_PARAMETER_GROUP_FAMILIES = ["mysql5.6", "mysql5.7"]
+
+    # Parameter group settings (MySQL), see get_db_parameters for the ones
+    # derived from the storage
+    DB_PARAMETERS = {
+        "innodb_buffer_pool_size": "{DBInstanceClassMemory*3/4}",
+        # SSD backed storage, neighbouring pages gain nothing
+        "innodb_flush_neighbors": "0",
+        # The query cache serializes writes
+        "query_cache_type": "0",
+        "query_cache_size": "0",
+        "performance_schema": "1",
+    }
+
+    def __init__(self, hooks=()):
+        super(DatabaseStack, self).__init__(hooks)
+        validate_storage(self.DB_STORAGE, self.DB_IOPS)
+        self.template.add_description(self.DESCRIPTION)
+
+        self.build(
+            self.add_parameters,
+            self.add_mappings,
+            self.add_db_sg,
+            self.add_db_subnet_group,
+            self.add_parameter_group,
+            self.add_db_instance,
+            self.add_read_replicas,
+            self.add_outputs,
+        )
+
+    def add_parameters(self):
+
+        """ Implements the abstract method and defines a number of parameters the
+            calling process or GUI must supply """
+        super(DatabaseStack, self).add_default_parameters()
+
+        self.vpc_id = self.template.add_parameter(Parameter(
+            "VpcId",
+            Description="The ID of the existing Virtual Private Cloud (VPC)",
+            Type="AWS::EC2::VPC::Id",
+            MinLength="1",
+            AllowedPattern=VALID_VPC_REGEX,
+            ConstraintDescription=INVALID_VPC_MSG,
+            Default=""
+        ))
+        self.data_subnet_1 = self.template.add_parameter(Parameter(
+            "DataSubnet1",
+            Description="The ID of the Data Tier Subnet in AZ 1",
+            Type="AWS::EC2::Subnet::Id",
+            MinLength="1",
+            ConstraintDescription=INVALID_SUBNET_MSG,
+            Default=""
+        ))
+        self.data_subnet_2 = self.template.add_parameter(Parameter(
+            "DataSubnet2",
+            Description="The ID of the Data Tier Subnet in AZ 2",
+            Type="AWS::EC2::Subnet::Id",
+            MinLength="1",
+            ConstraintDescription=INVALID_SUBNET_MSG,
+            Default=""
+        ))
+        self.add_network_stack_parameter(self.vpc_id, self.data_subnet_1, self.data_subnet_2)
+
+        self.db_engine = self.template.add_parameter(Parameter(
+            "DBEngine",
+            Description=DB_ENGINE_MSG,
+            Type="String",
+            Default=DB_ENGINE_DEFAULT,
+            AllowedValues=self.DB_ENGINES,
+            ConstraintDescription="Must be one of %s, the parameter group holds MySQL settings" % ", ".join(self.DB_ENGINES),
+        ))
+        self.db_engine_version = self.template.add_parameter(Parameter(
+            "DBEngineVersion",
+            Description=DB_ENGINE_VERSION_MSG,
+            Type="String",
+            Default=DB_ENGINE_VERSION_DEFAULT,
+            ConstraintDescription=INVALID_DB_ENGINE_VERSION,
+        ))
+        self.db_parameter_group_family = self.template.add_parameter(Parameter(
+            "DBParameterGroupFamily",
+            Description="Parameter group family matching DBEngine/DBEngineVersion, e.g. mysql5.6",
+            Type="String",
+            Default="mysql5.6",
+            AllowedValues=self.DB_PARAMETER_GROUP_FAMILIES,
+        ))
+        self.db_instance_class = self.template.add_parameter(Parameter(
+            "DBInstanceClass",
+            Description="RDS instance type for the master and the read replicas",
+            Type="String",
+            Default=DEFAULT_DB_INSTANCE_TYPE,
+            AllowedValues=DB_INSTANCE_TYPES,
+            ConstraintDescription=INVALID_DB_INSTANCE_TYPE_MSG,
+        ))
+        self.db_port = self.template.add_parameter(Parameter(
+            "DBPort",
+            Description=DB_PORT_MSG,
+            Type="String",
+            Default=DB_PORT_DEFAULT,
+            AllowedPattern=VALID_DB_PORT_REGEX,
+            ConstraintDescription=INVALID_DB_PORT_MSG,
+        ))
+        self.db_multi_az = self.template.add_parameter(Parameter(
+            "DBMultiAZ",
+            Description="Keep a synchronous standby in a second AZ",
+            Type="String",
+            Default="true",
+            AllowedValues=VALID_TRUE_FALSE_VALUES,
+        ))
+        self.db_snapshot = self.template.add_parameter(Parameter(
+            "DBSnapshotIdentifier",
+            Description=DB_SNAPSHOT_MSG,
+            Type="String",
+            Default="",
+            AllowedPattern=VALID_DB_SNAPSHOT_REGEX,
+            ConstraintDescription=INVALID_DB_SNAPSHOT_MSG,
+        ))
+        self.db_master_username = self.template.add_parameter(Parameter(
+            "DBMasterUsername",
+            Description="Master user name, ignored when restoring a snapshot",
+            Type="String",
+            Default="dbadmin",
+        ))
+        self.db_master_password = self.template.add_parameter(Parameter(
+            "DBMasterPassword",
+            Description="Master password (8-41 characters, no / \" @ or spaces), ignored when restoring a snapshot",
+            Type="String",
+            NoEcho=True,
+            Default="",
+            # Empty is only accepted when restoring, see DBMasterPasswordRequired
+            AllowedPattern="([^/\"@ ]{8,41})?",
+            ConstraintDescription="Must be 8-41 characters without / \" @ or spaces",
+        ))
+        # Read replicas need automated backups on the master
+        self.db_backup_retention = self.template.add_parameter(Parameter(
+            "DBBackupRetentionPeriod",
+            Description=DB_BACKUP_RETENTION_PERIOD_MSG,
+            Type="Number",
+            Default=DEFAULT_DB_BACKUP_RETENTION_PERIOD,
+            MinValue="1" if self.DB_READ_REPLICAS else "0",
+            MaxValue="35",
+            ConstraintDescription=INVALID_DB_BACKUP_RETENTION_PERIOD_MSG,
+        ))
+        self.db_backup_window = self.template.add_parameter(Parameter(
+            "DBBackupWindow",
+            Description=DB_BACKUP_WINDOW_MSG,
+            Type="String",
+            Default=DB_BACKUP_WINDOW_DEFAULT,
+            AllowedPattern=VALID_DB_BACKUP_WINDOW_REGEX,
+            ConstraintDescription=INVALID_DB_BACKUP_WINDOW_MSG,
+        ))
+        self.db_maint_window = self.template.add_parameter(Parameter(
+            "DBMaintenanceWindow",
+            Description=DB_MAINT_WINDOW_MSG,
+            Type="String",
+            Default=DB_MAINT_WINDOW_DEFAULT,
+            AllowedPattern=VALID_DB_MAINT_WINDOW_REGEX,
+            ConstraintDescription=INVALID_DB_MAINT_WINDOW_MSG,
+        ))
+        self.template.add_condition("HasDBSnapshot", Not(Equals(Ref(self.db_snapshot), "")))
+        self.template.add_rule("DBMasterPasswordRequired", {
+            "RuleCondition": Equals(Ref(self.db_snapshot), ""),
+            "Assertions": [{
+                "Assert": Not(Equals(Ref(self.db_master_password), "")),
+                "AssertDescription": "DBMasterPassword is required unless restoring DBSnapshotIdentifier",
+            }],
+        })
+        self.template.add_condition("HasDBBackupWindow", Not(Equals(Ref(self.db_backup_window), "")))
+        self.template.add_condition("HasDBMaintenanceWindow", Not(Equals(Ref(self.db_maint_window), "")))
+
+    def add_mappings(self):
+        self.vpc_mapping = self.template.add_mapping('VPCMAPPING', VPC_MAPPING)
+        self.region_convention_mapping = self.template.add_mapping('REGIONNAMEMAPPINGS', REGION_TO_CONVENTION_MAPPING)
+
+    def add_db_sg(self):
+        vpc_cidr = FindInMap("VPCMAPPING", FindInMap("REGIONNAMEMAPPINGS", Ref("AWS::Region"), "Name"),
+                             Ref(self.environment_type))
+        self.db_sg = self.template.add_resource(ec2.SecurityGroup(
+            "DBSG",
+            GroupDescription="Access to the data tier databases from the VPC",
+            VpcId=self.get_network_input(self.vpc_id),
+            SecurityGroupIngress=[
+              ec2.SecurityGroupRule(IpProtocol="tcp", FromPort=Ref(self.db_port), ToPort=Ref(self.db_port),
+                                    CidrIp=vpc_cidr)
+            ],
+            Tags=self.get_tags_as_list(None, '-data-sg-db')
+        ))
+
+    def add_db_subnet_group(self):
+        self.db_subnet_group = self.template.add_resource(rds.DBSubnetGroup(
+            "DBSubnetGroup",
+            DBSubnetGroupDescription="Data tier subnets",
+            SubnetIds=[self.get_network_input(self.data_subnet_1), self.get_network_input(self.data_subnet_2)],
+            Tags=self.get_tags_as_list(None, '-data-dbsubnets')
+        ))
+
+    def get_db_parameters(self):
+        """ DB_PARAMETERS plus the InnoDB IO capacity matching the provisioned IOPS """
+        parameters = dict(self.DB_PARAMETERS)
+        if self.DB_IOPS:
+            parameters.setdefault("innodb_io_capacity", str(int(self.DB_IOPS) // 2))
+            parameters.setdefault("innodb_io_capacity_max", str(self.DB_IOPS))
+        return parameters
+
+    def add_parameter_group(self):
+        self.db_parameter_group = self.template.add_resource(rds.DBParameterGroup(
+            "DBParameterGroup",
+            Description="Data tier performance settings",
+            Family=Ref(self.db_parameter_group_family),
+            Parameters=self.get_db_parameters(),
+            Tags=self.get_tags_as_list(None, '-data-dbparams')
+        ))
+
+    def get_storage_properties(self):
+        if self.DB_IOPS:
+            return {"AllocatedStorage": str(self.DB_STORAGE), "StorageType": "io1", "Iops": int(self.DB_IOPS)}
+        return {"AllocatedStorage": str(self.DB_STORAGE), "StorageType": "gp2"}
+
+    def add_db_instance(self):
+        no_value = Ref("AWS::NoValue")
+        self.db_instance = self.template.add_resource(rds.DBInstance(
+            "DBInstance",
+            Engine=Ref(self.db_engine),
+            EngineVersion=Ref(self.db_engine_version),
+            DBInstanceClass=Ref(self.db_instance_class),
+            Port=Ref(self.db_port),
+            MultiAZ=Ref(self.db_multi_az),
+            DBSnapshotIdentifier=If("HasDBSnapshot", Ref(self.db_snapshot), no_value),
+            MasterUsername=If("HasDBSnapshot", no_value, Ref(self.db_master_username)),
+            MasterUserPassword=If("HasDBSnapshot", no_value, Ref(self.db_master_password)),
+            BackupRetentionPeriod=Ref(self.db_backup_retention),
+            PreferredBackupWindow=If("HasDBBackupWindow", Ref(self.db_backup_window), no_value),
+            PreferredMaintenanceWindow=If("HasDBMaintenanceWindow", Ref(self.db_maint_window), no_value),
+            DBParameterGroupName=Ref(self.db_parameter_group),
+            DBSubnetGroupName=Ref(self.db_subnet_group),
+            VPCSecurityGroups=[Ref(self.db_sg)],
+            Tags=self.get_tags_as_list(None, '-data-db'),
+            DeletionPolicy="Snapshot",
+            UpdateReplacePolicy="Snapshot",
+            **self.get_storage_properties()
+        ))
+
+    def add_read_replicas(self):
+        self.db_read_replicas = []
+        for i in range(1, self.DB_READ_REPLICAS + 1):
+            self.db_read_replicas.append(self.template.add_resource(rds.DBInstance(
+                "DBReadReplica%i" % i,
+                SourceDBInstanceIdentifier=Ref(self.db_instance),
+                Engine=Ref(self.db_engine),
+                DBInstanceClass=Ref(self.db_instance_class),
+                DBParameterGroupName=Ref(self.db_parameter_group),
+                VPCSecurityGroups=[Ref(self.db_sg)],
+                Tags=self.get_tags_as_list(None, '-data-db-replica%i' % i),
+                **self.get_storage_properties()
+            )))
+
+    def add_outputs(self):
+        self.template.add_output(self.make_output(
+            "DBEndpoint",
+            "Address of the master database",
+            GetAtt(self.db_instance, "Endpoint.Address")
+        ))
+        self.template.add_output(self.make_output(
+            "DBPort",
+            "Port of the databases",
+            GetAtt(self.db_instance, "Endpoint.Port")
+        ))
+        for i, replica in enumerate(self.db_read_replicas, 1):
+            self.template.add_output(self.make_output(
+                "DBReadReplica%iEndpoint" % i,
+                "Address of read replica %i" % i,
+                GetAtt(replica, "Endpoint.Address")
+            ))
+
+if __name__ == "__main__":
+    dbstack = DatabaseStack()
+    print(fragments.render(dbstack.template))
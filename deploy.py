@@ -0,0 +1,327 @@
+#!/usr/bin/env python
+
+# Concurrent create/update of many stacks, in dependency order:
+#
+#   python deploy.py base-sgs=securitygroups.BaseSGs nat-1=specs/nat-m3.yaml \
+#       --after nat-1:base-sgs --parameter nat-1:NatKeyPair=ops --concurrency 8
+#
+# Each target is <stack name>=<module.Class or spec file>, rendered the same
+# way as watch.py. A stack starts once everything it comes --after has been
+# deployed, so the NATs of a VPC wait for its base SGs while unrelated stacks
+# go ahead in parallel. The sha256 of the template and parameters is stored in
+# the TemplateHash stack tag, and stacks whose hash is unchanged are skipped
+# without calling Create/UpdateStack.
+#
+# Templates over the inline TemplateBody limit (NATStack is) are uploaded to
+# --template-bucket as <stack name>/<hash>.json and passed as TemplateURL.
+# Every stack is rendered with limits.py's LimitGuard at --threshold, which
+# checks the TemplateBody limit too when there is no --template-bucket.
+#
+# Throttled calls back off through one limiter shared by every stack, so a
+# burst of Throttling errors slows the whole deploy down rather than each
+# stack retrying on its own. To tune --concurrency offline, point it at a
+# local stand-in such as moto's server mode:
+#
+#   moto_server -p 5000 &
+#   python deploy.py ... --endpoint-url http://localhost:5000 --region us-east-1
+
+import argparse
+import asyncio
+import hashlib
+import json
+import random
+import time
+from collections import namedtuple
+
+import boto3
+from botocore.exceptions import ClientError
+
+from constants import CFN_TEMPLATE_BODY_BYTES
+from watch import Variant
+
+HASH_TAG = "TemplateHash"
+
+THROTTLING_CODES = frozenset([
+    "Throttling", "ThrottlingException", "RequestLimitExceeded", "TooManyRequestsException",
+])
+
+# Stack states that end a create or update
+SUCCEEDED = frozenset(["CREATE_COMPLETE", "UPDATE_COMPLETE", "IMPORT_COMPLETE"])
+FAILED = frozenset([
+    "CREATE_FAILED", "ROLLBACK_COMPLETE", "ROLLBACK_FAILED", "DELETE_COMPLETE", "DELETE_FAILED",
+    "UPDATE_ROLLBACK_COMPLETE", "UPDATE_ROLLBACK_FAILED", "UPDATE_FAILED",
+])
+
+DeployEvent = namedtuple("DeployEvent", ["time", "stack", "status", "detail"])
+
+
+class Throttle(object):
+
+    """ Shared adaptive backoff: every throttled call doubles the delay
+        before the next API call (up to max_delay) and every successful call
+        shrinks it again, so the deploy settles near the account's rate limit """
+
+    def __init__(self, initial_delay=0.0, max_delay=30.0, floor=0.05):
+        self.delay = initial_delay
+        self.max_delay = max_delay
+        self.floor = floor
+        self.throttled = 0
+
+    def success(self):
+        self.delay = self.delay * 0.8 if self.delay > self.floor else 0.0
+
+    def failure(self):
+        self.throttled += 1
+        self.delay = min(self.max_delay, max(self.floor * 4, self.delay * 2))
+
+    async def wait(self):
+        if self.delay:
+            # Jitter spreads out the stacks that were throttled together
+            await asyncio.sleep(self.delay * random.uniform(0.5, 1.5))
+
+
+class Target(object):
+
+    """ A stack to deploy: its name, what it renders from and the stacks it
+        has to wait for. threshold and inline set up the Variant's LimitGuard """
+
+    def __init__(self, name, source, parameters=None, after=(), threshold=None, inline=True):
+        self.name = name
+        self.variant = Variant(source, threshold=threshold, inline=inline)
+        self.parameters = dict(parameters or {})
+        self.after = set(after)
+        self._body = None
+
+    @property
+    def body(self):
+        if self._body is None:
+            # Compact, as nothing reads the deployed copy
+            self._body = self.variant.render(indent=None)
+        return self._body
+
+    @property
+    def digest(self):
+        data = json.dumps([self.body, sorted(self.parameters.items())])
+        return hashlib.sha256(data.encode("utf-8")).hexdigest()
+
+
+def order(targets):
+    """ Checks the dependencies and returns the targets in a valid deploy
+        order, raises ValueError on unknown names or cycles """
+    by_name = dict((t.name, t) for t in targets)
+    for target in targets:
+        missing = target.after - set(by_name)
+        if missing:
+            raise ValueError("%s comes after unknown stacks %s" % (target.name, ", ".join(sorted(missing))))
+    ordered, done, visiting = [], set(), []
+
+    def visit(target):
+        if target.name in done:
+            return
+        if target.name in visiting:
+            raise ValueError("dependency cycle: %s" % " -> ".join(visiting + [target.name]))
+        visiting.append(target.name)
+        for name in sorted(target.after):
+            visit(by_name[name])
+        visiting.pop()
+        done.add(target.name)
+        ordered.append(target)
+
+    for target in targets:
+        visit(target)
+    return ordered
+
+
+class Deployer(object):
+
+    """ Deploys targets with at most `concurrency` stacks in flight. on_event
+        is called with a DeployEvent for every status change and stack event """
+
+    def __init__(self, client, concurrency=4, poll=5.0, on_event=None, throttle=None,
+                 s3=None, template_bucket=None):
+        self.client = client
+        self.s3 = s3
+        self.template_bucket = template_bucket
+        self.concurrency = concurrency
+        self.poll = poll
+        self.on_event = on_event or (lambda event: None)
+        self.throttle = throttle or Throttle()
+        self.results = {}
+
+    def emit(self, stack, status, detail=""):
+        self.on_event(DeployEvent(time.time(), stack, status, detail))
+
+    async def call(self, operation, client=None, **kwargs):
+        """ Runs a (blocking) boto3 call in the default executor, retrying
+            throttled calls after the shared backoff """
+        loop = asyncio.get_running_loop()
+        method = getattr(client or self.client, operation)
+        while True:
+            await self.throttle.wait()
+            try:
+                result = await loop.run_in_executor(None, lambda: method(**kwargs))
+            except ClientError as e:
+                if e.response.get("Error", {}).get("Code") not in THROTTLING_CODES:
+                    raise
+                self.throttle.failure()
+                continue
+            self.throttle.success()
+            return result
+
+    async def describe(self, name):
+        try:
+            stacks = (await self.call("describe_stacks", StackName=name))["Stacks"]
+        except ClientError as e:
+            if "does not exist" in e.response.get("Error", {}).get("Message", ""):
+                return None
+            raise
+        return stacks[0] if stacks else None
+
+    async def wait(self, name, since):
+        """ Polls until the stack settles, forwarding the stack events newer
+            than `since`, and returns its final status """
+        seen = set()
+        while True:
+            events = (await self.call("describe_stack_events", StackName=name)).get("StackEvents", [])
+            for event in reversed(events):
+                stamp = event.get("Timestamp")
+                stamp = stamp.timestamp() if hasattr(stamp, "timestamp") else since
+                if event["EventId"] in seen or stamp < since:
+                    continue
+                seen.add(event["EventId"])
+                self.emit(name, event["ResourceStatus"], "%s %s" % (
+                    event["LogicalResourceId"], event.get("ResourceStatusReason", "")))
+            status = (await self.describe(name))["StackStatus"]
+            if status in SUCCEEDED or status in FAILED:
+                return status
+            await asyncio.sleep(self.poll)
+
+    async def template_location(self, name, body, digest):
+        """ TemplateBody, or TemplateURL of an S3 copy for templates too big
+            to pass inline """
+        if len(body.encode("utf-8")) <= CFN_TEMPLATE_BODY_BYTES:
+            return {"TemplateBody": body}
+        if not (self.s3 and self.template_bucket):
+            raise ValueError("%s is over %i bytes and needs a template bucket" % (name, CFN_TEMPLATE_BODY_BYTES))
+        key = "%s/%s.json" % (name, digest)
+        await self.call("put_object", client=self.s3, Bucket=self.template_bucket, Key=key, Body=body.encode("utf-8"))
+        return {"TemplateURL": "https://%s.s3.amazonaws.com/%s" % (self.template_bucket, key)}
+
+    async def deploy(self, target):
+        # Rendering stays on the loop thread, the builders share class-level caches
+        body = target.body
+        digest = target.digest
+        existing = await self.describe(target.name)
+        if existing and existing["StackStatus"] == "ROLLBACK_COMPLETE":
+            # A failed create can only be deleted, not updated
+            self.emit(target.name, "DELETING", "previous create rolled back")
+            await self.call("delete_stack", StackName=target.name)
+            while True:
+                existing = await self.describe(target.name)
+                if existing is None or existing["StackStatus"] == "DELETE_COMPLETE":
+                    break
+                if existing["StackStatus"] == "DELETE_FAILED":
+                    raise ValueError("deleting the rolled back stack failed: %s" % existing.get("StackStatusReason", ""))
+                await asyncio.sleep(self.poll)
+            existing = None
+        tags = {}
+        if existing:
+            # UpdateStack replaces the tag set, keep the ones already on the
+            # stack. aws: tags are managed by AWS and cannot be passed back
+            tags = dict((t["Key"], t["Value"]) for t in existing.get("Tags", []) if not t["Key"].startswith("aws:"))
+            if tags.get(HASH_TAG) == digest and existing["StackStatus"] in SUCCEEDED:
+                self.emit(target.name, "SKIPPED", "template and parameters unchanged")
+                return "SKIPPED"
+        tags[HASH_TAG] = digest
+        kwargs = dict(
+            StackName=target.name,
+            Parameters=[{"ParameterKey": k, "ParameterValue": v} for k, v in sorted(target.parameters.items())],
+            Capabilities=["CAPABILITY_IAM", "CAPABILITY_NAMED_IAM"],
+            Tags=[{"Key": k, "Value": v} for k, v in sorted(tags.items())],
+        )
+        kwargs.update(await self.template_location(target.name, body, digest))
+        since = time.time() - 1
+        try:
+            await self.call("update_stack" if existing else "create_stack", **kwargs)
+        except ClientError as e:
+            if "No updates are to be performed" in e.response.get("Error", {}).get("Message", ""):
+                self.emit(target.name, "SKIPPED", "no changes")
+                return "SKIPPED"
+            raise
+        self.emit(target.name, "UPDATING" if existing else "CREATING")
+        return await self.wait(target.name, since)
+
+    async def run(self, targets):
+        """ Deploys every target, returns {stack name: final status}. Stacks
+            that come after a failed stack are not attempted (BLOCKED) """
+        targets = order(targets)
+        slots = asyncio.Semaphore(self.concurrency)
+        finished = dict((t.name, asyncio.Event()) for t in targets)
+
+        async def one(target):
+            for name in target.after:
+                await finished[name].wait()
+            blocked = [n for n in target.after if self.results[n] not in SUCCEEDED | set(["SKIPPED"])]
+            try:
+                if blocked:
+                    self.results[target.name] = "BLOCKED"
+                    self.emit(target.name, "BLOCKED", "waiting on failed %s" % ", ".join(sorted(blocked)))
+                    return
+                async with slots:
+                    try:
+                        self.results[target.name] = await self.deploy(target)
+                    except Exception as e:
+                        self.results[target.name] = "ERROR"
+                        self.emit(target.name, "ERROR", str(e))
+                        return
+                self.emit(target.name, "DONE", self.results[target.name])
+            finally:
+                finished[target.name].set()
+
+        await asyncio.gather(*[one(t) for t in targets])
+        return self.results
+
+
+def print_event(event):
+    print("%s %-30s %-20s %s" % (time.strftime("%H:%M:%S", time.localtime(event.time)),
+                                 event.stack, event.status, event.detail))
+
+
+def _split(value, separator, what):
+    if separator not in value:
+        raise argparse.ArgumentTypeError("expected %s, got %s" % (what, value))
+    return value.split(separator, 1)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Create or update stacks concurrently in dependency order")
+    parser.add_argument("targets", nargs="+", help="<stack name>=<module.Class or spec file>")
+    parser.add_argument("--after", action="append", default=[], help="<stack>:<stack it waits for>")
+    parser.add_argument("--parameter", action="append", default=[], help="<stack>:<Key>=<Value>")
+    parser.add_argument("--concurrency", type=int, default=4)
+    parser.add_argument("--poll", type=float, default=5.0, help="seconds between status polls")
+    parser.add_argument("--region")
+    parser.add_argument("--endpoint-url", help="e.g. a local moto server")
+    parser.add_argument("--template-bucket", help="S3 bucket for templates too big to pass inline")
+    parser.add_argument("--threshold", type=float, default=0.9, help="fraction of each CloudFormation limit "
+                        "a stack may use")
+    args = parser.parse_args()
+
+    inline = not args.template_bucket
+    targets = dict((name, Target(name, source, threshold=args.threshold, inline=inline))
+                   for name, source in (_split(t, "=", "<stack name>=<source>") for t in args.targets))
+    for value in args.after:
+        stack, dependency = _split(value, ":", "<stack>:<stack>")
+        targets[stack].after.add(dependency)
+    for value in args.parameter:
+        stack, pair = _split(value, ":", "<stack>:<Key>=<Value>")
+        key, setting = _split(pair, "=", "<Key>=<Value>")
+        targets[stack].parameters[key] = setting
+
+    client = boto3.client("cloudformation", region_name=args.region, endpoint_url=args.endpoint_url)
+    s3 = boto3.client("s3", region_name=args.region, endpoint_url=args.endpoint_url)
+    deployer = Deployer(client, args.concurrency, args.poll, on_event=print_event,
+                        s3=s3, template_bucket=args.template_bucket)
+    results = asyncio.run(deployer.run(list(targets.values())))
+    print("%i throttled calls" % deployer.throttle.throttled)
+    raise SystemExit(0 if all(r in SUCCEEDED or r == "SKIPPED" for r in results.values()) else 1)
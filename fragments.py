@@ -0,0 +1,87 @@
+#!/usr/bin/env python
+
+# Serialized-fragment cache for the parts of a template that never change
+# between renders: IAM trust policies, NAT user data, shared rules/listeners.
+#
+# A Fragment wraps an immutable value and can be used anywhere troposphere
+# accepts an intrinsic. template.to_json() still works as usual, while
+# render(template) swaps each fragment for a placeholder, lets troposphere
+# encode the rest and splices in the fragment's JSON, which is encoded once
+# per indent and then reused by every template containing that fragment.
+# render(template, indent) returns exactly what template.to_json(indent) would.
+
+import json
+import re
+import threading
+
+from troposphere import AWSHelperFn
+
+import ir
+
+_state = threading.local()
+
+# How a placeholder string comes out of the JSON encoder
+_PLACEHOLDER = re.compile(r'"\\u0000fragment:(\d+)\\u0000"')
+
+
+class Fragment(AWSHelperFn):
+
+    """ An immutable subtree whose JSON is computed once. Do not modify the
+        wrapped value after creating the fragment """
+
+    def __init__(self, data):
+        self.data = data
+        self._json = {}
+
+    def _placeholder(self):
+        fragments = getattr(_state, "fragments", None)
+        if fragments is None:
+            return None
+        fragments[id(self)] = self
+        return "\0fragment:%d\0" % id(self)
+
+    def to_dict(self):
+        return self._placeholder() or ir.lower(self.data)
+
+    JSONrepr = to_dict
+
+    def to_json(self, indent):
+        """ Returns the JSON for the value as if it were at the top level """
+        if indent not in self._json:
+            self._json[indent] = json.dumps(ir.lower(self.data), indent=indent,
+                                            sort_keys=True, separators=(',', ': '))
+        return self._json[indent]
+
+
+def render(template, indent=1):
+    """ Same output as template.to_json(indent), reusing cached fragment JSON """
+    return _encode(lambda: template.to_json(indent=indent), indent)
+
+
+def dumps(data, indent=1):
+    """ Like render for plain JSON data (dicts, lists) containing Fragments """
+    return _encode(lambda: json.dumps(data, indent=indent, sort_keys=True, separators=(',', ': '),
+                                      default=lambda fragment: fragment.to_dict()), indent)
+
+
+def _encode(encode, indent):
+    _state.fragments = {}
+    try:
+        rendered = encode()
+        fragments = _state.fragments
+    finally:
+        _state.fragments = None
+
+    def splice(match):
+        text = fragments[int(match.group(1))].to_json(indent)
+        # Nested lines of the fragment are indented relative to the line the
+        # placeholder sits on
+        line = rendered[rendered.rfind("\n", 0, match.start()) + 1:match.start()]
+        margin = line[:len(line) - len(line.lstrip(" "))]
+        return text.replace("\n", "\n" + margin) if margin else text
+
+    return _PLACEHOLDER.sub(splice, rendered)
+
+
+if __name__ == "__main__":
+    pass
@@ -0,0 +1,65 @@
+#!/usr/bin/env python
+
+# Account-wide IAM: the instance roles and profiles are created once here and
+# exported as <stack name>-<profile> (see make_output), e.g. identity-NatInstanceProfile.
+# Stacks launched with IdentityStackName=identity import them with
+# ImportValue instead of creating (and waiting on) their own IAM resources.
+
+from troposphere import Parameter, Ref
+
+from base import CloudformationAbstractBaseClass
+import fragments
+from constants import *
+
+
+class IdentityStack(CloudformationAbstractBaseClass):
+
+    DESCRIPTION = "Template which creates the shared instance roles and profiles and exports them"
+
+    def __init__(self, hooks=()):
+        super(IdentityStack, self).__init__(hooks)
+        self.template.add_description(self.DESCRIPTION)
+
+        self.build(
+            self.add_parameters,
+            self.add_roles,
+            self.add_outputs,
+        )
+
+    def add_parameters(self):
+        self.instance_resources_bucket_name_param = self.template.add_parameter(Parameter(
+            "UploadBucketName",
+            Description="Bucket name for NAT Failover Script",
+            Type="String",
+            MinLength="1",
+        ))
+        self.binaries_bucket = self.template.add_parameter(Parameter(
+            "BinariesBucketName",
+            Description="Bucket the default instance role may read binaries from",
+            Type="String",
+            MinLength="1",
+        ))
+        self.scripts_bucket = self.template.add_parameter(Parameter(
+            "ScriptsBucketName",
+            Description="Bucket the default instance role may read scripts from",
+            Type="String",
+            MinLength="1",
+        ))
+
+    def add_roles(self):
+        for resource in self.make_nat_instance_role(Ref(self.instance_resources_bucket_name_param)):
+            self.template.add_resource(resource)
+        self.add_default_instance_role("Default", Ref(self.binaries_bucket), Ref(self.scripts_bucket))
+
+    def add_outputs(self):
+        for name in ("NatInstanceProfile", "DefaultInstanceProfile"):
+            self.template.add_output(self.make_output(
+                name,
+                "Instance profile %s, exported for IdentityStackName" % name,
+                Ref(name),
+            ))
+
+
+if __name__ == "__main__":
+    identity = IdentityStack()
+    print(fragments.render(identity.template))
@@ -0,0 +1,132 @@
+#!/usr/bin/env python
+
+# Compact intermediate representation for the resources that stacks create
+# in bulk (looping SG rules, per-AZ routes and so on).
+#
+# A troposphere object carries a __dict__, a per-instance copy of its prop
+# names and a properties dict, and type checks every assignment. The records
+# here use __slots__, hold properties as a tuple of (name, value) pairs and
+# are only lowered to plain dicts when the template is serialized. They can
+# be added to a troposphere Template next to regular resources:
+#
+#   ingress = self.template.add_resource(ir.Resource(
+#       "LoopSGingress0", "AWS::EC2::SecurityGroupIngress",
+#       GroupId=ir.ref(self.sg_loopsg), IpProtocol="tcp", ...))
+#
+# No property validation is done, so only use them where the builder fixes
+# the shape of the resource. Troposphere objects must refer to a record by
+# name, i.e. Ref(record.title) rather than Ref(record).
+
+try:
+    basestring
+except NameError:
+    basestring = str
+
+
+def lower(value):
+    """ Converts records, troposphere objects and containers of them into
+        plain JSON-ready values """
+    if isinstance(value, (Resource, Struct, Intrinsic)):
+        return value.to_dict()
+    if isinstance(value, (list, tuple)):
+        return [lower(v) for v in value]
+    if isinstance(value, dict):
+        return dict((k, lower(v)) for k, v in value.items())
+    if hasattr(value, "to_dict"):
+        return lower(value.to_dict())
+    if hasattr(value, "JSONrepr"):
+        return lower(value.JSONrepr())
+    return value
+
+
+def _name(target):
+    # Logical name of a troposphere object or record, or the string itself
+    if isinstance(target, basestring):
+        return target
+    return target.title
+
+
+class Intrinsic(object):
+
+    """ A CloudFormation intrinsic function, e.g. {"Ref": "VpcId"} """
+
+    __slots__ = ("fn", "args")
+
+    def __init__(self, fn, args):
+        self.fn = fn
+        self.args = args
+
+    def to_dict(self):
+        return {self.fn: lower(self.args)}
+
+    JSONrepr = to_dict
+
+
+def ref(target):
+    return Intrinsic("Ref", _name(target))
+
+
+def get_att(target, attribute):
+    return Intrinsic("Fn::GetAtt", (_name(target), attribute))
+
+
+def find_in_map(mapname, key, value):
+    return Intrinsic("Fn::FindInMap", (mapname, key, value))
+
+
+def join(delimiter, values):
+    return Intrinsic("Fn::Join", (delimiter, values))
+
+
+def select(index, values):
+    return Intrinsic("Fn::Select", (index, values))
+
+
+def fn_if(condition, true, false):
+    return Intrinsic("Fn::If", (condition, true, false))
+
+
+class Struct(object):
+
+    """ A nested property type such as a security group rule """
+
+    __slots__ = ("properties",)
+
+    def __init__(self, **properties):
+        self.properties = tuple(properties.items())
+
+    def to_dict(self):
+        return dict((k, lower(v)) for k, v in self.properties)
+
+    JSONrepr = to_dict
+
+
+class Resource(object):
+
+    """ A template resource: logical name, type and properties, plus the
+        DependsOn/Condition attributes """
+
+    __slots__ = ("title", "resource_type", "properties", "depends_on", "condition")
+
+    def __init__(self, title, resource_type, DependsOn=None, Condition=None, **properties):
+        self.title = title
+        self.resource_type = resource_type
+        self.properties = tuple(properties.items())
+        self.depends_on = DependsOn
+        self.condition = Condition
+
+    def to_dict(self):
+        d = {"Type": self.resource_type}
+        if self.properties:
+            d["Properties"] = dict((k, lower(v)) for k, v in self.properties)
+        if self.depends_on is not None:
+            d["DependsOn"] = self.depends_on
+        if self.condition is not None:
+            d["Condition"] = self.condition
+        return d
+
+    JSONrepr = to_dict
+
+
+if __name__ == "__main__":
+    pass
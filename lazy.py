@@ -0,0 +1,45 @@
+#!/usr/bin/env python
+
+# Helpers to defer the cost of importing troposphere resource modules and
+# building shared objects until a stack actually uses them
+
+import importlib
+
+
+class LazyModule(object):
+
+    """ Stand-in for a module that is imported on first attribute access.
+        Once loaded, the module namespace is copied onto the proxy so later
+        lookups are plain attribute reads """
+
+    def __init__(self, name):
+        self.__dict__["_name"] = name
+
+    def __getattr__(self, attr):
+        module = importlib.import_module(self._name)
+        self.__dict__.update(module.__dict__)
+        return getattr(module, attr)
+
+    def __repr__(self):
+        return "<lazy module %r>" % self._name
+
+
+class lazy_attribute(object):
+
+    """ Class level attribute whose value is built by the decorated function
+        the first time it is read, then shared by the class and subclasses """
+
+    def __init__(self, factory):
+        self.factory = factory
+        self.__doc__ = factory.__doc__
+
+    def __get__(self, instance, owner):
+        try:
+            return self.value
+        except AttributeError:
+            self.value = self.factory()
+            return self.value
+
+
+if __name__ == "__main__":
+    pass
@@ -0,0 +1,235 @@
+#!/usr/bin/env python
+
+# CloudFormation quota headroom, checked while rendering instead of at
+# deploy time:
+#
+#   python limits.py nat.NATStack securitygroups.BaseSGs specs/*.yaml --threshold 0.8
+#
+# prints each stack's usage of every limit in CFN_LIMITS and, for every list
+# attribute a spec can extend (LOOP_RULES, NAT_SG_RULES, ...), how many more
+# entries fit before the threshold. The growth per entry is measured by
+# rendering the stack with one more copy of the attribute's last entry. The
+# stack cannot build more entries of a fixed length attribute (spec.py's
+# FIXED_LENGTH), so one more NAT_AZ_INDEXES entry is estimated from what the
+# last AZ adds: MGMTSubnet2, NATInstance2, PrivateRoute2 and the rest named
+# after its number.
+#
+# template_body_bytes only applies to templates passed inline as TemplateBody,
+# --via-s3 leaves it out for stacks deployed through a template bucket.
+#
+# LimitGuard does the check as part of any build and raises when a stack is
+# past the threshold:
+#
+#   NATStack(hooks=[LimitGuard(0.9, inline=False)])
+#
+# watch.py, spec.py, region.py and deploy.py render with it.
+
+import argparse
+import importlib
+import json
+import re
+from collections import namedtuple
+
+from base import BuildHook
+import fragments
+from constants import CFN_LIMITS
+
+# The limit that does not apply to templates deployed through S3
+INLINE_LIMIT = "template_body_bytes"
+
+# Template sections counted by the limits of the same name
+SECTION_LIMITS = {
+    "Resources": "resources",
+    "Parameters": "parameters",
+    "Outputs": "outputs",
+    "Mappings": "mappings",
+}
+
+Usage = namedtuple("Usage", ["limit", "used", "maximum"])
+
+Projection = namedtuple("Projection", ["attribute", "growth", "headroom", "bound_by", "unprojectable"])
+
+
+def measure(template, rendered=None):
+    """ Returns {limit name: Usage} for a template, its size as deploy.py
+        sends it (compact JSON) """
+    if rendered is None:
+        rendered = fragments.render(template, None)
+    used = {
+        "resources": len(template.resources),
+        "parameters": len(template.parameters),
+        "outputs": len(template.outputs),
+        "mappings": len(template.mappings),
+        "mapping_attributes": max([len(attributes)
+                                   for mapping in template.mappings.values()
+                                   for attributes in mapping.values()
+                                   if isinstance(attributes, dict)] or [0]),
+        "template_bytes": len(rendered.encode("utf-8")),
+        "template_body_bytes": len(rendered.encode("utf-8")),
+    }
+    return dict((name, Usage(name, used[name], maximum)) for name, maximum in CFN_LIMITS.items())
+
+
+def over(usages, threshold, inline=True):
+    """ The usages past threshold (a fraction of each limit), leaving out
+        the TemplateBody limit unless the template is passed inline """
+    return [u for u in usages.values()
+            if u.used > u.maximum * threshold and (inline or u.limit != INLINE_LIMIT)]
+
+
+def growable_attributes(cls):
+    """ The list attributes of cls a spec can extend """
+    spec = importlib.import_module("spec")
+    return sorted(attribute for attribute in set(spec.SPEC_ATTRIBUTES.values())
+                  if isinstance(getattr(cls, attribute, None), list) and getattr(cls, attribute))
+
+
+def _grown(values):
+    """ values with one more copy of its last entry. Entries named by their
+        first item (NAT_ROUTES) get a new name, the names must be unique """
+    last = values[-1]
+    if isinstance(last, (tuple, list)) and last and isinstance(last[0], str):
+        last = type(last)([last[0] + "Projected"] + list(last[1:]))
+    return values + [last]
+
+
+def last_entry_footprint(rendered, count):
+    """ Usage growth of the template entries named after the last of count
+        fixed entries (MGMTSubnet2, NATInstance2, PrivateRoute2, ... for the
+        second AZ). References to them from shared resources are not counted """
+    template = json.loads(rendered)
+    numbered = re.compile(r"\D%i$" % count)
+    rest = dict(template)
+    growth = {}
+    for section, limit in SECTION_LIMITS.items():
+        entries = template.get(section)
+        if not entries:
+            growth[limit] = 0
+            continue
+        rest[section] = dict((name, value) for name, value in entries.items() if not numbered.search(name))
+        growth[limit] = len(entries) - len(rest[section])
+    size = len(rendered.encode("utf-8")) - len(fragments.dumps(rest, None).encode("utf-8"))
+    growth["template_bytes"] = growth["template_body_bytes"] = size
+    return growth
+
+
+def _headroom(base, growth, threshold):
+    """ (entries that fit before the first limit reaches threshold, that
+        limit) for the growth per entry """
+    headroom, bound_by = None, None
+    for name, delta in growth.items():
+        fits = max(0, int((base[name].maximum * threshold - base[name].used) // delta))
+        if headroom is None or fits < headroom:
+            headroom, bound_by = fits, name
+    return headroom, bound_by
+
+
+def project(cls, threshold=1.0, rendered=None, inline=True):
+    """ For each growable attribute, how much one more entry adds and how
+        many more entries fit before the first limit reaches threshold.
+        headroom is None when an entry changes the template without growing
+        it. growth is None and unprojectable says why when the copied entry
+        cannot be built or leaves the template unchanged. Fixed length
+        attributes are projected from the footprint of their last entry """
+    spec = importlib.import_module("spec")
+    template = cls().template
+    rendered = rendered or fragments.render(template, None)
+    base = measure(template, rendered)
+    projections = []
+    for attribute in growable_attributes(cls):
+        values = getattr(cls, attribute)
+        if attribute in spec.FIXED_LENGTH:
+            growth = last_entry_footprint(rendered, len(values))
+        else:
+            try:
+                grown_template = type(cls.__name__, (cls,), {attribute: _grown(values)})().template
+            except ValueError as e:
+                projections.append(Projection(attribute, None, None, None, str(e)))
+                continue
+            grown_rendered = fragments.render(grown_template, None)
+            if grown_rendered == rendered:
+                projections.append(Projection(attribute, None, None, None, "extra entries are not used"))
+                continue
+            usages = measure(grown_template, grown_rendered)
+            growth = dict((name, usage.used - base[name].used) for name, usage in usages.items())
+        growth = dict((name, delta) for name, delta in growth.items()
+                      if delta > 0 and (inline or name != INLINE_LIMIT))
+        headroom, bound_by = _headroom(base, growth, threshold)
+        projections.append(Projection(attribute, growth, headroom, bound_by, None))
+    return projections
+
+
+class LimitGuard(BuildHook):
+
+    """ Fails the build of any stack using more than threshold of a limit,
+        e.g. 0.9 keeps 10% headroom on every quota. inline=False is for
+        stacks deployed through a template bucket """
+
+    def __init__(self, threshold=0.9, inline=True):
+        self.threshold = threshold
+        self.inline = inline
+        self.usages = {}
+
+    def finish_build(self, stack):
+        usages = measure(stack.template)
+        self.usages[type(stack).__name__] = usages
+        exceeded = over(usages, self.threshold, self.inline)
+        if exceeded:
+            raise ValueError("%s is past %i%% of %s" % (
+                type(stack).__name__, self.threshold * 100,
+                ", ".join("%s (%i of %i)" % (u.limit, u.used, u.maximum) for u in sorted(exceeded))))
+
+
+def load_class(source):
+    """ module.Class or a spec file """
+    if source.endswith((".yaml", ".yml", ".json")):
+        spec = importlib.import_module("spec")
+        return spec.compile_spec(spec.load_spec(source))
+    module, name = source.rsplit(".", 1)
+    return getattr(importlib.import_module(module), name)
+
+
+def report(cls, threshold=0.9, inline=True):
+    """ Text report of a stack's headroom, returns (text, usages past threshold) """
+    stack = cls()
+    rendered = fragments.render(stack.template, None)
+    usages = measure(stack.template, rendered)
+    exceeded = over(usages, threshold, inline)
+    lines = ["%s" % cls.__name__]
+    for name in sorted(usages):
+        usage = usages[name]
+        if usage in exceeded:
+            note = "  OVER %i%%" % (threshold * 100)
+        elif name == INLINE_LIMIT and not inline:
+            note = "  not checked, deployed via S3"
+        else:
+            note = ""
+        lines.append("  %-20s %8i / %-8i %5.1f%%%s" % (
+            name, usage.used, usage.maximum, 100.0 * usage.used / usage.maximum, note))
+    for projection in project(cls, threshold, rendered, inline):
+        if projection.unprojectable:
+            lines.append("  +1 %-17s %s, not projected" % (projection.attribute, projection.unprojectable))
+        elif projection.headroom is None:
+            lines.append("  +1 %-17s no growth" % projection.attribute)
+        else:
+            lines.append("  +1 %-17s %s, %i more fit (bound by %s)" % (
+                projection.attribute,
+                ", ".join("%s +%i" % item for item in sorted(projection.growth.items())),
+                projection.headroom, projection.bound_by))
+    return "\n".join(lines), exceeded
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Report CloudFormation quota headroom of stacks")
+    parser.add_argument("stacks", nargs="+", help="module.Class or spec files")
+    parser.add_argument("--threshold", type=float, default=0.9, help="fraction of each limit to fail at")
+    parser.add_argument("--via-s3", action="store_true", help="the stacks are deployed through a template bucket, "
+                        "leave out the %s limit" % INLINE_LIMIT)
+    args = parser.parse_args()
+
+    failed = False
+    for source in args.stacks:
+        text, exceeded = report(load_class(source), args.threshold, not args.via_s3)
+        print(text)
+        failed = failed or bool(exceeded)
+    raise SystemExit(1 if failed else 0)
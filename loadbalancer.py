@@ -0,0 +1,139 @@
+#!/usr/bin/env python
+
+from troposphere import GetAtt, Parameter, Ref, If, Not, Equals
+import troposphere.ec2 as ec2
+import troposphere.elasticloadbalancing as elb
+
+from base import CloudformationAbstractBaseClass
+import fragments
+from constants import *
+
+
+class WebLoadBalancerStack(CloudformationAbstractBaseClass):
+
+    DESCRIPTION = "Template which creates the web tier load balancer and the SGs for it and its instances"
+
+    # Ports the backends listen on behind the ELB
+    BACKEND_PORTS = ["80"]
+
+    def __init__(self, hooks=()):
+        super(WebLoadBalancerStack, self).__init__(hooks)
+        self.template.add_description(self.DESCRIPTION)
+
+        self.build(
+            self.add_parameters,
+            self.add_mappings,
+            self.add_sgs,
+            self.add_load_balancer,
+            self.add_outputs,
+        )
+
+    def add_parameters(self):
+
+        """ Implements the abstract method and defines a number of parameters the
+            calling process or GUI must supply """
+        super(WebLoadBalancerStack, self).add_default_parameters()
+
+        self.vpc_id = self.template.add_parameter(Parameter(
+            "VpcId",
+            Description="The ID of the existing Virtual Private Cloud (VPC)",
+            Type="AWS::EC2::VPC::Id",
+            MinLength="1",
+            AllowedPattern=VALID_VPC_REGEX,
+            ConstraintDescription=INVALID_VPC_MSG,
+            Default=""
+        ))
+        self.web_subnet_1 = self.template.add_parameter(Parameter(
+            "WebSubnet1",
+            Description="The ID of the Web Tier Subnet in AZ 1",
+            Type="AWS::EC2::Subnet::Id",
+            MinLength="1",
+            ConstraintDescription=INVALID_SUBNET_MSG,
+            Default=""
+        ))
+        self.web_subnet_2 = self.template.add_parameter(Parameter(
+            "WebSubnet2",
+            Description="The ID of the Web Tier Subnet in AZ 2",
+            Type="AWS::EC2::Subnet::Id",
+            MinLength="1",
+            ConstraintDescription=INVALID_SUBNET_MSG,
+            Default=""
+        ))
+        self.add_network_stack_parameter(self.vpc_id, self.web_subnet_1, self.web_subnet_2)
+
+        self.certificate_arn = self.template.add_parameter(Parameter(
+            "CertificateArn",
+            Description="ACM/IAM certificate for an HTTPS listener, leave empty for HTTP only",
+            Type="String",
+            Default="",
+        ))
+        self.template.add_condition("HasCertificate", Not(Equals(Ref(self.certificate_arn), "")))
+        self.add_elb_parameters()
+
+    def add_mappings(self):
+        # Resource names in the tags
+        self.region_convention_mapping = self.template.add_mapping('REGIONNAMEMAPPINGS', REGION_TO_CONVENTION_MAPPING)
+
+    def add_sgs(self):
+        self.elb_sg = self.template.add_resource(ec2.SecurityGroup(
+            "WebElbSG",
+            GroupDescription="Client access to the web tier load balancer",
+            VpcId=self.get_network_input(self.vpc_id),
+            SecurityGroupIngress=[
+              ec2.SecurityGroupRule(IpProtocol="tcp", FromPort="80", ToPort="80", CidrIp=QUAD_ZERO_CIDR),
+              # Only open while there is an HTTPS listener
+              If("HasCertificate",
+                 ec2.SecurityGroupRule(IpProtocol="tcp", FromPort="443", ToPort="443", CidrIp=QUAD_ZERO_CIDR),
+                 Ref("AWS::NoValue")),
+            ],
+            Tags=self.get_tags_as_list(None, '-web-sg-elb')
+        ))
+        # Web tier instances join this group to accept traffic from the ELB only
+        self.instance_sg = self.template.add_resource(ec2.SecurityGroup(
+            "WebInstanceSG",
+            GroupDescription="Web tier instances behind the load balancer",
+            VpcId=self.get_network_input(self.vpc_id),
+            SecurityGroupIngress=[
+              ec2.SecurityGroupRule(IpProtocol="tcp", FromPort=port, ToPort=port,
+                                    SourceSecurityGroupId=Ref(self.elb_sg))
+              for port in self.BACKEND_PORTS
+            ],
+            Tags=self.get_tags_as_list(None, '-web-sg-instances')
+        ))
+
+    def add_load_balancer(self):
+        https = elb.Listener(
+            LoadBalancerPort="443",
+            Protocol="HTTPS",
+            InstancePort="80",
+            InstanceProtocol="HTTP",
+            SSLCertificateId=Ref(self.certificate_arn),
+        )
+        self.load_balancer = self.template.add_resource(self.make_load_balancer(
+            "WebElb",
+            [self.get_network_input(self.web_subnet_1), self.get_network_input(self.web_subnet_2)],
+            [Ref(self.elb_sg)],
+            listeners=[self.ELB_HTTP_LISTENER, If("HasCertificate", https, Ref("AWS::NoValue"))],
+            taglist=self.get_tags_as_list(None, '-web-elb'),
+        ))
+
+    def add_outputs(self):
+        self.template.add_output(self.make_output(
+            "WebElbName",
+            "Name of the web tier load balancer",
+            Ref(self.load_balancer)
+        ))
+        self.template.add_output(self.make_output(
+            "WebElbDNSName",
+            "DNS name of the web tier load balancer",
+            GetAtt(self.load_balancer, "DNSName")
+        ))
+        self.template.add_output(self.make_output(
+            "WebInstanceSG",
+            "SG for the web tier instances registered with the load balancer",
+            Ref(self.instance_sg)
+        ))
+
+if __name__ == "__main__":
+    lbstack = WebLoadBalancerStack()
+    print(fragments.render(lbstack.template))
@@ -3,36 +3,70 @@
 import os
 import sys
 
-from troposphere import GetAtt, GetAZs, Join, Output, Parameter, Ref, Select, FindInMap, Base64
-import troposphere.cloudformation as cf
+from troposphere import GetAtt, GetAZs, Join, Output, Parameter, Ref, Select, FindInMap, Base64, Equals, If, Or, And, Not, Condition
+import troposphere.autoscaling as autoscaling
+from troposphere.policies import CreationPolicy, ResourceSignal
 import troposphere.ec2 as ec2
-import troposphere.iam as iam
 
 from base import CloudformationAbstractBaseClass
+import ir
+from userdata import Script, Section, Slot, merge
+import fragments
 from constants import *
 
 
 class NATStack(CloudformationAbstractBaseClass):
 
-    def __init__(self):
-        # super(NATStack, self).__init__()
-        self.template.add_description("Template which creates two NATs, modifies route tables and enables HA NAT failover")
+    DESCRIPTION = "Template which creates two NATs (HA instance pair, NAT Gateways or self-healing ASGs) and modifies route tables"
 
-        # various definitions and constants at the top
-        self.add_parameters()
-        self.add_mappings()
+    # Ingress rules for the NAT SG, a cidr of 'vpc' means the CIDR of the
+    # environment's VPC from VPCMAPPING
+    NAT_SG_RULES = [
+        {'prot': 'tcp', 'fp': '22', 'tp': '22', 'cidr': INTERNAL_IP_RANGE},
+        {'prot': 'tcp', 'fp': '53', 'tp': '53', 'cidr': 'vpc'},
+        {'prot': 'udp', 'fp': '53', 'tp': '53', 'cidr': 'vpc'},
+        {'prot': 'tcp', 'fp': '80', 'tp': '80', 'cidr': 'vpc'},
+        {'prot': 'tcp', 'fp': '443', 'tp': '443', 'cidr': 'vpc'},
+        {'prot': 'icmp', 'fp': '-1', 'tp': '-1', 'cidr': INTERNAL_IP_RANGE},
+    ]
 
-        self.add_nat_instance_role()
-        self.add_nat_sg()
+    # Index into the account's AZ naming convention for NAT 1 and NAT 2
+    NAT_AZ_INDEXES = [0, 1]
 
-        self.add_nat_instances()
+    # Root volume of the NAT instances, see make_block_device
+    NAT_ROOT_VOLUME = {"device_name": "/dev/xvda", "size": 8, "volume_type": "gp3"}
 
-        self.allocate_eips()
-        self.add_routes()
+    # Default routes sent through the NATs as (route name, route table parameter, NAT number)
+    NAT_ROUTES = [
+        ("PrivateRoute1", "PrivateRouteTable1", 1),
+        ("PrivateRoute2", "PrivateRouteTable2", 2),
+        ("SSRoute1", "SSRouteTable1", 1),
+        ("SSRoute2", "SSRouteTable2", 2),
+    ]
 
+    def __init__(self, hooks=()):
+        super(NATStack, self).__init__(hooks)
+        self.template.add_description(self.DESCRIPTION)
 
-        # outputs that might be of interest
-        self.add_outputs()
+        self.build(
+            # various definitions and constants at the top
+            self.add_parameters,
+            self.add_mappings,
+
+            self.add_nat_instance_role,
+            self.add_nat_sg,
+
+            self.add_nat_instances,
+
+            self.allocate_eips,
+            self.add_nat_gateways,
+            self.add_nat_autoscaling_groups,
+            self.add_routes,
+            self.add_endpoints,
+
+            # outputs that might be of interest
+            self.add_outputs,
+        )
 
 
     def add_parameters(self):
@@ -109,6 +143,12 @@ class NATStack(CloudformationAbstractBaseClass):
             Default=""
         ))
 
+        self.add_network_stack_parameter(
+            self.vpc_id, self.mgmt_subnet_1, self.mgmt_subnet_2,
+            self.private_route_table_1, self.private_route_table_2,
+            self.ss_route_table_1, self.ss_route_table_2,
+        )
+
         # NAT Speciific Parameters
         self.nat_hostname_1 = self.template.add_parameter(Parameter(
             "NatHostname1",
@@ -131,6 +171,13 @@ class NATStack(CloudformationAbstractBaseClass):
             AllowedValues= INSTANCE_TYPES,
             ConstraintDescription= INVALID_INSTANCE_TYPE_MSG
         ))
+        self.nat_ebs_optimized = self.template.add_parameter(Parameter(
+            "NatEbsOptimized",
+            Description="EBS optimized NAT instances, not supported by the t2 types",
+            Type="String",
+            Default="false",
+            AllowedValues=VALID_TRUE_FALSE_VALUES,
+        ))
         self.ping_number = self.template.add_parameter(Parameter(
             "PingNumber",
             Description= "The number of times the health check will ping the alternate NAT Node",
@@ -178,6 +225,75 @@ class NATStack(CloudformationAbstractBaseClass):
             ConstraintDescription=INVALID_AMI_MSG,
             Default=""
         ))
+        self.nat_signal_timeout = self.template.add_parameter(Parameter(
+            "NatSignalTimeout",
+            Description="How long (ISO 8601 duration) to wait for each NAT to signal it is forwarding",
+            Type="String",
+            Default="PT20M",
+            AllowedPattern="PT(\\d+H)?(\\d+M)?(\\d+S)?",
+            ConstraintDescription="must be an ISO 8601 duration such as PT20M",
+        ))
+        self.boot_metrics = self.template.add_parameter(Parameter(
+            "BootMetrics",
+            Description="Publish each NAT's boot phase durations (also in /var/log/nat-boot-timeline.json) "
+                        "as CloudWatch metrics in the %s namespace" % NAT_BOOT_METRICS_NAMESPACE,
+            Type="String",
+            Default="false",
+            AllowedValues=VALID_TRUE_FALSE_VALUES,
+        ))
+        self.nat_stats_interval = self.template.add_parameter(Parameter(
+            "NatStatsInterval",
+            Description="Seconds between nat_stats_exporter.sh samples of conntrack, NAT and NIC counters "
+                        "(kept on the NAT in /var/log/nat-stats)",
+            Type="Number",
+            Default="60",
+            MinValue="5",
+        ))
+        self.nat_stats_metrics = self.template.add_parameter(Parameter(
+            "NatStatsMetrics",
+            Description="Push aggregated flow statistics as CloudWatch metrics in the %s namespace" % NAT_FLOW_METRICS_NAMESPACE,
+            Type="String",
+            Default="false",
+            AllowedValues=VALID_TRUE_FALSE_VALUES,
+        ))
+        self.bootstrap_mode = self.template.add_parameter(Parameter(
+            "BootstrapMode",
+            Description="install: fetch and install tooling on every boot, bundle: install the versioned "
+                        "nat-bootstrap-<BootstrapBundleVersion>.tar.gz from UploadBucketName if not present, "
+                        "prebaked: EC2InstanceAmi already has the tooling",
+            Type="String",
+            Default="install",
+            AllowedValues=BOOTSTRAP_MODES,
+        ))
+        self.bootstrap_bundle_version = self.template.add_parameter(Parameter(
+            "BootstrapBundleVersion",
+            Description="Version of the bootstrap bundle built by bootstrap_bundle.py",
+            Type="String",
+            Default="1",
+        ))
+        self.nat_engine = self.template.add_parameter(Parameter(
+            "NatEngine",
+            Description="instance: HA pair of NAT instances, gateway: a managed NAT Gateway per AZ, "
+                        "asg: a self-healing NAT per AZ (size 1 Auto Scaling group with a floating ENI)",
+            Type="String",
+            Default="instance",
+            AllowedValues=NAT_ENGINES,
+        ))
+        self.gateway_endpoints = self.template.add_parameter(Parameter(
+            "GatewayEndpoints",
+            Description="Add S3/DynamoDB gateway endpoints to the private and SS route tables. "
+                        "S3 access from them is then limited to the bootstrap buckets",
+            Type="String",
+            Default="false",
+            AllowedValues=VALID_TRUE_FALSE_VALUES,
+        ))
+        self.template.add_condition("AddGatewayEndpoints", Equals(Ref(self.gateway_endpoints), "true"))
+        self.template.add_condition("UseNatInstances", Equals(Ref(self.nat_engine), "instance"))
+        self.template.add_condition("UseNatGateway", Equals(Ref(self.nat_engine), "gateway"))
+        self.template.add_condition("UseNatAutoScaling", Equals(Ref(self.nat_engine), "asg"))
+        self.template.add_condition("UseNatHosts", Or(Condition("UseNatInstances"), Condition("UseNatAutoScaling")))
+        self.add_identity_parameters()
+        self.template.add_condition("CreateNatIdentity", And(Condition("UseNatHosts"), Not(Condition("UseSharedIdentity"))))
 
     def add_mappings(self):
         self.vpc_mapping = self.template.add_mapping('VPCMAPPING', VPC_MAPPING)
@@ -188,114 +304,164 @@ class NATStack(CloudformationAbstractBaseClass):
         self.az_per_account = self.template.add_mapping('ACCOUNTAZS', AZ_PER_ACCOUNT)
 
     def add_nat_instance_role(self):
-        # Create a role for the NAT Instance
-        # FIXME: Going to need to be able to grab and set own EIP
-        self.nat_instance_role = self.template.add_resource(iam.Role(
-            "NatInstanceRole",
-            AssumeRolePolicyDocument={
-              "Statement": [{
-                "Effect": "Allow",
-                "Principal": {
-                  "Service": [ "ec2.amazonaws.com" ]
-                },
-                "Action": [ "sts:AssumeRole" ]
-              }]
-            },
-            Path="/"
-        ))
-
-        # The NAT does not have any perms in this particular config
-        self.nat_instance_ec2_policy = self.template.add_resource(iam.PolicyType(
-          "NatInstanceEC2Policy",
-          PolicyName="NAT_Takeover",
-          PolicyDocument={
-            # to allow us to update things
-            "Statement": [{
-              "Effect": "Allow",
-              "Action": [
-                "ec2:AssociateAddress",
-                "ec2:DescribeInstances",
-                "ec2:DescribeRouteTables",
-                "ec2:CreateRoute",
-                "ec2:ReplaceRoute",
-                "ec2:StartInstances",
-                "ec2:StopInstances"
-              ], 
-              "Resource": "*", # Perhaps come and change this, and use waitcondition handles to prevent other stuff happening
-            }]
-          },
-          Roles=[ Ref(self.nat_instance_role) ]
-        ))
-
-        self.nat_instance_ec2_policy = self.template.add_resource(iam.PolicyType(
-          "NatInstanceS3Policy",
-          PolicyName="NAT_S3_Pull",
-          PolicyDocument={
-            # to allow us to update things
-            "Statement": [{
-                "Effect": "Allow",
-                "Action": [ "s3:GetObject" ],
-                "Resource": [
-                    Join("", [ "arn:aws:s3:::", Ref(self.instance_resources_bucket_name_param), "" ]),
-                    Join("", [ "arn:aws:s3:::", Ref(self.instance_resources_bucket_name_param), "/*" ]),
-                ]
-                },{
-                "Effect": "Allow",
-                "Action": [ "s3:PutObject" ],
-                "Resource": [
-                    Join("", [ "arn:aws:s3:::", Ref(self.instance_resources_bucket_name_param), "" ]),
-                    Join("", [ "arn:aws:s3:::", Ref(self.instance_resources_bucket_name_param), "/*" ]),
-                ]},
-            ]
-          },
-          Roles=[ Ref(self.nat_instance_role) ]
-        ))
-
-        self.nat_instance_profile = self.template.add_resource(iam.InstanceProfile(
-          "NatInstanceProfile",
-          Path="/",
-          Roles=[ Ref(self.nat_instance_role) ]
-        ))
+        # Only created when no IdentityStackName is given, otherwise the
+        # profile is imported from the shared identity stack
+        for resource in self.make_nat_instance_role(Ref(self.instance_resources_bucket_name_param),
+                                                    condition="CreateNatIdentity"):
+            self.template.add_resource(resource)
+        self.nat_instance_profile = self.get_identity_ref("NatInstanceProfile", "NatInstanceProfile")
+        # Launch templates take the ARN, the profile's Path is /
+        self.nat_instance_profile_arn = Join("", [
+            "arn:", Ref("AWS::Partition"), ":iam::", Ref("AWS::AccountId"), ":instance-profile/",
+            self.nat_instance_profile,
+        ])
 
 
     def allocate_eips(self):
-        self.eip1 = self.template.add_resource(ec2.EIP(
+        self.eip1 = self.template.add_resource(ir.Resource(
             "EIP1",
+            "AWS::EC2::EIP",
+            Condition="UseNatInstances",
             Domain="vpc",
-            InstanceId=Ref(self.nat_instance_1),
+            InstanceId=ir.ref(self.nat_instance_1),
         ))
-        self.eip2 = self.template.add_resource(ec2.EIP(
+        self.eip2 = self.template.add_resource(ir.Resource(
             "EIP2",
+            "AWS::EC2::EIP",
+            Condition="UseNatInstances",
             Domain="vpc",
-            InstanceId=Ref(self.nat_instance_2),
-        ))
+            InstanceId=ir.ref(self.nat_instance_2),
+        ))
+
+    def add_nat_gateways(self):
+        """ Managed alternative to the instance pair: one NAT Gateway with its
+            own EIP in each management subnet """
+        self.nat_gateways = []
+        for i, subnet in enumerate([self.mgmt_subnet_1, self.mgmt_subnet_2], 1):
+            eip = self.template.add_resource(ir.Resource(
+                "NATGatewayEIP%i" % i,
+                "AWS::EC2::EIP",
+                Condition="UseNatGateway",
+                Domain="vpc",
+            ))
+            self.nat_gateways.append(self.template.add_resource(ir.Resource(
+                "NATGateway%i" % i,
+                "AWS::EC2::NatGateway",
+                Condition="UseNatGateway",
+                AllocationId=ir.get_att(eip, "AllocationId"),
+                SubnetId=self.get_network_input(subnet),
+            )))
+
+    def add_nat_autoscaling_groups(self):
+        """ Self-healing NATs: each AZ gets a persistent ENI holding the EIP and
+            acting as the route target, plus a size 1 Auto Scaling group whose
+            instance attaches that ENI at boot. A replacement instance takes
+            over the same ENI, so routes never change and recovery only takes
+            as long as an instance launch """
+        self.nat_enis = []
+        nat_hostnames = [self.nat_hostname_1, self.nat_hostname_2]
+        for i, subnet in enumerate([self.mgmt_subnet_1, self.mgmt_subnet_2], 1):
+            tags = self.get_tags_as_list(self.NAT_AZ_INDEXES[i - 1], '-bigdata-mgmt-', Ref(nat_hostnames[i - 1]))
+            eni = self.template.add_resource(ec2.NetworkInterface(
+                "NATENI%i" % i,
+                Condition="UseNatAutoScaling",
+                Description="Floating NAT interface, route target for AZ %i" % i,
+                SubnetId=self.get_network_input(subnet),
+                GroupSet=[Ref(self.nat_instance_sg)],
+                SourceDestCheck=False,
+                Tags=tags,
+            ))
+            eip = self.template.add_resource(ir.Resource(
+                "NATENIEIP%i" % i,
+                "AWS::EC2::EIP",
+                Condition="UseNatAutoScaling",
+                Domain="vpc",
+            ))
+            self.template.add_resource(ir.Resource(
+                "NATENIEIPAssociation%i" % i,
+                "AWS::EC2::EIPAssociation",
+                Condition="UseNatAutoScaling",
+                AllocationId=ir.get_att(eip, "AllocationId"),
+                NetworkInterfaceId=ir.ref(eni),
+            ))
+            launch_template = self.template.add_resource(ec2.LaunchTemplate(
+                "NATLaunchTemplate%i" % i,
+                Condition="UseNatAutoScaling",
+                LaunchTemplateData=ec2.LaunchTemplateData(
+                    IamInstanceProfile=ec2.IamInstanceProfile(Arn=self.nat_instance_profile_arn),
+                    InstanceType=Ref(self.nat_size),
+                    KeyName=Ref(self.keyname_param),
+                    ImageId=Ref(self.ec2_instance_ami),
+                    EbsOptimized=Ref(self.nat_ebs_optimized),
+                    BlockDeviceMappings=[self.make_block_device(boot=True, mapping=ec2.LaunchTemplateBlockDeviceMapping,
+                                                                **self.NAT_ROOT_VOLUME)],
+                    NetworkInterfaces=[ec2.NetworkInterfaces(
+                        DeviceIndex=0,
+                        Groups=[Ref(self.nat_instance_sg)],
+                        # eth0 needs to reach the EC2 API before the ENI is attached
+                        AssociatePublicIpAddress=True,
+                        DeleteOnTermination=True,
+                    )],
+                    UserData=self.shared_fragment("NATLaunchTemplate%iUserData" % i,
+                                                  lambda: self.get_nat_asg_userdata(eni, "NATAutoScalingGroup%i" % i)),
+                ),
+            ))
+            self.template.add_resource(autoscaling.AutoScalingGroup(
+                "NATAutoScalingGroup%i" % i,
+                Condition="UseNatAutoScaling",
+                DependsOn="NATENIEIPAssociation%i" % i,
+                LaunchTemplate=autoscaling.LaunchTemplateSpecification(
+                    LaunchTemplateId=Ref(launch_template),
+                    Version=GetAtt(launch_template, "LatestVersionNumber"),
+                ),
+                MinSize="1",
+                MaxSize="1",
+                DesiredCapacity="1",
+                # Only gates the stack create on the first instance signalling,
+                # replacements launched later by the group are not waited for
+                CreationPolicy=self.get_nat_creation_policy(),
+                HealthCheckType="EC2",
+                VPCZoneIdentifier=[self.get_network_input(subnet)],
+                Tags=self.get_asg_tags(tags),
+            ))
+            self.nat_enis.append(eni)
+
+    def add_endpoints(self):
+        """ S3 (scoped to the bootstrap buckets) and DynamoDB endpoints so that
+            traffic from the routed subnets does not go through the NATs """
+        buckets = [Ref(self.instance_resources_bucket_name_param)] + [
+            Join("", [ prefix, ".", Ref("AWS::Region"), ".amazonaws.com" ])
+            for prefix in AMAZON_LINUX_REPO_BUCKET_PREFIXES
+        ]
+        route_tables = [self.get_network_input(self.private_route_table_1), self.get_network_input(self.private_route_table_2),
+                        self.get_network_input(self.ss_route_table_1), self.get_network_input(self.ss_route_table_2)]
+        for endpoint in self.add_gateway_endpoints(self.get_network_input(self.vpc_id), route_tables, buckets,
+                                                   condition="AddGatewayEndpoints"):
+            self.template.add_resource(endpoint)
 
     def add_nat_sg(self):
+        vpc_cidr = FindInMap("VPCMAPPING", FindInMap("REGIONNAMEMAPPINGS", Ref("AWS::Region"), "Name"),
+                             Ref(self.environment_type))
         self.nat_instance_sg = self.template.add_resource(ec2.SecurityGroup(
             "NATSG",
+            Condition="UseNatHosts",
             GroupDescription="Rules NAT instances. Also allows access to HA Nodes",
-            VpcId=Ref(self.vpc_id),
+            VpcId=self.get_network_input(self.vpc_id),
             SecurityGroupIngress=[
-              ec2.SecurityGroupRule( IpProtocol="tcp", FromPort="22", ToPort="22", CidrIp="10.0.0.0/8"),
-              ec2.SecurityGroupRule( IpProtocol="tcp", FromPort="53", ToPort="53", CidrIp=FindInMap("VPCMAPPING", 
-                                FindInMap("REGIONNAMEMAPPINGS", Ref("AWS::Region"), "Name"), Ref(self.environment_type))),
-              ec2.SecurityGroupRule( IpProtocol="udp", FromPort="53", ToPort="53", CidrIp=FindInMap("VPCMAPPING", 
-                                FindInMap("REGIONNAMEMAPPINGS", Ref("AWS::Region"), "Name"), Ref(self.environment_type))),
-              ec2.SecurityGroupRule( IpProtocol="tcp", FromPort="80", ToPort="80", CidrIp=FindInMap("VPCMAPPING", 
-                                FindInMap("REGIONNAMEMAPPINGS", Ref("AWS::Region"), "Name"), Ref(self.environment_type))),
-              ec2.SecurityGroupRule( IpProtocol="tcp", FromPort="443", ToPort="443", CidrIp=FindInMap("VPCMAPPING", 
-                                FindInMap("REGIONNAMEMAPPINGS", Ref("AWS::Region"), "Name"), Ref(self.environment_type))),
-              ec2.SecurityGroupRule( IpProtocol="icmp", FromPort="-1", ToPort="-1", CidrIp="10.0.0.0/8"),
-
+              ec2.SecurityGroupRule(IpProtocol=rule['prot'], FromPort=rule['fp'], ToPort=rule['tp'],
+                                    CidrIp=vpc_cidr if rule['cidr'] == 'vpc' else rule['cidr'])
+              for rule in self.NAT_SG_RULES
             ],
 
-            Tags=self.get_tags_as_list(0, '-bigdata-sg-natsg')
+            Tags=self.get_tags_as_list(self.NAT_AZ_INDEXES[0], '-bigdata-sg-natsg')
         ))
     
-        self.nat_ping_rule = self.template.add_resource(ec2.SecurityGroupIngress(
+        self.nat_ping_rule = self.template.add_resource(ir.Resource(
             "NATPingRule",
-            GroupId=Ref(self.nat_instance_sg),
-            SourceSecurityGroupId=Ref(self.nat_instance_sg),
+            "AWS::EC2::SecurityGroupIngress",
+            Condition="UseNatInstances",
+            GroupId=ir.ref(self.nat_instance_sg),
+            SourceSecurityGroupId=ir.ref(self.nat_instance_sg),
             IpProtocol="icmp", 
             FromPort="-1", 
             ToPort="-1", 
@@ -303,298 +469,406 @@ class NATStack(CloudformationAbstractBaseClass):
 
     def add_nat_instances(self):
 
-        self.eip_wait_handle_1 = self.template.add_resource(cf.WaitConditionHandle("EIPAttachmentHandle1"))
-        self.userdata_wait_handle_1 = self.template.add_resource(cf.WaitConditionHandle("UserdataCompletionHandle1"))
-
-        self.eip_wait_handle_2 = self.template.add_resource(cf.WaitConditionHandle("EIPAttachmentHandle2"))
-        self.userdata_wait_handle_2 = self.template.add_resource(cf.WaitConditionHandle("UserdataCompletionHandle2"))
+        tags1=self.get_tags_as_list(self.NAT_AZ_INDEXES[0], '-bigdata-mgmt-', Ref(self.nat_hostname_1))
 
-        tags1=self.get_tags_as_list(0, '-bigdata-mgmt-', Ref(self.nat_hostname_1))
-
-        tags2=self.get_tags_as_list(1, '-bigdata-mgmt-',Ref(self.nat_hostname_2))
+        tags2=self.get_tags_as_list(self.NAT_AZ_INDEXES[1], '-bigdata-mgmt-',Ref(self.nat_hostname_2))
 
         self.nat_instance_1 = self.template.add_resource(ec2.Instance(
             "NATInstance1",
-            IamInstanceProfile=Ref(self.nat_instance_profile),
+            Condition="UseNatInstances",
+            IamInstanceProfile=self.nat_instance_profile,
             InstanceType=Ref(self.nat_size),
             KeyName=Ref(self.keyname_param),
-            SubnetId=Ref(self.mgmt_subnet_1),
+            SubnetId=self.get_network_input(self.mgmt_subnet_1),
             ImageId=Ref(self.ec2_instance_ami),  #FindInMap("NATAMIMAPPING", Ref("AWS::Region"), "AMI"),
             SecurityGroupIds=[Ref(self.nat_instance_sg)],
             SourceDestCheck="false",
+            EbsOptimized=Ref(self.nat_ebs_optimized),
+            BlockDeviceMappings=[self.make_block_device(boot=True, **self.NAT_ROOT_VOLUME)],
             Tags=tags1,
             #DependsOn=self.vpcgw.name,
-            # We need to wait for NAT to become available, we assume that
-            # if userdata is executing then we are good to go, so cfn-signal back
-            # * * * * * * * * * * * * * * * * * *
-            # PS Make sure other instances that require nat use DependsOn=WaitCondition, not
-            # the nat itself as this takes some time to spin up
-            # * * * * * * * * * * * * * * * * * *
-            UserData=Base64(Join("", [
-"#!/bin/bash -x\n", 
-"exec > >(tee /var/log/user_data_run.log)\n", 
-"exec 2>&1\n", 
-"date\n", 
-"ping -c 5 www.google.com > /var/log/ping-test.log\n", 
-"##### Install cfn-init to interpret and act upon the metadata\n", 
-"##### Ubuntu does not have this be default\n", 
-
-"yum update -y aws*\n", 
-". /etc/profile.d/aws-apitools-common.sh\n", 
-"CFN=aws-cfn-bootstrap-latest\n", 
-"wget -P /root https://s3.amazonaws.com/cloudformation-examples/${CFN}.tar.gz\n", 
-"mkdir -p /root/${CFN}\n", 
-"tar xvfz /root/${CFN}.tar.gz --strip-components=1 -C /root/${CFN}\n", 
-"easy_install /root/${CFN}/","\n", 
-"easy_install awscli\n", 
-"/opt/aws/bin/cfn-signal -e 0 -r 'EIP is attached' '",Ref(self.eip_wait_handle_1),"' > /var/log/cfn-signal.log\n",
-
-"##### change the hostname to something more identifible\n", 
-"INSTANCEID=$(curl http://169.254.169.254//latest/meta-data/instance-id )\n", 
-"INSTANCEIP=$(curl http://169.254.169.254//latest/meta-data/local-ipv4 )\n", 
-"INSTANCEPUBLICIP=$(curl http://169.254.169.254//latest/meta-data/public-ipv4 )\n",
-
-"NEWHOSTNAME=",Ref(self.nat_hostname_1),".timeinc.com\n",
-
-"echo $NEWHOSTNAME > /etc/hostname\n", 
-"sed -i '1i 127.0.0.1 '$NEWHOSTNAME /etc/hosts\n", 
-"hostname -F /etc/hostname\n", 
-
-"/opt/aws/bin/cfn-signal -e 0 -r 'NAT instance is ready for bootstrapping' '",Ref(self.userdata_wait_handle_1),"' > /var/log/cfn-signal.log\n",
-
-"# Configure iptables\n", 
-"/sbin/iptables -t nat -A POSTROUTING -o eth0 -s 0.0.0.0/0 -j MASQUERADE\n", 
-"/sbin/iptables-save > /etc/sysconfig/iptables\n", 
-"# Configure ip forwarding and redirects\n", 
-"echo 1 >  /proc/sys/net/ipv4/ip_forward && echo 0 >  /proc/sys/net/ipv4/conf/eth0/send_redirects\n", 
-"mkdir -p /etc/sysctl.d/\n", 
-"cat <<EOF > /etc/sysctl.d/nat.conf\n", 
-"net.ipv4.ip_forward = 1\n", 
-"net.ipv4.conf.eth0.send_redirects = 0\n", 
-"EOF\n",
-
-"aws s3 cp s3://",Ref(self.instance_resources_bucket_name_param), "/nat_monitor.sh /root/nat_monitor.sh\n", 
-"sed -i.bak 's/$4/$5/g' /root/nat_monitor.sh\n",
-
-"# Wait for NAT #2 to boot up and update PrivateRouteTable2\n",
-"sleep 180\n",
-"NAT_ID=\n",
-"# CloudFormation should have updated the PrivateRouteTable2 by now (due to yum update), however loop to make sure\n",
-"while [ \"$NAT_ID\" == \"\" ]; do\n",
-"  sleep 60\n",
-"  NAT_ID=`/opt/aws/bin/ec2-describe-route-tables ",Ref(self.private_route_table_2), 
-" -U https://ec2.",Ref("AWS::Region"), ".amazonaws.com | grep 0.0.0.0/0 | awk '{print $2;}'`\n",
-"  #echo `date` \"-- NAT_ID=$NAT_ID\" >> /tmp/test.log\n",
-"done\n",
-"# Update NAT_ID, NAT_RT_ID, and My_RT_ID\n", 
-
-# ToDo - Change line below to "sed -i.bak \"s/NAT_ID=/NAT_ID=",{ "Ref" : "NATInstances1" },"/g\" /root/nat_monitor.sh\n",
-"sed -i.bak \"s/NAT_ID=/NAT_ID=$NAT_ID/g\" /root/nat_monitor.sh\n",
-"sed -i.bak \"s/NAT_RT_ID1=/NAT_RT_ID1=",Ref(self.private_route_table_2),"/g\" /root/nat_monitor.sh\n",
-
-# "sed -i.bak\"s/NAT_ID=/NAT_ID=$NAT_ID/g\" /root/nat_monitor.sh > /root/nat_monitor.tmp\n",
-# Set up the relative route tables for each NAT
-
-"sed -i.bak \"s/NAT_RT_ID2=/NAT_RT_ID2=",Ref(self.ss_route_table_2),"/g\" /root/nat_monitor.sh\n",
-
-"sed -i.bak \"s/My_RT_ID1=/My_RT_ID1=",Ref(self.private_route_table_1),"/g\" /root/nat_monitor.sh\n",
-
-"sed \"s/My_RT_ID2=/My_RT_ID2=",Ref(self.ss_route_table_1),"/g\" /root/nat_monitor.sh > /root/nat_monitor.tmp\n",
-
-
-"sed \"s/EC2_URL=/EC2_URL=https:\\/\\/ec2.",Ref("AWS::Region"), ".amazonaws.com","/g\" /root/nat_monitor.tmp > /root/nat_monitor.sh\n",
-
-"sed \"s/Num_Pings=3/Num_Pings=",Ref(self.ping_number),"/g\" /root/nat_monitor.sh > /root/nat_monitor.tmp\n",
-
-"sed \"s/Ping_Timeout=1/Ping_Timeout=",Ref(self.ping_timeout),"/g\" /root/nat_monitor.tmp > /root/nat_monitor.sh\n",
-
-"sed \"s/Wait_Between_Pings=2/Wait_Between_Pings=",Ref(self.time_between_pings),"/g\" /root/nat_monitor.sh > /root/nat_monitor.tmp\n",
-
-"sed \"s/Wait_for_Instance_Stop=60/Wait_for_Instance_Stop=",Ref(self.time_for_instance_stop),"/g\" /root/nat_monitor.tmp > /root/nat_monitor.sh\n",
-
-"sed \"s/Wait_for_Instance_Start=300/Wait_for_Instance_Start=",Ref(self.time_for_instance_start),"/g\" /root/nat_monitor.sh > /root/nat_monitor.tmp\n",
-
-"mv /root/nat_monitor.tmp /root/nat_monitor.sh\n",
-"chmod a+x /root/nat_monitor.sh\n",
-"echo '@reboot /root/nat_monitor.sh > /var/log/nat_monitor.log' | crontab\n",
-"/root/nat_monitor.sh > /var/log/nat_monitor.log &\n",
-
-"exit 0\n"
-            ]))
+            # Creation only completes once user data signals that the NAT is
+            # forwarding, so other stacks can simply DependsOn the instance
+            CreationPolicy=self.get_nat_creation_policy(),
+            Metadata=self.shared_fragment("NATInstance1Metadata", lambda: self.get_nat_metadata("NATInstance1")),
+            UserData=self.shared_fragment("NATInstance1UserData", lambda: self.get_nat_instance_userdata(1)),
         ))
 
         self.nat_instance_2 = self.template.add_resource(ec2.Instance(
             "NATInstance2",
-            IamInstanceProfile=Ref(self.nat_instance_profile),
+            Condition="UseNatInstances",
+            IamInstanceProfile=self.nat_instance_profile,
             InstanceType=Ref(self.nat_size),
             KeyName=Ref(self.keyname_param),
-            SubnetId=Ref(self.mgmt_subnet_2),
+            SubnetId=self.get_network_input(self.mgmt_subnet_2),
             ImageId=Ref(self.ec2_instance_ami), #FindInMap("NATAMIMAPPING", Ref("AWS::Region"), "AMI"),
             SecurityGroupIds=[Ref(self.nat_instance_sg)],
             SourceDestCheck="false",
+            EbsOptimized=Ref(self.nat_ebs_optimized),
+            BlockDeviceMappings=[self.make_block_device(boot=True, **self.NAT_ROOT_VOLUME)],
             Tags=tags2,
             #DependsOn=self.vpcgw.name,
-            # We need to wait for NAT to become available, we assume that
-            # if userdata is executing then we are good to go, so cfn-signal back
-            # * * * * * * * * * * * * * * * * * *
-            # PS Make sure other instances that require nat use DependsOn=WaitCondition, not
-            # the nat itself as this takes some time to spin up
-            # * * * * * * * * * * * * * * * * * *
-            UserData=Base64(Join("", [
-"#!/bin/bash -x\n", 
-"exec > >(tee /var/log/user_data_run.log)\n", 
-"exec 2>&1\n", 
-"date\n", 
-"ping -c 5 www.google.com > /var/log/ping-test.log\n", 
-"##### Install cfn-init to interpret and act upon the metadata\n", 
-"##### Ubuntu does not have this be default\n", 
-
-"yum update -y aws*\n", 
-". /etc/profile.d/aws-apitools-common.sh\n", 
-"CFN=aws-cfn-bootstrap-latest\n", 
-"wget -P /root https://s3.amazonaws.com/cloudformation-examples/${CFN}.tar.gz\n", 
-"mkdir -p /root/${CFN}\n", 
-"tar xvfz /root/${CFN}.tar.gz --strip-components=1 -C /root/${CFN}\n", 
-"easy_install /root/${CFN}/","\n", 
-"easy_install awscli\n", 
-"/opt/aws/bin/cfn-signal -e 0 -r 'EIP is attached' '",Ref(self.eip_wait_handle_2),"' > /var/log/cfn-signal.log\n",
-
-"##### change the hostname to something more identifible\n", 
-"INSTANCEID=$(curl http://169.254.169.254//latest/meta-data/instance-id )\n", 
-"INSTANCEIP=$(curl http://169.254.169.254//latest/meta-data/local-ipv4 )\n", 
-"INSTANCEPUBLICIP=$(curl http://169.254.169.254//latest/meta-data/public-ipv4 )\n",
-
-"NEWHOSTNAME=",Ref(self.nat_hostname_2),".timeinc.com\n",
-
-"echo $NEWHOSTNAME > /etc/hostname\n", 
-"sed -i '1i 127.0.0.1 '$NEWHOSTNAME /etc/hosts\n", 
-"hostname -F /etc/hostname\n", 
-
-"/opt/aws/bin/cfn-signal -e 0 -r 'NAT instance is ready for bootstrapping' '",Ref(self.userdata_wait_handle_2),"' > /var/log/cfn-signal.log\n",
-
-"# Configure iptables\n", 
-"/sbin/iptables -t nat -A POSTROUTING -o eth0 -s 0.0.0.0/0 -j MASQUERADE\n", 
-"/sbin/iptables-save > /etc/sysconfig/iptables\n", 
-"# Configure ip forwarding and redirects\n", 
-"echo 1 >  /proc/sys/net/ipv4/ip_forward && echo 0 >  /proc/sys/net/ipv4/conf/eth0/send_redirects\n", 
-"mkdir -p /etc/sysctl.d/\n", 
-"cat <<EOF > /etc/sysctl.d/nat.conf\n", 
-"net.ipv4.ip_forward = 1\n", 
-"net.ipv4.conf.eth0.send_redirects = 0\n", 
+            # Creation only completes once user data signals that the NAT is
+            # forwarding, so other stacks can simply DependsOn the instance
+            CreationPolicy=self.get_nat_creation_policy(),
+            Metadata=self.shared_fragment("NATInstance2Metadata", lambda: self.get_nat_metadata("NATInstance2")),
+            UserData=self.shared_fragment("NATInstance2UserData", lambda: self.get_nat_instance_userdata(2)),
+        ))
+
+    def get_nat_creation_policy(self):
+        """ One signal per NAT, sent by its user data once it forwards traffic """
+        return CreationPolicy(ResourceSignal=ResourceSignal(Count=1, Timeout=Ref(self.nat_signal_timeout)))
+
+    def get_nat_metadata(self, resource_name):
+        """ cfn-init metadata holding the nat_monitor.sh health check tuning,
+            the nat_stats_exporter.sh settings and the boot timeline settings.
+            Changing those parameters only updates the metadata, cfn-hup then
+            rewrites the .conf files and restarts both scripts in place instead
+            of the instance being replaced for new UserData """
+        return self.make_cfn_hup_metadata(resource_name, {
+            "files": {
+                "/etc/nat_monitor.conf": {
+                    "content": Join("", [
+                        "Num_Pings=", Ref(self.ping_number), "\n",
+                        "Ping_Timeout=", Ref(self.ping_timeout), "\n",
+                        "Wait_Between_Pings=", Ref(self.time_between_pings), "\n",
+                        "Wait_for_Instance_Stop=", Ref(self.time_for_instance_stop), "\n",
+                        "Wait_for_Instance_Start=", Ref(self.time_for_instance_start), "\n",
+                    ]),
+                    "mode": "000644",
+                    "owner": "root",
+                    "group": "root",
+                },
+                "/etc/nat_stats_exporter.conf": {
+                    "content": Join("", merge(self.get_nat_stats_config(resource_name, "eth0"))),
+                    "mode": "000644",
+                    "owner": "root",
+                    "group": "root",
+                },
+                "/etc/nat_boot.conf": {
+                    "content": Join("", self.get_nat_boot_config()),
+                    "mode": "000644",
+                    "owner": "root",
+                    "group": "root",
+                },
+                "/root/restart_nat_monitor.sh": {
+                    "content": Join("", [
+                        "#!/bin/bash\n",
+                        "# Only once user data has finished configuring the monitor\n",
+                        "[ -f /root/nat_monitor.configured ] || exit 0\n",
+                        "pkill -f /root/nat_monitor.sh\n",
+                        "nohup /root/nat_monitor.sh > /var/log/nat_monitor.log 2>&1 < /dev/null &\n",
+                        "[ -x /root/nat_stats_exporter.sh ] || exit 0\n",
+                        "pkill -f /root/nat_stats_exporter.sh\n",
+                        "nohup /root/nat_stats_exporter.sh > /var/log/nat_stats_exporter.log 2>&1 < /dev/null &\n",
+                    ]),
+                    "mode": "000755",
+                    "owner": "root",
+                    "group": "root",
+                },
+            },
+        }, hook_action="/root/restart_nat_monitor.sh")
+
+    def get_nat_stats_config(self, resource_name, interface):
+        """ /etc/nat_stats_exporter.conf, see nat_stats_exporter.sh """
+        return [
+            "Interval=", Ref(self.nat_stats_interval), "\n",
+            "Push_Metrics=", Ref(self.nat_stats_metrics), "\n",
+            "Namespace=", NAT_FLOW_METRICS_NAMESPACE, "\n",
+            "Interface=", interface, "\n",
+            "Resource=", resource_name, "\n",
+            "Region=", Ref("AWS::Region"), "\n",
+        ]
+
+    def get_nat_boot_config(self):
+        """ /etc/nat_boot.conf, read by boot_timeline """
+        return ["Boot_Metrics=", Ref(self.boot_metrics), "\n"]
+
+    def get_nat_script_sections(self):
+        """ The sections every NAT script is composed from, see userdata.py.
+            'phase' (defined by the bootstrap section) logs the seconds since
+            boot for each named phase to /var/log/nat-bootstrap-timing.log """
+        return dict((s.name, s) for s in [
+Section("header", [
+"#!/bin/bash -x\n",
+"exec > >(tee /var/log/user_data_run.log)\n",
+"exec 2>&1\n",
+]),
+Section("failure-signal", [
+"##### Any exit with an error before the signal section fails the CreationPolicy right away\n",
+"SIGNALLED=\n",
+"signal_failure() {\n",
+"  CODE=$?\n",
+"  if [ $CODE -ne 0 ] && [ -z \"$SIGNALLED\" ]; then\n",
+"    ",Slot("cfn_signal_failure")," > /var/log/cfn-signal.log 2>&1\n",
+"  fi\n",
+"}\n",
+"trap signal_failure EXIT\n",
+]),
+Section("settings", [
+"##### NAT instances get these from cfn-init, auto scaled NATs have no metadata\n",
+"cat <<EOF > /etc/nat_stats_exporter.conf\n",
+Slot("stats_config"),
 "EOF\n",
-
-"aws s3 cp s3://",Ref(self.instance_resources_bucket_name_param), "/nat_monitor.sh /root/nat_monitor.sh\n", 
+"cat <<EOF > /etc/nat_boot.conf\n",
+Slot("boot_config"),
+"EOF\n",
+]),
+Section("bootstrap", [
+"date\n",
+"BOOT_START=$(date +%s)\n",
+"LAST_PHASE=$BOOT_START\n",
+"PHASES=()\n",
+"phase() {\n",
+"  NOW=$(date +%s)\n",
+"  echo \"$NOW +$(( NOW - BOOT_START ))s $1\" | tee -a /var/log/nat-bootstrap-timing.log\n",
+"  PHASES+=(\"{\\\"phase\\\": \\\"$1\\\", \\\"at\\\": $NOW, \\\"elapsed\\\": $(( NOW - BOOT_START )), \\\"duration\\\": $(( NOW - LAST_PHASE ))}\")\n",
+"  LAST_PHASE=$NOW\n",
+"}\n",
+"##### Writes the phases as one JSON document and optionally publishes each\n",
+"##### phase duration plus the total as CloudWatch metrics\n",
+"boot_timeline() {\n",
+"  local IFS=,\n",
+"  echo \"{\\\"stack\\\": \\\"",Ref("AWS::StackName"),"\\\", \\\"resource\\\": \\\"$1\\\", \\\"start\\\": $BOOT_START, \\\"phases\\\": [${PHASES[*]}]}\" > /var/log/nat-boot-timeline.json\n",
+"  local Boot_Metrics=false\n",
+"  [ -f /etc/nat_boot.conf ] && . /etc/nat_boot.conf\n",
+"  [ \"$Boot_Metrics\" = \"true\" ] || return 0\n",
+"  METRICS=\"\"\n",
+"  for P in \"${PHASES[@]}\"; do\n",
+"    NAME=$(echo \"$P\" | sed 's/.*\"phase\": \"\\([^\"]*\\)\".*/\\1/')\n",
+"    VALUE=$(echo \"$P\" | sed 's/.*\"duration\": \\([0-9]*\\).*/\\1/')\n",
+"    METRICS=\"$METRICS{\\\"MetricName\\\": \\\"PhaseDuration\\\", \\\"Unit\\\": \\\"Seconds\\\", \\\"Value\\\": $VALUE, \\\"Dimensions\\\": [{\\\"Name\\\": \\\"Resource\\\", \\\"Value\\\": \\\"$1\\\"}, {\\\"Name\\\": \\\"Phase\\\", \\\"Value\\\": \\\"$NAME\\\"}]},\"\n",
+"  done\n",
+"  METRICS=\"$METRICS{\\\"MetricName\\\": \\\"BootDuration\\\", \\\"Unit\\\": \\\"Seconds\\\", \\\"Value\\\": $(( $(date +%s) - BOOT_START )), \\\"Dimensions\\\": [{\\\"Name\\\": \\\"Resource\\\", \\\"Value\\\": \\\"$1\\\"}]}\"\n",
+"  aws cloudwatch put-metric-data --region ",Ref("AWS::Region")," --namespace ",NAT_BOOT_METRICS_NAMESPACE," --metric-data \"[$METRICS]\"\n",
+"}\n",
+"BOOTSTRAP_MODE=",Ref(self.bootstrap_mode),"\n",
+"BUNDLE_VERSION=",Ref(self.bootstrap_bundle_version),"\n",
+"BUNDLE_DIR=/opt/nat-bootstrap\n",
+"case $BOOTSTRAP_MODE in\n",
+"install)\n",
+"ping -c 5 www.google.com > /var/log/ping-test.log\n",
+"##### Install cfn-init to interpret and act upon the metadata\n",
+"##### Ubuntu does not have this be default\n",
+"yum update -y aws*\n",
+"phase yum-update\n",
+"CFN=aws-cfn-bootstrap-latest\n",
+"wget -P /root https://s3.amazonaws.com/cloudformation-examples/${CFN}.tar.gz\n",
+"mkdir -p /root/${CFN}\n",
+"tar xvfz /root/${CFN}.tar.gz --strip-components=1 -C /root/${CFN}\n",
+"easy_install /root/${CFN}/\n",
+"easy_install awscli\n",
+"phase cfn-bootstrap\n",
+";;\n",
+"bundle)\n",
+"##### One versioned artifact with the tooling and nat_monitor.sh, only fetched when the version differs\n",
+"if [ \"$(cat $BUNDLE_DIR/VERSION 2>/dev/null)\" != \"$BUNDLE_VERSION\" ]; then\n",
+"aws s3 cp s3://",Ref(self.instance_resources_bucket_name_param),"/nat-bootstrap-${BUNDLE_VERSION}.tar.gz /root/nat-bootstrap.tar.gz\n",
+"rm -rf $BUNDLE_DIR && mkdir -p $BUNDLE_DIR\n",
+"tar xzf /root/nat-bootstrap.tar.gz -C $BUNDLE_DIR\n",
+"$BUNDLE_DIR/install.sh\n",
+"fi\n",
+"phase bundle\n",
+";;\n",
+"esac\n",
+"##### prebaked: the AMI (EC2InstanceAmi) already has the tooling and $BUNDLE_DIR/nat_monitor.sh\n",
+". /etc/profile.d/aws-apitools-common.sh\n",
+]),
+Section("cfn-init", [Slot("cfn_init"), " || exit 1\n",
+"phase cfn-init\n",
+]),
+Section("hostname", [
+"##### change the hostname to something more identifible\n",
+"INSTANCEID=$(curl http://169.254.169.254//latest/meta-data/instance-id )\n",
+"INSTANCEIP=$(curl http://169.254.169.254//latest/meta-data/local-ipv4 )\n",
+"INSTANCEPUBLICIP=$(curl http://169.254.169.254//latest/meta-data/public-ipv4 )\n",
+"NEWHOSTNAME=",Slot("hostname"),".timeinc.com\n",
+"echo $NEWHOSTNAME > /etc/hostname\n",
+"sed -i '1i 127.0.0.1 '$NEWHOSTNAME /etc/hosts\n",
+"hostname -F /etc/hostname\n",
+"phase hostname\n",
+]),
+Section("eni-attach", [
+"INSTANCEID=$(curl -s http://169.254.169.254/latest/meta-data/instance-id)\n",
+"ENI=",Slot("eni"),"\n",
+"REGION=",Ref("AWS::Region"),"\n",
+"##### Take over the floating ENI. A terminating predecessor may still hold it, so retry\n",
+"until aws ec2 attach-network-interface --region $REGION --instance-id $INSTANCEID",
+" --network-interface-id $ENI --device-index 1; do\n",
+"  sleep 5\n",
+"done\n",
+"while ! ip link show eth1 > /dev/null 2>&1; do sleep 1; done\n",
+"until ip -4 addr show eth1 | grep -q inet; do sleep 1; done\n",
+"phase eni-attach\n",
+"# Egress leaves through the ENI that holds the EIP\n",
+"GATEWAY=$(ip route show default | awk '/default/ {print $3; exit}')\n",
+"ip route replace default via $GATEWAY dev eth1\n",
+]),
+Section("iptables", [
+"# Configure iptables\n",
+"/sbin/iptables -t nat -A POSTROUTING -o ",Slot("interface")," -s 0.0.0.0/0 -j MASQUERADE\n",
+"/sbin/iptables-save > /etc/sysconfig/iptables\n",
+"# Configure ip forwarding and redirects\n",
+"echo 1 >  /proc/sys/net/ipv4/ip_forward\n",
+"mkdir -p /etc/sysctl.d/\n",
+"echo 'net.ipv4.ip_forward = 1' > /etc/sysctl.d/nat.conf\n",
+"for IF in ",Slot("redirect_interfaces"),"; do\n",
+"  echo 0 >  /proc/sys/net/ipv4/conf/$IF/send_redirects\n",
+"  echo \"net.ipv4.conf.$IF.send_redirects = 0\" >> /etc/sysctl.d/nat.conf\n",
+"done\n",
+"phase iptables\n",
+]),
+Section("signal", ["SIGNALLED=1\n", Slot("cfn_signal"), " > /var/log/cfn-signal.log\n",
+"phase signal\n",
+]),
+Section("monitor-download", [
+"if [ -f $BUNDLE_DIR/nat_monitor.sh ]; then cp $BUNDLE_DIR/nat_monitor.sh /root/nat_monitor.sh; else\n",
+"aws s3 cp s3://",Ref(self.instance_resources_bucket_name_param), "/nat_monitor.sh /root/nat_monitor.sh; fi\n",
+"phase monitor-download\n",
 "sed -i.bak 's/$4/$5/g' /root/nat_monitor.sh\n",
-
+]),
+Section("peer-discovery", [
+"# Wait for the peer NAT to boot up and update its private route table\n",
+"sleep 180\n",
+"NAT_ID=\n",
+"# CloudFormation should have updated the route table by now (due to yum update), however loop to make sure\n",
+"while [ \"$NAT_ID\" == \"\" ]; do\n",
+"  sleep 60\n",
+"  NAT_ID=`/opt/aws/bin/ec2-describe-route-tables ",Slot("peer_private_rt"),
+" -U https://ec2.",Ref("AWS::Region"), ".amazonaws.com | grep 0.0.0.0/0 | awk '{print $2;}'`\n",
+"done\n",
+"phase peer-discovery\n",
+]),
+Section("monitor-config", [
 "# Update NAT_ID, NAT_RT_ID, and My_RT_ID\n",
-"sed -i.bak \"s/NAT_ID=/NAT_ID=",Ref(self.nat_instance_1),"/g\" /root/nat_monitor.sh\n",
-# "sed -i.bak\"s/NAT_ID=/NAT_ID=",Ref(self.nat_instance_1),"/g\" /root/nat_monitor.sh > /root/nat_monitor.tmp\n",
-
-# Set up the relative route tables for each NAT
-"sed -i.bak \"s/NAT_RT_ID1=/NAT_RT_ID1=",Ref(self.private_route_table_1),"/g\" /root/nat_monitor.sh\n",
-# "sed -i.bak \"s/NAT_RT_ID1=/NAT_RT_ID1=",Ref(self.private_route_table_1), "/g\" /root/nat_monitor.sh\n",
-
-"sed -i.bak \"s/NAT_RT_ID2=/NAT_RT_ID2=",Ref(self.ss_route_table_1),"/g\" /root/nat_monitor.sh\n",
-
-"sed -i.bak \"s/My_RT_ID1=/My_RT_ID1=",Ref(self.private_route_table_2),"/g\" /root/nat_monitor.sh\n",
-
-"sed \"s/My_RT_ID2=/My_RT_ID2=",Ref(self.ss_route_table_2),"/g\" /root/nat_monitor.sh > /root/nat_monitor.tmp\n",
-
-
+"sed -i.bak \"s/NAT_ID=/NAT_ID=$NAT_ID/g\" /root/nat_monitor.sh\n",
+"# Set up the relative route tables for each NAT\n",
+"sed -i.bak \"s/NAT_RT_ID1=/NAT_RT_ID1=",Slot("peer_private_rt"),"/g\" /root/nat_monitor.sh\n",
+"sed -i.bak \"s/NAT_RT_ID2=/NAT_RT_ID2=",Slot("peer_ss_rt"),"/g\" /root/nat_monitor.sh\n",
+"sed -i.bak \"s/My_RT_ID1=/My_RT_ID1=",Slot("private_rt"),"/g\" /root/nat_monitor.sh\n",
+"sed \"s/My_RT_ID2=/My_RT_ID2=",Slot("ss_rt"),"/g\" /root/nat_monitor.sh > /root/nat_monitor.tmp\n",
 "sed \"s/EC2_URL=/EC2_URL=https:\\/\\/ec2.",Ref("AWS::Region"), ".amazonaws.com","/g\" /root/nat_monitor.tmp > /root/nat_monitor.sh\n",
-
-"sed \"s/Num_Pings=3/Num_Pings=",Ref(self.ping_number),"/g\" /root/nat_monitor.sh > /root/nat_monitor.tmp\n",
-
-"sed \"s/Ping_Timeout=1/Ping_Timeout=",Ref(self.ping_timeout),"/g\" /root/nat_monitor.tmp > /root/nat_monitor.sh\n",
-
-"sed \"s/Wait_Between_Pings=2/Wait_Between_Pings=",Ref(self.time_between_pings),"/g\" /root/nat_monitor.sh > /root/nat_monitor.tmp\n",
-
-"sed \"s/Wait_for_Instance_Stop=60/Wait_for_Instance_Stop=",Ref(self.time_for_instance_stop),"/g\" /root/nat_monitor.tmp > /root/nat_monitor.sh\n",
-
-"sed \"s/Wait_for_Instance_Start=300/Wait_for_Instance_Start=",Ref(self.time_for_instance_start),"/g\" /root/nat_monitor.sh > /root/nat_monitor.tmp\n",
-
-"mv /root/nat_monitor.tmp /root/nat_monitor.sh\n",
+"# Health check tuning comes from /etc/nat_monitor.conf (cfn-init metadata), read after the defaults\n",
+"sed -i '/^Wait_for_Instance_Start=/a . /etc/nat_monitor.conf' /root/nat_monitor.sh\n",
+]),
+Section("monitor-start", [
 "chmod a+x /root/nat_monitor.sh\n",
 "echo '@reboot /root/nat_monitor.sh > /var/log/nat_monitor.log' | crontab\n",
 "/root/nat_monitor.sh > /var/log/nat_monitor.log &\n",
-
-"exit 0\n"
-            ]))
-        ))
-
-        self.eip_waitcondition_1 = self.template.add_resource(cf.WaitCondition(
-                "EipAttachmentCondition1",
-                DependsOn=self.nat_instance_1.name,
-                Handle=Ref(self.eip_wait_handle_1),
-                Timeout="1000"
-            ))
-        self.eip_waitcondition_2 = self.template.add_resource(cf.WaitCondition(
-                "EipAttachmentCondition2",
-                DependsOn=self.nat_instance_2.name,
-                Handle=Ref(self.eip_wait_handle_2),
-                Timeout="1000"
-            ))
-        self.userdata_waitcondition_1 = self.template.add_resource(cf.WaitCondition(
-            "UserDataCompletionCondition1",
-            DependsOn=self.nat_instance_1.name,
-            Handle=Ref(self.userdata_wait_handle_1),
-            Timeout="1000"
-        ))
-        self.userdata_waitcondition_2 = self.template.add_resource(cf.WaitCondition(
-            "UserDataCompletionCondition2",
-            DependsOn=self.nat_instance_2.name,
-            Handle=Ref(self.userdata_wait_handle_2),
-            Timeout="1000"
-        ))
+"phase monitor-start\n",
+"touch /root/nat_monitor.configured\n",
+]),
+Section("stats-exporter", [
+"##### Flow statistics, the settings are in /etc/nat_stats_exporter.conf\n",
+"if [ -f $BUNDLE_DIR/nat_stats_exporter.sh ]; then cp $BUNDLE_DIR/nat_stats_exporter.sh /root/nat_stats_exporter.sh; else\n",
+"aws s3 cp s3://",Ref(self.instance_resources_bucket_name_param), "/nat_stats_exporter.sh /root/nat_stats_exporter.sh; fi\n",
+"chmod a+x /root/nat_stats_exporter.sh\n",
+"(crontab -l 2>/dev/null; echo '@reboot /root/nat_stats_exporter.sh > /var/log/nat_stats_exporter.log 2>&1') | crontab\n",
+"nohup /root/nat_stats_exporter.sh > /var/log/nat_stats_exporter.log 2>&1 < /dev/null &\n",
+"phase stats-exporter\n",
+]),
+Section("finish", [
+"boot_timeline ",Slot("resource"),"\n",
+"exit 0\n",
+]),
+        ])
+
+    def get_nat_instance_script(self):
+        sections = self.get_nat_script_sections()
+        return Script([sections[name] for name in (
+            "header", "failure-signal", "bootstrap", "cfn-init", "hostname", "iptables", "signal",
+            "monitor-download", "peer-discovery", "monitor-config", "monitor-start", "stats-exporter", "finish",
+        )])
+
+    def get_nat_asg_script(self):
+        sections = self.get_nat_script_sections()
+        return Script([sections[name] for name in (
+            "header", "failure-signal", "settings", "bootstrap", "eni-attach", "iptables", "signal",
+            "stats-exporter", "finish",
+        )])
+
+    def get_nat_asg_userdata(self, eni, group_name):
+        return self.get_nat_asg_script().render(
+            eni=Ref(eni),
+            interface="eth1",
+            redirect_interfaces="eth0 eth1",
+            stats_config=self.get_nat_stats_config(group_name, "eth1"),
+            boot_config=self.get_nat_boot_config(),
+            resource=group_name,
+            cfn_signal=self.get_cfn_signal_command(group_name),
+            cfn_signal_failure=self.get_cfn_signal_command(group_name, exit_code="1"),
+        )
+
+    def get_nat_instance_userdata(self, index):
+        """ User data of NATInstance1 or 2, both rendered from the same script.
+            Only refers to logical names, so the result is the same for every
+            stack of the class and is cached as a shared fragment """
+        me, peer = index - 1, 2 - index
+        private = [self.private_route_table_1, self.private_route_table_2]
+        ss = [self.ss_route_table_1, self.ss_route_table_2]
+        resource = "NATInstance%i" % index
+        script = self.get_nat_instance_script()
+        if index == 2:
+            # NATInstance2 Refs NATInstance1, so it is only created once NAT #1
+            # has signalled; NAT #1 signals before waiting for NAT #2 (PrivateRoute2
+            # needs NATInstance2) and NAT #2 knows its peer without waiting
+            script = script.move("signal", after="monitor-start").replace("peer-discovery", Section(
+                "peer-discovery", ["NAT_ID=", Ref(self.nat_instance_1), "\n"]))
+        return script.render(
+            resource=resource,
+            hostname=Ref([self.nat_hostname_1, self.nat_hostname_2][me]),
+            interface="eth0",
+            redirect_interfaces="eth0",
+            cfn_init=self.get_cfn_init_command(resource),
+            cfn_signal=self.get_cfn_signal_command(resource),
+            cfn_signal_failure=self.get_cfn_signal_command(resource, exit_code="1"),
+            private_rt=self.get_network_input(private[me]),
+            ss_rt=self.get_network_input(ss[me]),
+            peer_private_rt=self.get_network_input(private[peer]),
+            peer_ss_rt=self.get_network_input(ss[peer]),
+        )
 
     def add_routes(self):
-        self.private_route_1 = self.template.add_resource(ec2.Route(
-            "PrivateRoute1",
-            RouteTableId = Ref(self.private_route_table_1),
-            DestinationCidrBlock= "0.0.0.0/0",
-            InstanceId=Ref(self.nat_instance_1)
-        ))
-        self.private_route_2 = self.template.add_resource(ec2.Route(
-            "PrivateRoute2",
-            RouteTableId = Ref(self.private_route_table_2),
-            DestinationCidrBlock= "0.0.0.0/0",
-            InstanceId=Ref(self.nat_instance_2)
-        ))
-        self.ss_route_1 = self.template.add_resource(ec2.Route(
-            "SSRoute1",
-            RouteTableId = Ref(self.ss_route_table_1),
-            DestinationCidrBlock= "0.0.0.0/0",
-            InstanceId=Ref(self.nat_instance_1)
-        ))
-        self.ss_route_2 = self.template.add_resource(ec2.Route(
-            "SSRoute2",
-            RouteTableId = Ref(self.ss_route_table_2),
-            DestinationCidrBlock= "0.0.0.0/0",
-            InstanceId=Ref(self.nat_instance_2)
-        ))
+        nat_instances = [self.nat_instance_1, self.nat_instance_2]
+        self.routes = {}
+        for title, route_table, nat in self.NAT_ROUTES:
+            # Only one of the targets is set, depending on NatEngine
+            self.routes[title] = self.template.add_resource(ir.Resource(
+                title,
+                "AWS::EC2::Route",
+                RouteTableId = self.get_network_input(route_table),
+                DestinationCidrBlock= "0.0.0.0/0",
+                InstanceId=ir.fn_if("UseNatInstances", ir.ref(nat_instances[nat - 1]), ir.ref("AWS::NoValue")),
+                NatGatewayId=ir.fn_if("UseNatGateway", ir.ref(self.nat_gateways[nat - 1]), ir.ref("AWS::NoValue")),
+                NetworkInterfaceId=ir.fn_if("UseNatAutoScaling", ir.ref(self.nat_enis[nat - 1]), ir.ref("AWS::NoValue")),
+            ))
 
     def add_outputs(self):
 
         # """ Implements the abstract method and writes IDs of various
         #     created resources """
+        # Not exported, consumers import the VPC from the network stack and
+        # CloudFormation warns against re-exporting an imported value
         self.template.add_output(Output(
             "vpcid",
             Description="ID of the VPC",
-            Value=Ref(self.vpc_id)
+            Value=self.get_network_input(self.vpc_id)
         ))
-        self.template.add_output(Output(
+        self.template.add_output(self.make_output(
             "NATAZbIP",
-            Description="Public IP of the NAT in AZ b",
-            Value=GetAtt(self.nat_instance_1, "PublicIp")
+            "Public IP of the NAT in AZ b",
+            If("UseNatGateway", Ref("NATGatewayEIP1"),
+                     If("UseNatAutoScaling", Ref("NATENIEIP1"), GetAtt(self.nat_instance_1, "PublicIp")))
         ))
-        self.template.add_output(Output(
+        self.template.add_output(self.make_output(
             "NATAZcIP",
-            Description="Public IP of the NAT in AZ c",
-            Value=GetAtt(self.nat_instance_2, "PublicIp")
+            "Public IP of the NAT in AZ c",
+            If("UseNatGateway", Ref("NATGatewayEIP2"),
+                     If("UseNatAutoScaling", Ref("NATENIEIP2"), GetAtt(self.nat_instance_2, "PublicIp")))
         ))
 #
 # End of Class
 
 if __name__ == "__main__":
     natstack = NATStack()
-    print(natstack.template.to_json())
+    print(fragments.render(natstack.template))
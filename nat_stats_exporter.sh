@@ -0,0 +1,121 @@
+#!/bin/bash
+# NAT flow statistics exporter, installed and started by NATStack's user data
+# (shipped in the bootstrap bundle or fetched from UploadBucketName).
+#
+# Every Interval seconds it samples conntrack (entries per protocol, table
+# size, drops), the MASQUERADE counters and the NIC statistics, including the
+# ENA allowance counters, and appends them as one CSV line to
+# $Data_Dir/<yyyymmdd>.csv. Files older than Retention_Days are removed.
+# With Push_Metrics=true it also pushes aggregates (peak table usage, rates,
+# drop counts) to CloudWatch every Push_Every seconds.
+#
+# Settings come from /etc/nat_stats_exporter.conf, written by cfn-init
+# (NAT instances) or user data (Auto Scaling NATs).
+
+CONF=/etc/nat_stats_exporter.conf
+Interval=60
+Push_Metrics=false
+Push_Every=300
+Namespace=NAT/Flows
+Interface=eth0
+Resource=$(hostname)
+Region=
+Retention_Days=14
+Data_Dir=/var/log/nat-stats
+[ -f $CONF ] && . $CONF
+
+COLUMNS="time,conntrack,conntrack_max,tcp,udp,icmp,ct_drop,ct_early_drop,ct_insert_failed"
+COLUMNS="$COLUMNS,nat_packets,nat_bytes,rx_bytes,tx_bytes,rx_packets,tx_packets,rx_dropped,tx_dropped"
+COLUMNS="$COLUMNS,bw_in_exceeded,bw_out_exceeded,pps_exceeded,conntrack_exceeded"
+
+value() { cat "$1" 2>/dev/null || echo 0; }
+
+# /proc/net/stat/nf_conntrack holds one row of hex counters per CPU
+conntrack_stat() {
+  local V
+  V=$(awk -v name="$1" 'NR == 1 { for (i = 1; i <= NF; i++) if ($i == name) col = i; next }
+                        col { total += strtonum("0x" $col) } END { print total + 0 }' /proc/net/stat/nf_conntrack 2>/dev/null)
+  echo ${V:-0}
+}
+
+# ENA allowance counters, 0 on other drivers
+ena_stat() {
+  local V
+  V=$(ethtool -S $Interface 2>/dev/null | awk -v name="$1" '$1 == name ":" { print $2 }')
+  echo ${V:-0}
+}
+
+sample() {
+  local NIC=/sys/class/net/$Interface/statistics
+  local FLOWS NAT
+  FLOWS=$(awk '{ n[$3]++ } END { print n["tcp"] + 0, n["udp"] + 0, n["icmp"] + 0 }' /proc/net/nf_conntrack 2>/dev/null)
+  NAT=$(iptables -t nat -L POSTROUTING -v -x -n 2>/dev/null | awk '/MASQUERADE/ { p += $1; b += $2 } END { print p + 0, b + 0 }')
+  echo $(date +%s) \
+    $(value /proc/sys/net/netfilter/nf_conntrack_count) $(value /proc/sys/net/netfilter/nf_conntrack_max) \
+    ${FLOWS:-0 0 0} \
+    $(conntrack_stat drop) $(conntrack_stat early_drop) $(conntrack_stat insert_failed) \
+    ${NAT:-0 0} \
+    $(value $NIC/rx_bytes) $(value $NIC/tx_bytes) $(value $NIC/rx_packets) $(value $NIC/tx_packets) \
+    $(value $NIC/rx_dropped) $(value $NIC/tx_dropped) \
+    $(ena_stat bw_in_allowance_exceeded) $(ena_stat bw_out_allowance_exceeded) \
+    $(ena_stat pps_allowance_exceeded) $(ena_stat conntrack_allowance_exceeded)
+}
+
+record() {
+  local FILE=$Data_Dir/$(date +%Y%m%d).csv
+  [ -f $FILE ] || echo "$COLUMNS" > $FILE
+  echo "$*" | tr ' ' ',' >> $FILE
+}
+
+metric() {
+  # name unit value
+  echo -n "{\"MetricName\": \"$1\", \"Unit\": \"$2\", \"Value\": $3,"
+  echo -n " \"Dimensions\": [{\"Name\": \"Resource\", \"Value\": \"$Resource\"}]},"
+}
+
+delta() {
+  # Counter increase between the last push and now, 0 after a counter reset
+  local D=$(( CURRENT[$1] - PREVIOUS[$1] ))
+  [ $D -lt 0 ] && D=0
+  echo $D
+}
+
+push() {
+  local SECONDS_SINCE=$(( CURRENT[0] - PREVIOUS[0] ))
+  [ $SECONDS_SINCE -gt 0 ] || return 0
+  local UTILIZATION=0
+  [ ${CURRENT[2]} -gt 0 ] && UTILIZATION=$(( PEAK * 100 / CURRENT[2] ))
+  local DATA
+  DATA=$(
+    metric ConntrackEntries Count $PEAK
+    metric ConntrackUtilization Percent $UTILIZATION
+    metric TcpFlows Count ${CURRENT[3]}
+    metric UdpFlows Count ${CURRENT[4]}
+    metric IcmpFlows Count ${CURRENT[5]}
+    metric ConntrackDrops Count $(( $(delta 6) + $(delta 7) + $(delta 8) ))
+    metric NatPackets Count/Second $(( $(delta 9) / SECONDS_SINCE ))
+    metric NatBytes Bytes/Second $(( $(delta 10) / SECONDS_SINCE ))
+    metric RxBytes Bytes/Second $(( $(delta 11) / SECONDS_SINCE ))
+    metric TxBytes Bytes/Second $(( $(delta 12) / SECONDS_SINCE ))
+    metric NicDrops Count $(( $(delta 15) + $(delta 16) ))
+    metric AllowanceExceeded Count $(( $(delta 17) + $(delta 18) + $(delta 19) + $(delta 20) ))
+  )
+  aws cloudwatch put-metric-data --region $Region --namespace $Namespace --metric-data "[${DATA%,}]" \
+    || echo "$(date) put-metric-data failed" >&2
+}
+
+mkdir -p $Data_Dir
+PREVIOUS=( $(sample) )
+PEAK=${PREVIOUS[1]}
+while true; do
+  sleep $Interval
+  CURRENT=( $(sample) )
+  record "${CURRENT[@]}"
+  [ ${CURRENT[1]} -gt $PEAK ] && PEAK=${CURRENT[1]}
+  if [ "$Push_Metrics" = "true" ] && [ $(( CURRENT[0] - PREVIOUS[0] )) -ge $Push_Every ]; then
+    push
+    PREVIOUS=( "${CURRENT[@]}" )
+    PEAK=${CURRENT[1]}
+  fi
+  find $Data_Dir -name '*.csv' -mtime +$Retention_Days -delete
+done
@@ -0,0 +1,113 @@
+#!/usr/bin/env python
+
+# Build hooks for finding out which builder phase of a stack is slow or
+# bloated. Pass them to any stack constructor, e.g.
+#
+#   profiler = PhaseProfiler()
+#   NATStack(hooks=[profiler, CProfileHook("/tmp/%(stack)s.prof")])
+#   print(profiler.report())
+#
+# or run this file directly: python profiling.py nat.NATStack
+
+import argparse
+import cProfile
+import importlib
+import time
+import tracemalloc
+from collections import namedtuple
+
+from base import BuildHook
+
+
+PhaseRecord = namedtuple("PhaseRecord", [
+    "stack", "phase", "seconds", "allocated", "peak",
+    "resources", "parameters", "outputs", "bytes",
+])
+
+
+class PhaseProfiler(BuildHook):
+
+    """ Records wall time, allocations (via tracemalloc) and what each phase
+        contributed to the template. Measuring bytes renders the partial
+        template after every phase, so it can be switched off for big stacks """
+
+    def __init__(self, measure_bytes=True):
+        self.measure_bytes = measure_bytes
+        self.records = []
+        self._started_tracing = False
+
+    def _counts(self, stack):
+        template = stack.template
+        size = len(template.to_json()) if self.measure_bytes else 0
+        return (len(template.resources), len(template.parameters), len(template.outputs), size)
+
+    def start_build(self, stack):
+        if not tracemalloc.is_tracing():
+            tracemalloc.start()
+            self._started_tracing = True
+
+    def before_phase(self, stack, phase):
+        self._before = self._counts(stack)
+        # The peak is per phase, measured from the memory in use at its start
+        tracemalloc.reset_peak()
+        self._memory = tracemalloc.get_traced_memory()[0]
+        self._started = time.perf_counter()
+
+    def after_phase(self, stack, phase):
+        seconds = time.perf_counter() - self._started
+        current, peak = tracemalloc.get_traced_memory()
+        after = self._counts(stack)
+        self.records.append(PhaseRecord(
+            type(stack).__name__, phase, seconds, current - self._memory, peak - self._memory,
+            *[a - b for a, b in zip(after, self._before)]
+        ))
+
+    def finish_build(self, stack):
+        if self._started_tracing:
+            tracemalloc.stop()
+            self._started_tracing = False
+
+    def report(self):
+        """ Returns the records as a fixed width table, one line per phase """
+        lines = ["%-16s %-24s %9s %11s %11s %9s %6s %6s %9s" % (
+            "stack", "phase", "ms", "alloc", "peak", "res", "params", "outs", "bytes")]
+        for r in self.records:
+            lines.append("%-16s %-24s %9.2f %11d %11d %9d %6d %6d %9d" % (
+                r.stack, r.phase, r.seconds * 1000, r.allocated, r.peak,
+                r.resources, r.parameters, r.outputs, r.bytes))
+        return "\n".join(lines)
+
+
+class CProfileHook(BuildHook):
+
+    """ Profiles the whole build of a stack and dumps the stats to path, which
+        may contain %(stack)s to get one file per stack class """
+
+    def __init__(self, path):
+        self.path = path
+        self.profile = None
+
+    def start_build(self, stack):
+        self.profile = cProfile.Profile()
+        self.profile.enable()
+
+    def finish_build(self, stack):
+        self.profile.disable()
+        self.profile.dump_stats(self.path % {"stack": type(stack).__name__})
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Profile the build phases of one or more stacks")
+    parser.add_argument("stacks", nargs="+", help="stack classes as module.Class, e.g. nat.NATStack")
+    parser.add_argument("--cprofile", help="dump cProfile stats to this path, %%(stack)s is replaced")
+    parser.add_argument("--no-bytes", action="store_true", help="skip rendering the template after each phase")
+    args = parser.parse_args()
+
+    profiler = PhaseProfiler(measure_bytes=not args.no_bytes)
+    hooks = [profiler]
+    if args.cprofile:
+        hooks.append(CProfileHook(args.cprofile))
+    for name in args.stacks:
+        module, cls = name.rsplit(".", 1)
+        getattr(importlib.import_module(module), cls)(hooks=hooks)
+    print(profiler.report())
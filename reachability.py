@@ -0,0 +1,528 @@
+#!/usr/bin/env python
+
+# Reachability queries over rendered templates. Load any number of stacks
+# (the JSON that spec.py/watch.py write) and ask whether traffic is allowed:
+#
+#   fleet = Fleet(parameters={"nat": {"EnvironmentName": "prod"}})
+#   fleet.load("rendered/nat.json")
+#   fleet.load("rendered/securitygroups.json")
+#   fleet.can_reach("10.0.1.0/24", "nat.NATSG", 443)      # tier1 -> NAT on 443
+#   fleet.route("rtb-0a1b2c3d", "8.8.8.8")                # -> "nat.NATInstance1"
+#
+#   python reachability.py rendered/*.json --assertions policy.json
+#
+# Intrinsics are evaluated against the parameter values (or defaults), the
+# template mappings and conditions, and ImportValue against the exports of
+# the other loaded stacks. Resources are named <stack>.<logical id>, where
+# the stack name is the file name without extension. Resources whose
+# properties cannot be resolved (e.g. an empty parameter) are skipped and
+# listed in Fleet.skipped.
+#
+# Everything is indexed up front so a query is a few bisects:
+#
+#   IntervalIndex  - stabbing queries over integer intervals, used both for
+#                    source CIDRs (as address ranges) and port ranges
+#   SG graph       - destination SG -> source SG -> rules, including
+#                    self-referencing rules
+#   RouteTrie      - longest-prefix match per route table
+
+import argparse
+import bisect
+import json
+import os
+import sys
+import time
+
+try:
+    basestring
+except NameError:
+    basestring = str
+
+PROTOCOLS = {"tcp": "6", "udp": "17", "icmp": "1", "all": "-1"}
+
+# Properties the indexes read, nothing else (tags etc.) is evaluated
+RULE_PROPERTIES = ("IpProtocol", "FromPort", "ToPort", "CidrIp", "DestinationCidrIp",
+                   "SourceSecurityGroupId", "DestinationSecurityGroupId")
+SG_PROPERTIES = ("SecurityGroupIngress", "SecurityGroupEgress")
+ACL_ENTRY_PROPERTIES = ("NetworkAclId", "RuleNumber", "Protocol", "RuleAction", "Egress",
+                        "CidrBlock", "PortRange")
+
+# Properties of AWS::EC2::Route naming the target, in lookup order
+ROUTE_TARGETS = ("InstanceId", "NatGatewayId", "NetworkInterfaceId", "GatewayId",
+                 "VpcPeeringConnectionId", "TransitGatewayId")
+
+class Unresolved(Exception):
+    pass
+
+
+# Marker for AWS::NoValue, dropped from lists and properties
+NO_VALUE = object()
+
+
+def parse_cidr(value):
+    """ Returns the (first, last) address of an IPv4 address or CIDR as ints """
+    address, _, length = value.partition("/")
+    octets = address.split(".")
+    if len(octets) != 4:
+        raise ValueError("not an IPv4 address or CIDR: %s" % value)
+    start = 0
+    for octet in octets:
+        start = (start << 8) | int(octet)
+    length = int(length) if length else 32
+    size = 1 << (32 - length)
+    start &= ~(size - 1) & 0xFFFFFFFF
+    return start, start + size - 1
+
+
+def normalize_protocol(protocol):
+    protocol = str(protocol).lower()
+    return PROTOCOLS.get(protocol, protocol)
+
+
+class IntervalIndex(object):
+
+    """ Closed integer intervals with values. Boundaries are split into
+        elementary segments once, so stabbing a point is one bisect """
+
+    def __init__(self):
+        self._items = []
+        self._points = None
+
+    def add(self, start, end, value):
+        self._items.append((start, end, value))
+        self._points = None
+
+    def _build(self):
+        points = sorted(set([s for s, _, _ in self._items] + [e + 1 for _, e, _ in self._items]))
+        segments = [[] for _ in points]
+        for item in self._items:
+            for i in range(bisect.bisect_left(points, item[0]), bisect.bisect_left(points, item[1] + 1)):
+                segments[i].append(item)
+        self._points = points
+        self._segments = segments
+
+    def query(self, x):
+        """ (start, end, value) of every interval containing x """
+        if self._points is None:
+            self._build()
+        i = bisect.bisect_right(self._points, x) - 1
+        return self._segments[i] if i >= 0 else []
+
+    def containing(self, start, end):
+        """ Values of the intervals containing all of start..end """
+        return [v for s, e, v in self.query(start) if e >= end]
+
+
+class RouteTrie(object):
+
+    """ Binary trie over destination prefixes for longest-prefix match """
+
+    def __init__(self):
+        # node: [child for bit 0, child for bit 1, target]
+        self.root = [None, None, None]
+
+    def add(self, cidr, target):
+        start, end = parse_cidr(cidr)
+        length = 32 - (end - start).bit_length()
+        node = self.root
+        for i in range(length):
+            bit = (start >> (31 - i)) & 1
+            if node[bit] is None:
+                node[bit] = [None, None, None]
+            node = node[bit]
+        node[2] = target
+
+    def lookup(self, address):
+        ip = parse_cidr(address)[0]
+        node, best = self.root, self.root[2]
+        for i in range(32):
+            node = node[(ip >> (31 - i)) & 1]
+            if node is None:
+                break
+            if node[2] is not None:
+                best = node[2]
+        return best
+
+
+class Rule(object):
+
+    """ One ingress/egress permission of a security group or NACL entry """
+
+    __slots__ = ("owner", "protocol", "ports", "cidr", "source_sg", "number", "allow", "egress", "origin")
+
+    def __init__(self, owner, protocol, ports, cidr=None, source_sg=None, number=None,
+                 allow=True, egress=False, origin=None):
+        self.owner = owner
+        self.protocol = protocol
+        self.ports = ports
+        self.cidr = cidr
+        self.source_sg = source_sg
+        self.number = number
+        self.allow = allow
+        self.egress = egress
+        self.origin = origin
+
+    def __repr__(self):
+        source = self.source_sg or "%s-%s" % (format_ip(self.cidr[0]), format_ip(self.cidr[1]))
+        return "<%s %s %s %s:%s-%s from %s>" % (
+            self.origin, self.owner, "egress" if self.egress else "ingress",
+            self.protocol, self.ports[0], self.ports[1], source)
+
+
+def format_ip(value):
+    return ".".join(str((value >> shift) & 255) for shift in (24, 16, 8, 0))
+
+
+class Stack(object):
+
+    """ A loaded template with an intrinsic evaluator """
+
+    def __init__(self, fleet, name, template, parameters=None):
+        self.fleet = fleet
+        self.name = name
+        self.template = template
+        self.parameters = dict(
+            (k, v["Default"]) for k, v in template.get("Parameters", {}).items() if "Default" in v)
+        self.parameters.update(parameters or {})
+        self._conditions = {}
+
+    def condition(self, name):
+        if name not in self._conditions:
+            self._conditions[name] = bool(self.resolve(self.template["Conditions"][name]))
+        return self._conditions[name]
+
+    def ref(self, name):
+        if name == "AWS::NoValue":
+            return NO_VALUE
+        if name == "AWS::Region":
+            return self.fleet.region
+        if name == "AWS::AccountId":
+            return self.fleet.account
+        if name in ("AWS::StackName", "AWS::StackId"):
+            return self.name
+        if name in self.template.get("Resources", {}):
+            return "%s.%s" % (self.name, name)
+        if name in self.parameters:
+            return self.parameters[name]
+        raise Unresolved("Ref %s" % name)
+
+    def resolve(self, node):
+        """ Evaluates the intrinsics in node """
+        if isinstance(node, list):
+            return [v for v in (self.resolve(v) for v in node) if v is not NO_VALUE]
+        if not isinstance(node, dict):
+            return node
+        if len(node) == 1:
+            fn, args = list(node.items())[0]
+            if fn == "Ref":
+                return self.ref(args)
+            if fn == "Condition":
+                return self.condition(args)
+            if fn.startswith("Fn::"):
+                return getattr(self, "_fn_" + fn[4:].lower())(args)
+        resolved = dict((k, self.resolve(v)) for k, v in node.items())
+        return dict((k, v) for k, v in resolved.items() if v is not NO_VALUE)
+
+    def _fn_if(self, args):
+        return self.resolve(args[1] if self.condition(args[0]) else args[2])
+
+    def _fn_equals(self, args):
+        return self.resolve(args[0]) == self.resolve(args[1])
+
+    def _fn_not(self, args):
+        return not self.resolve(args[0])
+
+    def _fn_and(self, args):
+        return all(self.resolve(v) for v in args)
+
+    def _fn_or(self, args):
+        return any(self.resolve(v) for v in args)
+
+    def _fn_findinmap(self, args):
+        name, key, value = [self.resolve(v) for v in args]
+        try:
+            return self.template["Mappings"][name][key][value]
+        except KeyError:
+            raise Unresolved("FindInMap %s/%s/%s" % (name, key, value))
+
+    def _fn_select(self, args):
+        return self.resolve(args[1])[int(self.resolve(args[0]))]
+
+    def _fn_join(self, args):
+        return self.resolve(args[0]).join(str(v) for v in self.resolve(args[1]))
+
+    def _fn_getatt(self, args):
+        # GroupId/AllocationId style attributes name the resource itself
+        return "%s.%s" % (self.name, args[0])
+
+    def _fn_getazs(self, args):
+        return ["%s%s" % (self.fleet.region, az) for az in "abc"]
+
+    def _fn_sub(self, args):
+        text = args if isinstance(args, basestring) else args[0]
+        out, rest = [], text
+        while "${" in rest:
+            before, _, rest = rest.partition("${")
+            name, _, rest = rest.partition("}")
+            out.append(before)
+            out.append(str(self.ref(name)))
+        return "".join(out) + rest
+
+    def _fn_importvalue(self, args):
+        return self.fleet.export(self.resolve(args))
+
+    def resources(self, resource_type, properties):
+        """ (logical id, resolved properties) of the active resources of a
+            type, only the named properties are resolved """
+        for name, resource in sorted(self.template.get("Resources", {}).items()):
+            if resource["Type"] != resource_type:
+                continue
+            try:
+                if "Condition" in resource and not self.condition(resource["Condition"]):
+                    continue
+                props = resource.get("Properties", {})
+                resolved = self.resolve(dict((k, props[k]) for k in properties if k in props))
+                yield name, resolved
+            except (Unresolved, KeyError, IndexError, ValueError) as e:
+                self.fleet.skipped.append(("%s.%s" % (self.name, name), str(e)))
+
+
+class Fleet(object):
+
+    """ Indexed security groups, NACLs and routes of a set of stacks """
+
+    def __init__(self, parameters=None, region="us-east-1", account="123456789012"):
+        self.parameters = parameters or {}
+        self.region = region
+        self.account = account
+        self.stacks = {}
+        self.skipped = []
+        self._indexed = False
+
+    def load(self, path, name=None):
+        name = name or os.path.splitext(os.path.basename(path))[0]
+        with open(path) as f:
+            self.add_stack(name, json.load(f))
+
+    def add_stack(self, name, template):
+        self.stacks[name] = Stack(self, name, template, self.parameters.get(name))
+        self._indexed = False
+
+    def export(self, export_name):
+        for stack in self.stacks.values():
+            for output in stack.template.get("Outputs", {}).values():
+                if "Export" in output and stack.resolve(output["Export"]["Name"]) == export_name:
+                    return stack.resolve(output["Value"])
+        raise Unresolved("ImportValue %s" % export_name)
+
+    # Indexing
+
+    def _add_sg_rule(self, rule):
+        rule_id = len(self.rules)
+        self.rules.append(rule)
+        self.port_index.setdefault((rule.egress, rule.protocol), IntervalIndex()).add(
+            rule.ports[0], rule.ports[1], rule_id)
+        self.rules_by_sg.setdefault((rule.egress, rule.owner), set()).add(rule_id)
+        if rule.source_sg:
+            peers = self.sg_graph.setdefault((rule.egress, rule.owner), {})
+            peers.setdefault(rule.source_sg, set()).add(rule_id)
+        else:
+            self.cidr_index.add(rule.cidr[0], rule.cidr[1], rule_id)
+
+    def _sg_rule(self, owner, props, egress, origin):
+        protocol = normalize_protocol(props.get("IpProtocol", "-1"))
+        low, high = int(props.get("FromPort", -1)), int(props.get("ToPort", -1))
+        ports = (0, 65535) if protocol == "-1" or (low, high) == (-1, -1) else (low, high)
+        peer = props.get("DestinationSecurityGroupId" if egress else "SourceSecurityGroupId")
+        cidr = props.get("CidrIp") or props.get("DestinationCidrIp" if egress else None)
+        rule = Rule(owner, protocol, ports, cidr=parse_cidr(cidr) if cidr else None,
+                    source_sg=peer, egress=egress, origin=origin)
+        if rule.cidr is None and rule.source_sg is None:
+            raise Unresolved("%s has neither a CIDR nor a peer group" % origin)
+        self._add_sg_rule(rule)
+
+    def index(self):
+        self.rules = []
+        self.cidr_index = IntervalIndex()
+        self.port_index = {}
+        self.rules_by_sg = {}
+        self.sg_graph = {}
+        self.groups = set()
+        self.egress_groups = set()
+        self.acls = {}
+        self.subnet_acls = {}
+        self.route_tables = {}
+        self.skipped = []
+        for stack in self.stacks.values():
+            for name, props in stack.resources("AWS::EC2::SecurityGroup", SG_PROPERTIES):
+                group = "%s.%s" % (stack.name, name)
+                self.groups.add(group)
+                for i, rule in enumerate(props.get("SecurityGroupIngress", [])):
+                    self._sg_rule(group, rule, False, "%s[%i]" % (group, i))
+                if props.get("SecurityGroupEgress"):
+                    self.egress_groups.add(group)
+                    for i, rule in enumerate(props["SecurityGroupEgress"]):
+                        self._sg_rule(group, rule, True, "%s[egress %i]" % (group, i))
+            for kind, egress in (("AWS::EC2::SecurityGroupIngress", False), ("AWS::EC2::SecurityGroupEgress", True)):
+                # Standalone egress rules add to the group's egress, only the
+                # group's own SecurityGroupEgress replaces the default allow all
+                for name, props in stack.resources(kind, RULE_PROPERTIES + ("GroupId",)):
+                    self._sg_rule(props["GroupId"], props, egress, "%s.%s" % (stack.name, name))
+            for name, props in stack.resources("AWS::EC2::NetworkAclEntry", ACL_ENTRY_PROPERTIES):
+                ports = props.get("PortRange", {})
+                protocol = normalize_protocol(props["Protocol"])
+                rule = Rule(props["NetworkAclId"], protocol,
+                            (int(ports.get("From", 0)), int(ports.get("To", 65535))) if ports and protocol != "-1" else (0, 65535),
+                            cidr=parse_cidr(props["CidrBlock"]), number=int(props["RuleNumber"]),
+                            allow=props["RuleAction"] == "allow", egress=str(props.get("Egress", "false")).lower() == "true",
+                            origin="%s.%s" % (stack.name, name))
+                self.acls.setdefault((rule.egress, rule.owner), IntervalIndex()).add(rule.cidr[0], rule.cidr[1], rule)
+            for name, props in stack.resources("AWS::EC2::SubnetNetworkAclAssociation", ("SubnetId", "NetworkAclId")):
+                self.subnet_acls[props["SubnetId"]] = props["NetworkAclId"]
+            for name, props in stack.resources("AWS::EC2::Route", ("RouteTableId", "DestinationCidrBlock") + ROUTE_TARGETS):
+                target = [props[key] for key in ROUTE_TARGETS if key in props]
+                if target and "DestinationCidrBlock" in props:
+                    self.route_tables.setdefault(props["RouteTableId"], RouteTrie()).add(
+                        props["DestinationCidrBlock"], target[0])
+        self._indexed = True
+
+    # Queries
+
+    def _matching(self, egress, group, protocol, port, cidr, groups):
+        rule_ids = self.rules_by_sg.get((egress, group))
+        if not rule_ids:
+            return None
+        by_port = set()
+        for key in (protocol, "-1"):
+            if (egress, key) in self.port_index:
+                by_port.update(self.port_index[(egress, key)].containing(port, port))
+        candidates = rule_ids & by_port
+        if not candidates:
+            return None
+        if cidr is not None:
+            for rule_id in candidates.intersection(self.cidr_index.containing(cidr[0], cidr[1])):
+                return self.rules[rule_id]
+        peers = self.sg_graph.get((egress, group), {})
+        for peer in groups:
+            matched = candidates & peers.get(peer, set())
+            if matched:
+                return self.rules[min(matched)]
+        return None
+
+    def explain(self, source, destination, port, protocol="tcp", source_groups=()):
+        """ Returns the ingress rule of the destination group that lets source
+            (an address/CIDR or a group name) in on protocol/port, else None.
+            A CIDR source has to be allowed as a whole """
+        if not self._indexed:
+            self.index()
+        protocol = normalize_protocol(protocol)
+        groups = list(source_groups)
+        cidr = None
+        if source[:1].isdigit():
+            cidr = parse_cidr(source)
+        else:
+            groups.append(source)
+        return self._matching(False, destination, protocol, int(port), cidr, groups)
+
+    def can_reach(self, source, destination, port, protocol="tcp", source_groups=(),
+                  destination_address=None):
+        """ True if destination's ingress and, when source is a group with
+            a SecurityGroupEgress property, source's egress allow the traffic.
+            An egress CIDR rule counts if it covers destination_address, or
+            the whole address space when that is not given. Only security
+            groups are checked, NACLs (acl_allows) and routes (route) have to
+            be queried separately """
+        if self.explain(source, destination, port, protocol, source_groups) is None:
+            return False
+        protocol = normalize_protocol(protocol)
+        cidr = parse_cidr(destination_address or "0.0.0.0/0")
+        for group in [source] + list(source_groups):
+            if group in self.egress_groups and \
+                    self._matching(True, group, protocol, int(port), cidr, [destination]) is None:
+                return False
+        return True
+
+    def peers(self, group):
+        """ Groups allowed into group by group-to-group rules, itself included
+            for self-referencing rules """
+        if not self._indexed:
+            self.index()
+        return sorted(self.sg_graph.get((False, group), {}))
+
+    def acl_allows(self, acl, address, port, protocol="tcp", egress=False):
+        """ NACL evaluation: the lowest numbered matching entry decides,
+            nothing matching denies """
+        if not self._indexed:
+            self.index()
+        acl = self.subnet_acls.get(acl, acl)
+        index = self.acls.get((egress, acl))
+        if index is None:
+            return False
+        protocol, port = normalize_protocol(protocol), int(port)
+        matching = [rule for rule in index.containing(*parse_cidr(address))
+                    if rule.protocol in (protocol, "-1") and rule.ports[0] <= port <= rule.ports[1]]
+        return bool(matching) and min(matching, key=lambda rule: rule.number).allow
+
+    def route(self, route_table, address):
+        """ Target of the most specific route for address, None without a route """
+        if not self._indexed:
+            self.index()
+        trie = self.route_tables.get(route_table)
+        return trie.lookup(address) if trie else None
+
+
+def run_assertions(fleet, assertions):
+    """ Evaluates assertions like {"from": "10.0.1.0/24", "to": "nat.NATSG",
+        "port": 443, "protocol": "tcp", "to_address": "10.0.2.15",
+        "expect": true} or {"route_table":
+        "rtb-0a1b2c3d", "address": "8.8.8.8", "expect":
+        "nat.NATInstance1"}, returns the failed ones with what was found """
+    failures = []
+    for assertion in assertions:
+        if "route_table" in assertion:
+            found = fleet.route(assertion["route_table"], assertion["address"])
+        else:
+            found = fleet.can_reach(assertion["from"], assertion["to"], assertion["port"],
+                                    assertion.get("protocol", "tcp"), assertion.get("from_groups", ()),
+                                    assertion.get("to_address"))
+        if found != assertion.get("expect", True):
+            failures.append((assertion, found))
+    return failures
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Reachability queries over rendered templates")
+    parser.add_argument("templates", nargs="+", help="rendered template JSON files")
+    parser.add_argument("--parameters", help="JSON file of {stack: {parameter: value}}")
+    parser.add_argument("--region", default="us-east-1")
+    parser.add_argument("--assertions", help="JSON list of assertions to check")
+    parser.add_argument("--from", dest="source", help="address, CIDR or group")
+    parser.add_argument("--to", help="destination group")
+    parser.add_argument("--port", type=int)
+    parser.add_argument("--protocol", default="tcp")
+    args = parser.parse_args()
+
+    parameters = None
+    if args.parameters:
+        with open(args.parameters) as f:
+            parameters = json.load(f)
+    fleet = Fleet(parameters, args.region)
+    for path in args.templates:
+        fleet.load(path)
+    started = time.time()
+    fleet.index()
+    for resource, reason in fleet.skipped:
+        print("skipped %s: %s" % (resource, reason))
+
+    if args.source:
+        rule = fleet.explain(args.source, args.to, args.port, args.protocol)
+        print("%s -> %s %s/%s: %s" % (args.source, args.to, args.protocol, args.port,
+                                      "allowed by %r" % rule if rule else "denied"))
+    if args.assertions:
+        with open(args.assertions) as f:
+            assertions = json.load(f)
+        failures = run_assertions(fleet, assertions)
+        for assertion, found in failures:
+            print("FAILED %s (got %s)" % (json.dumps(assertion, sort_keys=True), found))
+        print("%d assertions, %d failed, %.1f ms" % (len(assertions), len(failures), (time.time() - started) * 1000))
+        sys.exit(1 if failures else 0)
@@ -0,0 +1,175 @@
+#!/usr/bin/env python
+
+# Per-region templates: the generic template looks the region up at deploy
+# time (FindInMap on AWS::Region for naming, AZs and AMIs). Specializing it
+# for a region resolves those lookups, Fn::GetAZs (from REGION_TO_AZ) and
+# AWS::Region itself into literals, drops the mappings nothing reads any
+# more and defaults the AMI parameters to the region's AMI:
+#
+#   python region.py nat.NATStack --regions us-east-1 eu-west-1 --output-dir rendered/ \
+#       --threshold 0.9 --via-s3
+#
+# writes rendered/NATStack-use1.json and rendered/NATStack-euw1.json. The
+# stack is built and rendered once. Every subtree that does not depend on the
+# region is wrapped in a Fragment, so its JSON is encoded for the first region
+# and spliced into the others.
+
+import argparse
+import json
+import os
+
+import fragments
+from constants import REGION_TO_AZ, REGION_TO_CONVENTION_MAPPING
+from limits import LimitGuard, load_class
+from userdata import merge
+
+# Parameters defaulted to a per-region value of a mapping, as
+# parameter -> (mapping, attribute)
+AMI_PARAMETERS = {
+    "EC2InstanceAmi": ("NATAMIMAPPING", "AMI"),
+}
+
+REGION = {"Ref": "AWS::Region"}
+
+
+def _is_intrinsic(node, name):
+    return isinstance(node, dict) and len(node) == 1 and name in node
+
+
+class Specializer(object):
+
+    """ Renders one stack class for any number of regions """
+
+    def __init__(self, cls, hooks=()):
+        self.cls = cls
+        self.template = json.loads(fragments.render(cls(hooks=hooks).template))
+        self.mappings = self.template.get("Mappings", {})
+        self._dependent = {}
+        self._fragments = {}
+        self._used = {}
+
+    def dependent(self, node):
+        """ Whether node refers to the region, memoized per subtree """
+        if not isinstance(node, (dict, list)):
+            return False
+        key = id(node)
+        if key not in self._dependent:
+            if node == REGION or _is_intrinsic(node, "Fn::GetAZs"):
+                result = True
+            elif _is_intrinsic(node, "Fn::Sub"):
+                body = node["Fn::Sub"]
+                result = "${AWS::Region}" in (body if isinstance(body, str) else body[0]) or self.dependent(body)
+            else:
+                values = node.values() if isinstance(node, dict) else node
+                result = any([self.dependent(v) for v in values])
+            self._dependent[key] = result
+        return self._dependent[key]
+
+    def shared(self, node):
+        # The same Fragment (and cached JSON) for every region
+        if id(node) not in self._fragments:
+            self._fragments[id(node)] = fragments.Fragment(node)
+        return self._fragments[id(node)]
+
+    def resolve(self, node, region):
+        """ Copy of node for region, region-invariant containers become
+            shared fragments """
+        if not isinstance(node, (dict, list)):
+            return node
+        if not self.dependent(node):
+            return self.shared(node)
+        if node == REGION:
+            return region
+        if isinstance(node, list):
+            return [self.resolve(v, region) for v in node]
+        resolved = dict((k, self.resolve(v, region)) for k, v in node.items())
+        return self.simplify(resolved, region)
+
+    def simplify(self, node, region):
+        """ Evaluates an intrinsic whose arguments are now literals """
+        if _is_intrinsic(node, "Fn::GetAZs") and region in REGION_TO_AZ:
+            return list(REGION_TO_AZ[region]["AZ"])
+        if _is_intrinsic(node, "Fn::FindInMap"):
+            name, key, attribute = node["Fn::FindInMap"]
+            if isinstance(key, str) and isinstance(attribute, str):
+                if key not in self.mappings.get(name, {}):
+                    raise ValueError("%s has no entry for %s (specializing for %s)" % (name, key, region))
+                return self.mappings[name][key][attribute]
+        if _is_intrinsic(node, "Fn::Select"):
+            index, values = node["Fn::Select"]
+            if isinstance(values, list) and isinstance(index, (int, str)):
+                return values[int(index)]
+        if _is_intrinsic(node, "Fn::Join"):
+            delimiter, values = node["Fn::Join"]
+            if isinstance(values, list):
+                if all(isinstance(v, str) for v in values):
+                    return delimiter.join(values)
+                if delimiter == "":
+                    return {"Fn::Join": ["", merge(values)]}
+        if _is_intrinsic(node, "Fn::Sub") and isinstance(node["Fn::Sub"], str):
+            return {"Fn::Sub": node["Fn::Sub"].replace("${AWS::Region}", region)}
+        return node
+
+    def specialize(self, region):
+        """ The template for region as a dict, may contain Fragments """
+        if region not in REGION_TO_CONVENTION_MAPPING:
+            raise ValueError("no naming convention for %s in REGION_TO_CONVENTION_MAPPING" % region)
+        template = dict((k, self.resolve(v, region)) for k, v in self.template.items()
+                        if k not in ("Mappings", "Parameters"))
+        if "Description" in template:
+            template["Description"] = "%s (%s)" % (template["Description"], region)
+        if "Parameters" in self.template:
+            # Per parameter, so the AMI defaults do not unshare the rest
+            parameters = self.template["Parameters"]
+            template["Parameters"] = dict((name, self.resolve(p, region)) for name, p in parameters.items())
+            for name, (mapping, attribute) in sorted(AMI_PARAMETERS.items()):
+                if name in parameters and region in self.mappings.get(mapping, {}):
+                    parameter = dict(parameters[name])
+                    parameter["Default"] = self.mappings[mapping][region][attribute]
+                    template["Parameters"][name] = parameter
+        used = self.used_mappings(template)
+        if used:
+            template["Mappings"] = dict((name, self.mappings[name]) for name in used)
+        return template
+
+    def used_mappings(self, node):
+        # Mapping names still looked up after specializing
+        if isinstance(node, fragments.Fragment):
+            if id(node) not in self._used:
+                self._used[id(node)] = self.used_mappings(node.data)
+            return self._used[id(node)]
+        if isinstance(node, list):
+            return set().union(*[self.used_mappings(v) for v in node]) if node else set()
+        if not isinstance(node, dict):
+            return set()
+        used = set().union(*[self.used_mappings(v) for v in node.values()]) if node else set()
+        if _is_intrinsic(node, "Fn::FindInMap"):
+            name = node["Fn::FindInMap"][0]
+            if isinstance(name, str):
+                used.add(name)
+        return used
+
+    def render(self, region, indent=1):
+        return fragments.dumps(self.specialize(region), indent)
+
+    def filename(self, region):
+        return "%s-%s.json" % (self.cls.__name__, REGION_TO_CONVENTION_MAPPING[region]["Name"])
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Render per-region specializations of stacks")
+    parser.add_argument("stacks", nargs="+", help="module.Class or spec files")
+    parser.add_argument("--regions", nargs="+", default=sorted(REGION_TO_CONVENTION_MAPPING))
+    parser.add_argument("--output-dir", default=".")
+    parser.add_argument("--threshold", type=float, help="fail past this fraction of a CloudFormation limit")
+    parser.add_argument("--via-s3", action="store_true", help="leave out the inline TemplateBody limit")
+    args = parser.parse_args()
+
+    hooks = [LimitGuard(args.threshold, not args.via_s3)] if args.threshold is not None else []
+    for source in args.stacks:
+        specializer = Specializer(load_class(source), hooks)
+        for region in args.regions:
+            path = os.path.join(args.output_dir, specializer.filename(region))
+            with open(path, "w") as f:
+                f.write(specializer.render(region))
+            print(path)
@@ -8,17 +8,31 @@ import troposphere.cloudformation as cf
 import troposphere.ec2 as ec2
 
 from base import CloudformationAbstractBaseClass
+import ir
+import fragments
 from constants import *
 
 
 class BaseSGs(CloudformationAbstractBaseClass):
 
-    def __init__(self):
-        super(BaseSGs, self).__init__()
-        self.template.add_description("Template to create generic Security Group")
-        self.add_parameters()
-        self.add_main_sgs()
-        self.add_outputs()
+    DESCRIPTION = "Template to create generic Security Group"
+
+    """ Here is the list that the SG will loop through """
+    LOOP_RULES = [
+        {'prot': 'tcp', 'fp' : '8080', 'tp': '8080'},
+        {'prot': 'tcp', 'fp' : '80', 'tp': '80'},
+        {'prot': 'tcp', 'fp' : '3389', 'tp': '3389'},
+    ]
+
+    def __init__(self, hooks=()):
+        super(BaseSGs, self).__init__(hooks)
+        self.template.add_description(self.DESCRIPTION)
+        self.build(
+            self.add_mappings,
+            self.add_parameters,
+            self.add_main_sgs,
+            self.add_outputs,
+        )
 
 
     def add_parameters(self):
@@ -35,6 +49,7 @@ class BaseSGs(CloudformationAbstractBaseClass):
             AllowedPattern=VALID_VPC_REGEX,
             ConstraintDescription=INVALID_VPC_MSG
         ))
+        self.add_network_stack_parameter(self.vpc_id)
 
     def add_main_sgs(self):
 
@@ -42,40 +57,34 @@ class BaseSGs(CloudformationAbstractBaseClass):
             "NonLoopingSG",
             GroupDescription="Security Group that statcially lists all rules",
             Tags=self.get_tags_as_list(None, '-nonloopingSg-tag'),
-            VpcId=Ref(self.vpc_id),
+            VpcId=self.get_network_input(self.vpc_id),
             SecurityGroupIngress=[
               ec2.SecurityGroupRule( IpProtocol="tcp", FromPort="22", ToPort="22", CidrIp="10.0.0.0/18" ),
             ]
         ))
 
-        """ Here is the list that the SG will loop through """
-
-        loop_rules = [
-            {'prot': 'tcp', 'fp' : '8080', 'tp': '8080'},
-            {'prot': 'tcp', 'fp' : '80', 'tp': '80'},
-            {'prot': 'tcp', 'fp' : '3389', 'tp': '3389'},
-        ]
-
         """ This is where the looping sg is declared"""
         self.sg_loopsg = self.template.add_resource(ec2.SecurityGroup(
             "LoopingSecurityGroup",
             GroupDescription="Security Group that loops through a list loop_rules",
             Tags=self.get_tags_as_list(None, '-loopingSg-tag'),
-            VpcId=Ref(self.vpc_id),
+            VpcId=self.get_network_input(self.vpc_id),
         ))
         """ no fucking clue what this does, but you need it"""
         self.sg_loopsg_ingress = []
 
         """ This is where the sg loops. The SG is created and this loop appends on to that sg adding the IpProtocol
-        and what ever else information until the list completes.  """
-        for i, props in enumerate(loop_rules):
-            self.sg_loopsg_ingress.append(self.template.add_resource(ec2.SecurityGroupIngress(
+        and what ever else information until the list completes. The rules are compact ir records as
+        this is the part of the stack that grows with the rule list.  """
+        for i, props in enumerate(self.LOOP_RULES):
+            self.sg_loopsg_ingress.append(self.template.add_resource(ir.Resource(
                 "LoopSGingress%i" %i,
-                GroupId = Ref(self.sg_loopsg),
+                "AWS::EC2::SecurityGroupIngress",
+                GroupId = ir.ref(self.sg_loopsg),
                 IpProtocol=props['prot'],
                 FromPort=props['fp'],
                 ToPort=props['tp'],
-                SourceSecurityGroupId=Ref(self.sg_loopsg) 
+                SourceSecurityGroupId=ir.ref(self.sg_loopsg)
         )))
 
     def add_outputs(self):
@@ -83,22 +92,24 @@ class BaseSGs(CloudformationAbstractBaseClass):
         # Implements the abstract method and writes IDs of various
         #     created resources
 
+        # Not exported, consumers import the VPC from the network stack and
+        # CloudFormation warns against re-exporting an imported value
         self.template.add_output(Output(
             "vpcid",
             Description="ID of the VPC",
-            Value=Ref(self.vpc_id)
+            Value=self.get_network_input(self.vpc_id)
         ))
-        self.template.add_output(Output(
+        self.template.add_output(self.make_output(
             "NonLoopingSG",
-            Description="ID of the non-looping SG",
-            Value=Ref(self.sg_standardsg)
+            "ID of the non-looping SG",
+            Ref(self.sg_standardsg)
         ))
-        self.template.add_output(Output(
+        self.template.add_output(self.make_output(
             "LoopingSecurityGroup",
-            Description="ID of the looping SG",
-            Value=Ref(self.sg_loopsg)
+            "ID of the looping SG",
+            Ref(self.sg_loopsg)
         ))
 
 if __name__ == "__main__":
     basesgs = BaseSGs()
-    print(basesgs.template.to_json())
\ No newline at end of file
+    print(fragments.render(basesgs.template))
\ No newline at end of file
@@ -0,0 +1,115 @@
+#!/usr/bin/env python
+
+# Declarative stack definitions. A spec (YAML or JSON) names the stack class
+# it specializes and overrides its data attributes, so a new variant is a
+# data file rather than a copied Python class:
+#
+#   name: NATStackM3
+#   stack: nat.NATStack
+#   description: NATs sized for the analytics VPC
+#   parameters:
+#     NatSize: {Default: m3.medium}
+#   nat_sg_rules:
+#     - {prot: tcp, fp: "443", tp: "443", cidr: vpc}
+#   nat_azs: [1, 2]
+#   routes:
+#     - [PrivateRoute1, PrivateRouteTable1, 1]
+#     - [PrivateRoute2, PrivateRouteTable2, 2]
+#
+#   python spec.py specs/*.yaml --output-dir rendered/ --threshold 0.9
+#
+# Compiled classes are cached on the spec contents, so identical specs (or
+# the same file rendered repeatedly) compile once.
+
+import argparse
+import hashlib
+import importlib
+import json
+import os
+
+import fragments
+from limits import LimitGuard
+
+try:
+    import yaml
+except ImportError:
+    yaml = None
+
+
+# spec key -> class attribute it overrides
+SPEC_ATTRIBUTES = {
+    "description": "DESCRIPTION",
+    "parameters": "PARAMETER_OVERRIDES",
+    "loop_rules": "LOOP_RULES",
+    "nat_sg_rules": "NAT_SG_RULES",
+    "nat_azs": "NAT_AZ_INDEXES",
+    "routes": "NAT_ROUTES",
+    "db_storage": "DB_STORAGE",
+    "db_iops": "DB_IOPS",
+    "db_parameters": "DB_PARAMETERS",
+    "read_replicas": "DB_READ_REPLICAS",
+    "user_tags": "USER_TAG_COUNT",
+}
+
+# Attributes whose length is fixed by the stack's code, e.g. NATStack builds
+# exactly two NATs and reads one NAT_AZ_INDEXES entry for each
+FIXED_LENGTH = frozenset(["NAT_AZ_INDEXES"])
+
+_compiled = {}
+
+
+def load_spec(path):
+    """ Reads a spec file, YAML needs PyYAML installed """
+    with open(path) as f:
+        if path.endswith((".yaml", ".yml")):
+            if yaml is None:
+                raise ImportError("PyYAML is required to load %s" % path)
+            return yaml.safe_load(f)
+        return json.load(f)
+
+
+def compile_spec(spec):
+    """ Returns a stack class built from the spec dict """
+    key = hashlib.sha1(json.dumps(spec, sort_keys=True).encode("utf-8")).hexdigest()
+    if key not in _compiled:
+        module, cls = spec["stack"].rsplit(".", 1)
+        base = getattr(importlib.import_module(module), cls)
+        attributes = {}
+        for name, value in spec.items():
+            if name in ("name", "stack"):
+                continue
+            if name not in SPEC_ATTRIBUTES:
+                raise ValueError("unknown spec key %s" % name)
+            if not hasattr(base, SPEC_ATTRIBUTES[name]):
+                raise ValueError("%s is not configurable on %s" % (name, spec["stack"]))
+            default = getattr(base, SPEC_ATTRIBUTES[name])
+            if SPEC_ATTRIBUTES[name] in FIXED_LENGTH and len(value) != len(default):
+                raise ValueError("%s needs exactly %i entries for %s, got %i" % (
+                    name, len(default), spec["stack"], len(value)))
+            attributes[SPEC_ATTRIBUTES[name]] = value
+        _compiled[key] = type(str(spec.get("name", cls)), (base,), attributes)
+    return _compiled[key]
+
+
+def render_spec(path, hooks=()):
+    """ Builds the stack described by the spec file and returns its JSON """
+    return fragments.render(compile_spec(load_spec(path))(hooks=hooks).template)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Render stacks from declarative specs")
+    parser.add_argument("specs", nargs="+", help="YAML or JSON spec files")
+    parser.add_argument("--output-dir", help="write <spec name>.json here instead of stdout")
+    parser.add_argument("--threshold", type=float, help="fail past this fraction of a CloudFormation limit")
+    parser.add_argument("--via-s3", action="store_true", help="leave out the inline TemplateBody limit")
+    args = parser.parse_args()
+
+    hooks = [LimitGuard(args.threshold, not args.via_s3)] if args.threshold is not None else []
+    for path in args.specs:
+        rendered = render_spec(path, hooks)
+        if args.output_dir:
+            name = os.path.splitext(os.path.basename(path))[0]
+            with open(os.path.join(args.output_dir, name + ".json"), "w") as f:
+                f.write(rendered)
+        else:
+            print(rendered)
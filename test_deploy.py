@@ -0,0 +1,227 @@
+#!/usr/bin/env python
+
+import asyncio
+
+import pytest
+
+pytest.importorskip("botocore")
+
+from botocore.exceptions import ClientError
+
+from constants import CFN_TEMPLATE_BODY_BYTES
+from deploy import HASH_TAG, Deployer, Target, Throttle, order
+
+
+def error(code, message, operation):
+    return ClientError({"Error": {"Code": code, "Message": message}}, operation)
+
+
+class FakeCloudFormation(object):
+
+    """ In-memory CloudFormation. A stack in progress settles on the next
+        describe_stacks, as <ACTION>_COMPLETE unless outcomes says otherwise.
+        The first `throttled` calls fail with Throttling """
+
+    def __init__(self, stacks=None, outcomes=None, throttled=0):
+        self.stacks = dict(stacks or {})
+        self.outcomes = dict(outcomes or {})
+        self.throttled = throttled
+        self.calls = []
+        self.requests = {}
+
+    def _call(self, operation, name):
+        if self.throttled:
+            self.throttled -= 1
+            raise error("Throttling", "Rate exceeded", operation)
+        self.calls.append((operation, name))
+
+    def _start(self, name, status, kwargs):
+        self.requests[name] = kwargs
+        self.stacks[name] = {"StackName": name, "StackStatus": status, "Tags": kwargs.get("Tags", [])}
+
+    def create_stack(self, **kwargs):
+        self._call("create_stack", kwargs["StackName"])
+        self._start(kwargs["StackName"], "CREATE_IN_PROGRESS", kwargs)
+
+    def update_stack(self, **kwargs):
+        self._call("update_stack", kwargs["StackName"])
+        self._start(kwargs["StackName"], "UPDATE_IN_PROGRESS", kwargs)
+
+    def delete_stack(self, StackName):
+        self._call("delete_stack", StackName)
+        self.stacks[StackName]["StackStatus"] = "DELETE_IN_PROGRESS"
+
+    def describe_stacks(self, StackName):
+        self._call("describe_stacks", StackName)
+        if StackName not in self.stacks:
+            raise error("ValidationError", "Stack with id %s does not exist" % StackName, "DescribeStacks")
+        stack = self.stacks[StackName]
+        status = stack["StackStatus"]
+        if status.endswith("_IN_PROGRESS"):
+            stack["StackStatus"] = self.outcomes.get(StackName, status.replace("IN_PROGRESS", "COMPLETE"))
+        if stack["StackStatus"] == "DELETE_COMPLETE":
+            del self.stacks[StackName]
+        return {"Stacks": [dict(stack)]}
+
+    def describe_stack_events(self, StackName):
+        self._call("describe_stack_events", StackName)
+        return {"StackEvents": []}
+
+
+class FakeS3(object):
+
+    def __init__(self):
+        self.objects = {}
+
+    def put_object(self, Bucket, Key, Body):
+        self.objects[(Bucket, Key)] = Body
+
+
+def deploy(client, targets, **kwargs):
+    events = []
+    deployer = Deployer(client, poll=0, on_event=events.append, throttle=Throttle(floor=0.001), **kwargs)
+    results = asyncio.run(deployer.run(targets))
+    return results, events, deployer
+
+
+def started(client):
+    return [name for operation, name in client.calls if operation in ("create_stack", "update_stack")]
+
+
+def test_order_checks_dependencies():
+    a = Target("a", "securitygroups.BaseSGs")
+    b = Target("b", "securitygroups.BaseSGs", after=["a"])
+    c = Target("c", "securitygroups.BaseSGs", after=["b"])
+    assert [t.name for t in order([c, b, a])] == ["a", "b", "c"]
+    with pytest.raises(ValueError):
+        order([Target("x", "securitygroups.BaseSGs", after=["missing"])])
+    a.after.add("c")
+    with pytest.raises(ValueError):
+        order([a, b, c])
+
+
+def test_dependencies_deploy_first():
+    client = FakeCloudFormation()
+    targets = [
+        Target("nat", "securitygroups.BaseSGs", after=["sgs"]),
+        Target("sgs", "securitygroups.BaseSGs"),
+        Target("other", "securitygroups.BaseSGs"),
+    ]
+    results, _, _ = deploy(client, targets)
+    assert results == {"sgs": "CREATE_COMPLETE", "nat": "CREATE_COMPLETE", "other": "CREATE_COMPLETE"}
+    calls = started(client)
+    assert calls.index("sgs") < calls.index("nat")
+    # nat is only created once sgs has settled
+    settled = client.calls.index(("describe_stacks", "sgs"), client.calls.index(("create_stack", "sgs")))
+    assert settled < client.calls.index(("create_stack", "nat"))
+
+
+def test_failed_stack_blocks_the_ones_after_it():
+    client = FakeCloudFormation(outcomes={"sgs": "ROLLBACK_COMPLETE"})
+    targets = [
+        Target("sgs", "securitygroups.BaseSGs"),
+        Target("nat", "securitygroups.BaseSGs", after=["sgs"]),
+        Target("other", "securitygroups.BaseSGs"),
+    ]
+    results, events, _ = deploy(client, targets)
+    assert results == {"sgs": "ROLLBACK_COMPLETE", "nat": "BLOCKED", "other": "CREATE_COMPLETE"}
+    assert "nat" not in started(client)
+    assert [e.detail for e in events if e.status == "BLOCKED"] == ["waiting on failed sgs"]
+
+
+def test_unchanged_stack_is_skipped():
+    target = Target("sgs", "securitygroups.BaseSGs", parameters={"EnvironmentName": "prod"})
+    client = FakeCloudFormation({"sgs": {"StackName": "sgs", "StackStatus": "UPDATE_COMPLETE",
+                                         "Tags": [{"Key": HASH_TAG, "Value": target.digest}]}})
+    results, _, _ = deploy(client, [target])
+    assert results == {"sgs": "SKIPPED"}
+    assert started(client) == []
+
+    # A parameter change alters the hash
+    changed = Target("sgs", "securitygroups.BaseSGs", parameters={"EnvironmentName": "dev"})
+    results, _, _ = deploy(client, [changed])
+    assert results == {"sgs": "UPDATE_COMPLETE"}
+    assert client.requests["sgs"]["Tags"] == [{"Key": HASH_TAG, "Value": changed.digest}]
+
+
+def test_update_keeps_the_other_stack_tags():
+    target = Target("sgs", "securitygroups.BaseSGs")
+    client = FakeCloudFormation({"sgs": {"StackName": "sgs", "StackStatus": "UPDATE_COMPLETE", "Tags": [
+        {"Key": HASH_TAG, "Value": "old"},
+        {"Key": "Team", "Value": "network"},
+        {"Key": "aws:cloudformation:stack-name", "Value": "sgs"},
+    ]}})
+    results, _, _ = deploy(client, [target])
+    assert results == {"sgs": "UPDATE_COMPLETE"}
+    assert client.requests["sgs"]["Tags"] == [{"Key": "Team", "Value": "network"},
+                                              {"Key": HASH_TAG, "Value": target.digest}]
+
+
+def test_rolled_back_stack_is_recreated():
+    client = FakeCloudFormation({"sgs": {"StackName": "sgs", "StackStatus": "ROLLBACK_COMPLETE"}})
+    results, _, _ = deploy(client, [Target("sgs", "securitygroups.BaseSGs")])
+    assert results == {"sgs": "CREATE_COMPLETE"}
+    assert [op for op, _ in client.calls if op.endswith("_stack")] == ["delete_stack", "create_stack"]
+
+
+def test_failed_delete_of_rolled_back_stack_is_an_error():
+    client = FakeCloudFormation({"sgs": {"StackName": "sgs", "StackStatus": "ROLLBACK_COMPLETE"}},
+                                outcomes={"sgs": "DELETE_FAILED"})
+    results, events, _ = deploy(client, [Target("sgs", "securitygroups.BaseSGs")])
+    assert results == {"sgs": "ERROR"}
+    assert "create_stack" not in [op for op, _ in client.calls]
+    assert [e.status for e in events][-1] == "ERROR"
+
+
+def test_throttled_calls_back_off_and_retry():
+    client = FakeCloudFormation(throttled=3)
+    results, _, deployer = deploy(client, [Target("sgs", "securitygroups.BaseSGs")])
+    assert results == {"sgs": "CREATE_COMPLETE"}
+    assert deployer.throttle.throttled == 3
+
+
+def test_other_errors_are_not_retried():
+    class Broken(FakeCloudFormation):
+        def create_stack(self, **kwargs):
+            raise error("InsufficientCapabilitiesException", "Requires capabilities", "CreateStack")
+    results, events, deployer = deploy(Broken(), [Target("sgs", "securitygroups.BaseSGs")])
+    assert results == {"sgs": "ERROR"}
+    assert deployer.throttle.throttled == 0
+
+
+def test_large_template_goes_through_s3():
+    target = Target("nat", "nat.NATStack")
+    assert len(target.body.encode("utf-8")) > CFN_TEMPLATE_BODY_BYTES
+    client, s3 = FakeCloudFormation(), FakeS3()
+    results, _, _ = deploy(client, [target], s3=s3, template_bucket="templates")
+    assert results == {"nat": "CREATE_COMPLETE"}
+    key = "nat/%s.json" % target.digest
+    assert s3.objects[("templates", key)] == target.body.encode("utf-8")
+    request = client.requests["nat"]
+    assert request["TemplateURL"] == "https://templates.s3.amazonaws.com/%s" % key
+    assert "TemplateBody" not in request
+
+    # Without a bucket the stack cannot be deployed
+    results, _, _ = deploy(FakeCloudFormation(), [Target("nat", "nat.NATStack")])
+    assert results == {"nat": "ERROR"}
+
+
+def test_stacks_past_a_limit_are_not_deployed():
+    client = FakeCloudFormation()
+    results, events, _ = deploy(client, [Target("nat", "nat.NATStack", threshold=0.9)],
+                                s3=FakeS3(), template_bucket="templates")
+    assert results == {"nat": "ERROR"}
+    assert "template_body_bytes" in events[-1].detail
+    assert started(client) == []
+
+    # Through S3 the TemplateBody limit does not apply
+    results, _, _ = deploy(client, [Target("nat", "nat.NATStack", threshold=0.9, inline=False)],
+                           s3=FakeS3(), template_bucket="templates")
+    assert results == {"nat": "CREATE_COMPLETE"}
+
+
+def test_small_template_is_passed_inline():
+    client = FakeCloudFormation()
+    target = Target("sgs", "securitygroups.BaseSGs")
+    deploy(client, [target], s3=FakeS3(), template_bucket="templates")
+    assert client.requests["sgs"]["TemplateBody"] == target.body
@@ -0,0 +1,185 @@
+#!/usr/bin/env python
+
+import pytest
+
+from reachability import Fleet, IntervalIndex, RouteTrie, parse_cidr, run_assertions
+
+
+def sg(ingress=(), egress=None, condition=None):
+    resource = {"Type": "AWS::EC2::SecurityGroup", "Properties": {"SecurityGroupIngress": list(ingress)}}
+    if egress is not None:
+        resource["Properties"]["SecurityGroupEgress"] = list(egress)
+    if condition:
+        resource["Condition"] = condition
+    return resource
+
+
+def tcp(port, **source):
+    rule = {"IpProtocol": "tcp", "FromPort": str(port), "ToPort": str(port)}
+    rule.update(source)
+    return rule
+
+
+ALL_EGRESS = {"IpProtocol": "-1", "CidrIp": "0.0.0.0/0"}
+
+
+def fleet(resources, **template):
+    template["Resources"] = resources
+    result = Fleet()
+    result.add_stack("app", template)
+    return result
+
+
+def test_parse_cidr():
+    assert parse_cidr("10.0.0.0/8") == (0x0A000000, 0x0AFFFFFF)
+    assert parse_cidr("10.1.2.3") == (0x0A010203, 0x0A010203)
+    # Host bits are masked off
+    assert parse_cidr("10.1.2.3/16") == (0x0A010000, 0x0A01FFFF)
+    with pytest.raises(ValueError):
+        parse_cidr("vpc-1234")
+
+
+def test_interval_index():
+    index = IntervalIndex()
+    index.add(0, 100, "a")
+    index.add(50, 60, "b")
+    index.add(80, 200, "c")
+    assert sorted(v for _, _, v in index.query(55)) == ["a", "b"]
+    assert sorted(v for _, _, v in index.query(150)) == ["c"]
+    assert index.query(201) == []
+    assert index.query(-1) == []
+    assert sorted(index.containing(50, 60)) == ["a", "b"]
+    assert index.containing(90, 150) == ["c"]
+    # Adding after a query rebuilds the segments
+    index.add(300, 300, "d")
+    assert index.containing(300, 300) == ["d"]
+
+
+def test_route_trie_longest_prefix():
+    trie = RouteTrie()
+    trie.add("0.0.0.0/0", "igw")
+    trie.add("10.0.0.0/8", "local")
+    trie.add("10.1.0.0/16", "peering")
+    assert trie.lookup("8.8.8.8") == "igw"
+    assert trie.lookup("10.2.0.1") == "local"
+    assert trie.lookup("10.1.200.1") == "peering"
+
+
+def test_cidr_ingress_has_to_cover_the_whole_source():
+    f = fleet({"Web": sg([tcp(443, CidrIp="10.0.0.0/16")])})
+    assert f.can_reach("10.0.1.0/24", "app.Web", 443)
+    assert f.can_reach("10.0.1.5", "app.Web", 443)
+    assert not f.can_reach("10.0.0.0/8", "app.Web", 443)
+    assert not f.can_reach("10.0.1.5", "app.Web", 80)
+    assert not f.can_reach("10.0.1.5", "app.Web", 443, "udp")
+
+
+def test_group_ingress_and_peers():
+    f = fleet({
+        "A": sg(),
+        "B": sg([tcp(443, SourceSecurityGroupId={"Fn::GetAtt": ["A", "GroupId"]})]),
+        "Loop": sg([tcp(22, SourceSecurityGroupId={"Ref": "Loop"})]),
+    })
+    assert f.can_reach("app.A", "app.B", 443)
+    assert not f.can_reach("app.A", "app.B", 22)
+    assert not f.can_reach("app.B", "app.A", 443)
+    assert f.peers("app.B") == ["app.A"]
+    assert f.peers("app.Loop") == ["app.Loop"]
+
+
+def test_all_egress_cidr_rule_allows_group_traffic():
+    f = fleet({
+        "A": sg(egress=[ALL_EGRESS]),
+        "B": sg([tcp(443, SourceSecurityGroupId={"Fn::GetAtt": ["A", "GroupId"]})]),
+    })
+    assert f.can_reach("app.A", "app.B", 443)
+
+
+def test_egress_cidr_rule_has_to_cover_the_destination():
+    f = fleet({
+        "A": sg(egress=[tcp(443, CidrIp="10.0.0.0/16")]),
+        "B": sg([tcp(443, SourceSecurityGroupId={"Fn::GetAtt": ["A", "GroupId"]})]),
+    })
+    assert f.can_reach("app.A", "app.B", 443, destination_address="10.0.3.4")
+    assert not f.can_reach("app.A", "app.B", 443, destination_address="10.1.3.4")
+    # Without an address only a rule covering every address is certain
+    assert not f.can_reach("app.A", "app.B", 443)
+
+
+def test_egress_rules_restrict_the_source_group():
+    f = fleet({
+        "A": sg(egress=[tcp(80, DestinationSecurityGroupId={"Fn::GetAtt": ["B", "GroupId"]})]),
+        "B": sg([{"IpProtocol": "tcp", "FromPort": "0", "ToPort": "65535",
+                  "SourceSecurityGroupId": {"Fn::GetAtt": ["A", "GroupId"]}}]),
+        "EgressRule": {"Type": "AWS::EC2::SecurityGroupEgress", "Properties": dict(
+            tcp(8080, DestinationSecurityGroupId={"Fn::GetAtt": ["B", "GroupId"]}),
+            GroupId={"Fn::GetAtt": ["A", "GroupId"]})},
+    })
+    assert f.can_reach("app.A", "app.B", 80)
+    assert f.can_reach("app.A", "app.B", 8080)
+    assert not f.can_reach("app.A", "app.B", 443)
+
+
+def test_standalone_egress_rule_keeps_the_default_egress():
+    f = fleet({
+        "A": sg(),
+        "B": sg([tcp(443, SourceSecurityGroupId={"Fn::GetAtt": ["A", "GroupId"]})]),
+        "EgressRule": {"Type": "AWS::EC2::SecurityGroupEgress", "Properties": dict(
+            tcp(8080, DestinationSecurityGroupId={"Fn::GetAtt": ["B", "GroupId"]}),
+            GroupId={"Fn::GetAtt": ["A", "GroupId"]})},
+    })
+    assert f.can_reach("app.A", "app.B", 443)
+
+
+def test_conditions_parameters_and_imports():
+    f = Fleet(parameters={"app": {"Mode": "gateway"}})
+    f.add_stack("network", {
+        "Resources": {},
+        "Outputs": {"Cidr": {"Value": "10.9.0.0/16", "Export": {"Name": {"Fn::Sub": "${AWS::StackName}-Cidr"}}}},
+    })
+    f.add_stack("app", {
+        "Parameters": {"Mode": {"Type": "String", "Default": "instances"}, "Empty": {"Type": "String", "Default": ""}},
+        "Conditions": {"UseInstances": {"Fn::Equals": [{"Ref": "Mode"}, "instances"]}},
+        "Resources": {
+            "Imported": sg([tcp(443, CidrIp={"Fn::ImportValue": "network-Cidr"})]),
+            "InstancesOnly": sg([tcp(22, CidrIp="10.0.0.0/8")], condition="UseInstances"),
+            "Broken": sg([tcp(22, CidrIp={"Ref": "Missing"})]),
+        },
+    })
+    assert f.can_reach("10.9.1.1", "app.Imported", 443)
+    assert not f.can_reach("10.0.0.1", "app.InstancesOnly", 22)
+    assert [name for name, _ in f.skipped] == ["app.Broken"]
+
+
+def test_acl_allows_lowest_rule_number_wins():
+    entry = lambda number, action, cidr: {"Type": "AWS::EC2::NetworkAclEntry", "Properties": {
+        "NetworkAclId": "acl-1", "RuleNumber": number, "Protocol": "6", "RuleAction": action,
+        "Egress": "false", "CidrBlock": cidr, "PortRange": {"From": "443", "To": "443"}}}
+    f = fleet({
+        "Deny": entry(100, "deny", "10.0.1.0/24"),
+        "Allow": entry(200, "allow", "10.0.0.0/16"),
+        "Association": {"Type": "AWS::EC2::SubnetNetworkAclAssociation",
+                        "Properties": {"SubnetId": "subnet-1", "NetworkAclId": "acl-1"}},
+    })
+    assert f.acl_allows("acl-1", "10.0.2.1", 443)
+    assert not f.acl_allows("acl-1", "10.0.1.1", 443)
+    assert not f.acl_allows("acl-1", "10.0.2.1", 80)
+    assert f.acl_allows("subnet-1", "10.0.2.1", 443)
+    assert not f.acl_allows("acl-2", "10.0.2.1", 443)
+
+
+def test_routes_and_assertions():
+    f = fleet({
+        "Nat": {"Type": "AWS::EC2::Instance", "Properties": {}},
+        "Default": {"Type": "AWS::EC2::Route", "Properties": {
+            "RouteTableId": "rtb-1", "DestinationCidrBlock": "0.0.0.0/0", "InstanceId": {"Ref": "Nat"}}},
+        "Web": sg([tcp(443, CidrIp="10.0.0.0/16")]),
+    })
+    assert f.route("rtb-1", "8.8.8.8") == "app.Nat"
+    assert f.route("rtb-2", "8.8.8.8") is None
+    failures = run_assertions(f, [
+        {"route_table": "rtb-1", "address": "8.8.8.8", "expect": "app.Nat"},
+        {"from": "10.0.1.0/24", "to": "app.Web", "port": 443},
+        {"from": "10.0.1.0/24", "to": "app.Web", "port": 80, "expect": True},
+    ])
+    assert [assertion["port"] for assertion, _ in failures] == [80]
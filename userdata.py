@@ -0,0 +1,125 @@
+#!/usr/bin/env python
+
+# User data composed from named sections instead of one hand-written Join
+# list per instance. A section is a list of strings and intrinsics which may
+# contain Slots, filled in when the script is rendered for one instance:
+#
+#   hostname = Section("hostname", [
+#       "NEWHOSTNAME=", Slot("hostname"), ".timeinc.com\n",
+#       "hostname $NEWHOSTNAME\n",
+#   ])
+#   script = Script([header, hostname, iptables])
+#   script.render(hostname=Ref("NatHostname1"))
+#
+# Variants are derived from one script with replace/move/without rather
+# than copied, and render merges adjacent literals, so the Join holds one
+# string between every pair of intrinsics instead of one per line.
+
+from troposphere import Base64, Join
+
+
+class Slot(object):
+
+    """ Placeholder for a per-instance value: a string, an intrinsic or a
+        list of both """
+
+    def __init__(self, name):
+        self.name = name
+
+    def __repr__(self):
+        return "Slot(%r)" % self.name
+
+
+class Section(object):
+
+    """ A named part of a script """
+
+    def __init__(self, name, parts):
+        self.name = name
+        self.parts = list(parts)
+
+    @property
+    def slots(self):
+        return set(part.name for part in self.parts if isinstance(part, Slot))
+
+
+class Script(object):
+
+    """ An ordered list of sections. The variant methods return new scripts
+        and leave this one unchanged """
+
+    def __init__(self, sections):
+        self.sections = list(sections)
+        names = [s.name for s in self.sections]
+        duplicates = set(n for n in names if names.count(n) > 1)
+        if duplicates:
+            raise ValueError("duplicate sections %s" % ", ".join(sorted(duplicates)))
+
+    @property
+    def names(self):
+        return [s.name for s in self.sections]
+
+    @property
+    def slots(self):
+        return set().union(*[s.slots for s in self.sections])
+
+    def _index(self, name):
+        if name not in self.names:
+            raise KeyError("no section %s, have %s" % (name, ", ".join(self.names)))
+        return self.names.index(name)
+
+    def replace(self, name, section):
+        """ Swaps the section called name for section """
+        sections = list(self.sections)
+        sections[self._index(name)] = section
+        return Script(sections)
+
+    def insert_after(self, name, section):
+        sections = list(self.sections)
+        sections.insert(self._index(name) + 1, section)
+        return Script(sections)
+
+    def move(self, name, after):
+        """ Moves the section called name to right after the section after """
+        section = self.sections[self._index(name)]
+        return Script(s for s in self.sections if s is not section).insert_after(after, section)
+
+    def without(self, *names):
+        for name in names:
+            self._index(name)
+        return Script(s for s in self.sections if s.name not in names)
+
+    def parts(self, **values):
+        """ The script's parts with every slot filled from values, adjacent
+            literals merged """
+        missing = self.slots - set(values)
+        if missing:
+            raise ValueError("no value for slots %s" % ", ".join(sorted(missing)))
+        parts = []
+        for section in self.sections:
+            for part in section.parts:
+                part = values[part.name] if isinstance(part, Slot) else part
+                parts.extend(part if isinstance(part, list) else [part])
+        return merge(parts)
+
+    def render(self, **values):
+        """ Base64 encoded Join, ready to use as UserData """
+        return Base64(Join("", self.parts(**values)))
+
+
+def merge(parts):
+    """ Joins runs of adjacent strings and drops empty ones """
+    merged = []
+    for part in parts:
+        if isinstance(part, str):
+            if not part:
+                continue
+            if merged and isinstance(merged[-1], str):
+                merged[-1] += part
+                continue
+        merged.append(part)
+    return merged
+
+
+if __name__ == "__main__":
+    pass
@@ -0,0 +1,310 @@
+#!/usr/bin/env python
+
+# Watch mode: re-render only the stack variants affected by an edit.
+#
+#   python watch.py nat.NATStack securitygroups.BaseSGs specs/*.yaml --output-dir rendered/
+#
+# Every render runs with a DependencyRecorder hook, which notes the repo
+# functions that executed and the constants they read. When a file changes,
+# the repo modules are re-imported and only the variants that depend on what
+# changed are rendered again:
+#
+#   constants.py    - variants that read a constant whose value changed
+#   other modules   - variants that executed a function whose code changed,
+#                     or every variant using the module when its module or
+#                     class level code (e.g. NAT_SG_RULES) changed
+#   spec files      - the variant built from that spec
+#
+# With --threshold every render also runs limits.py's LimitGuard, so a
+# variant going past a CloudFormation quota fails as soon as it is edited.
+# Add --via-s3 when the stacks are deployed through a template bucket.
+
+import argparse
+import importlib
+import inspect
+import os
+import sys
+import time
+import types
+
+from base import BuildHook
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+
+def _repo_file(filename):
+    # Skips pseudo files such as <frozen importlib._bootstrap> and <string>
+    if filename.startswith("<"):
+        return False
+    return os.path.dirname(os.path.abspath(filename)) == HERE
+
+
+def _qualname(code):
+    return getattr(code, "co_qualname", code.co_name)
+
+
+def _fingerprint(code):
+    # Bytecode, names and constants, nested code objects by name only, so
+    # moving a function to another line or editing a sibling changes nothing
+    consts = tuple(_qualname(c) if isinstance(c, types.CodeType) else repr(c) for c in code.co_consts)
+    return (code.co_code, code.co_names, consts)
+
+
+def code_fingerprints(path):
+    """ {qualified name: fingerprints} of the code objects compiled from
+        path. Module and class bodies are keyed on None, as a change there
+        can alter anything the module defines. Raises SyntaxError """
+    with open(path) as f:
+        pending = [compile(f.read(), path, "exec")]
+    fingerprints = {}
+    while pending:
+        code = pending.pop()
+        name = _qualname(code) if code.co_flags & inspect.CO_OPTIMIZED else None
+        fingerprints.setdefault(name, []).append(_fingerprint(code))
+        pending.extend(c for c in code.co_consts if isinstance(c, types.CodeType))
+    return dict((name, sorted(values)) for name, values in fingerprints.items())
+
+
+def changed_code(old, new):
+    """ Names whose code differs between two code_fingerprints results, None
+        when module or class level code changed """
+    if old.get(None) != new.get(None):
+        return None
+    return set(name for name in set(old) | set(new) if old.get(name) != new.get(name))
+
+
+def _constant_names(module):
+    return set(name for name in vars(module) if name.isupper())
+
+
+def _walk(value):
+    # Yields value and everything nested in it
+    yield value
+    if isinstance(value, dict):
+        for v in value.values():
+            for item in _walk(v):
+                yield item
+    elif isinstance(value, (list, tuple)):
+        for v in value:
+            for item in _walk(v):
+                yield item
+
+
+class DependencyRecorder(BuildHook):
+
+    """ Records what a stack read while it was built: the repo files and
+        functions that ran, as (file, qualified name), and the constants they
+        referenced """
+
+    def __init__(self):
+        self.files = set()
+        self.functions = set()
+        self.constants = set()
+        self._codes = set()
+
+    def _profile(self, frame, event, arg):
+        if event == "call" and _repo_file(frame.f_code.co_filename):
+            self._codes.add(frame.f_code)
+
+    def start_build(self, stack):
+        self._previous = sys.getprofile()
+        sys.setprofile(self._profile)
+
+    def finish_build(self, stack):
+        sys.setprofile(self._previous)
+        constants = importlib.import_module("constants")
+        names = _constant_names(constants)
+        for code in self._codes:
+            path = os.path.abspath(code.co_filename)
+            self.files.add(path)
+            self.functions.add((path, _qualname(code)))
+            self.constants.update(names.intersection(code.co_names))
+        # Class bodies run at import time, so data attributes built from
+        # constants (e.g. NAT_SG_RULES) are matched on identity instead
+        by_id = dict((id(getattr(constants, name)), name) for name in names)
+        for cls in type(stack).__mro__:
+            if cls.__module__ in sys.modules and _repo_file(getattr(sys.modules[cls.__module__], "__file__", "")):
+                self.files.add(os.path.abspath(sys.modules[cls.__module__].__file__))
+            for value in vars(cls).values():
+                for item in _walk(value):
+                    if id(item) in by_id:
+                        self.constants.add(by_id[id(item)])
+
+
+class Variant(object):
+
+    """ A renderable stack: either module.Class or a spec file. With a
+        threshold, rendering fails when the stack is past it, see LimitGuard """
+
+    def __init__(self, source, output_dir=None, threshold=None, inline=True):
+        self.source = source
+        self.output_dir = output_dir
+        self.threshold = threshold
+        self.inline = inline
+        self.is_spec = source.endswith((".yaml", ".yml", ".json"))
+        self.deps = None
+        # Set while the last render failed, so the next refresh retries it
+        self.stale = True
+
+    @property
+    def name(self):
+        if self.is_spec:
+            return os.path.splitext(os.path.basename(self.source))[0]
+        return self.source
+
+    def render(self, indent=1):
+        # The previous deps stay in place until this render succeeds
+        deps = DependencyRecorder()
+        self.stale = True
+        if self.is_spec:
+            spec = importlib.import_module("spec")
+            cls = spec.compile_spec(spec.load_spec(self.source))
+        else:
+            module, name = self.source.rsplit(".", 1)
+            cls = getattr(importlib.import_module(module), name)
+        hooks = [deps]
+        if self.threshold is not None:
+            # Made per render, the module may have been reloaded since the last
+            hooks.append(importlib.import_module("limits").LimitGuard(self.threshold, self.inline))
+        rendered = importlib.import_module("fragments").render(cls(hooks=hooks).template, indent)
+        if self.is_spec:
+            deps.files.add(os.path.abspath(self.source))
+        self.deps = deps
+        self.stale = False
+        if self.output_dir:
+            with open(os.path.join(self.output_dir, self.name + ".json"), "w") as f:
+                f.write(rendered)
+        return rendered
+
+    def affected_by(self, changes, changed_constants):
+        """ changes maps each changed file to the names of its changed
+            functions, or None when the whole file counts as changed """
+        if self.stale or self.deps is None:
+            return True
+        if self.deps.constants & changed_constants:
+            return True
+        for path, names in changes.items():
+            if path == os.path.join(HERE, "constants.py") or path not in self.deps.files:
+                continue
+            if names is None or self.deps.functions & set((path, name) for name in names):
+                return True
+        return False
+
+
+def reload_repo_modules():
+    """ Drops every repo module so the next import sees the edited sources,
+        returns the previous constants module for comparison """
+    old_constants = sys.modules.get("constants")
+    for name, module in list(sys.modules.items()):
+        if _repo_file(getattr(module, "__file__", None) or "/") and name != "__main__":
+            del sys.modules[name]
+    return old_constants
+
+
+def changed_constants(old, new):
+    names = _constant_names(old) | _constant_names(new)
+    return set(n for n in names if getattr(old, n, None) != getattr(new, n, None))
+
+
+class Watcher(object):
+
+    """ Polls the repo modules and spec files and re-renders affected variants """
+
+    def __init__(self, variants, interval=0.5):
+        self.variants = variants
+        self.interval = interval
+        self.mtimes = {}
+        # Last constants module that imported cleanly, edits are compared to it
+        self.constants = None
+        # code_fingerprints of the repo modules as last rendered
+        self.fingerprints = {}
+
+    def _watched_files(self):
+        files = set(os.path.join(HERE, f) for f in os.listdir(HERE) if f.endswith(".py"))
+        files.update(os.path.abspath(v.source) for v in self.variants if v.is_spec)
+        return files
+
+    def poll(self):
+        """ Returns the files modified since the last poll """
+        changed = set()
+        for path in self._watched_files():
+            try:
+                mtime = os.stat(path).st_mtime
+            except OSError:
+                continue
+            if self.mtimes.get(path, mtime) != mtime:
+                changed.add(path)
+            self.mtimes[path] = mtime
+        return changed
+
+    def _changes(self, changed_files):
+        # Raises on a syntax error, the fingerprints stay the last good ones
+        changes, fingerprints = {}, {}
+        for path in changed_files:
+            if not path.endswith(".py"):
+                changes[path] = None
+                continue
+            fingerprints[path] = code_fingerprints(path)
+            old = self.fingerprints.get(path)
+            changes[path] = changed_code(old, fingerprints[path]) if old is not None else None
+        return changes, fingerprints
+
+    def refresh(self, changed_files):
+        """ Re-renders the variants affected by changed_files (and those whose
+            last render failed), returns them and the (variant, error) pairs
+            of the renders that failed """
+        changes, fingerprints = self._changes(changed_files)
+        reload_repo_modules()
+        # Raises on a broken constants.py, self.constants stays the last good one
+        new = importlib.import_module("constants")
+        constants = changed_constants(self.constants, new) if self.constants else set()
+        self.constants = new
+        self.fingerprints.update(fingerprints)
+        affected = [v for v in self.variants if v.affected_by(changes, constants)]
+        errors = []
+        for variant in affected:
+            try:
+                variant.render()
+            except Exception as e:
+                errors.append((variant, e))
+        return affected, errors
+
+    def run(self):
+        for variant in self.variants:
+            variant.render()
+        self.constants = importlib.import_module("constants")
+        for path in self._watched_files():
+            if path.endswith(".py"):
+                self.fingerprints[path] = code_fingerprints(path)
+        self.poll()
+        print("rendered %d variants, watching for changes" % len(self.variants))
+        while True:
+            time.sleep(self.interval)
+            changed = self.poll()
+            if not changed:
+                continue
+            started = time.time()
+            try:
+                affected, errors = self.refresh(changed)
+            except Exception as e:
+                print("render failed: %s" % e)
+                continue
+            for variant, e in errors:
+                print("%s failed: %s" % (variant.name, e))
+            print("%s changed, re-rendered %s in %.0f ms" % (
+                ", ".join(sorted(os.path.basename(f) for f in changed)),
+                ", ".join(v.name for v in affected) or "nothing",
+                (time.time() - started) * 1000))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Re-render stack variants as their inputs change")
+    parser.add_argument("variants", nargs="+", help="module.Class names or spec files")
+    parser.add_argument("--output-dir", required=True)
+    parser.add_argument("--interval", type=float, default=0.5, help="seconds between polls")
+    parser.add_argument("--threshold", type=float, help="fail renders past this fraction of a CloudFormation limit")
+    parser.add_argument("--via-s3", action="store_true", help="leave out the inline TemplateBody limit")
+    args = parser.parse_args()
+
+    Watcher([Variant(v, args.output_dir, args.threshold, not args.via_s3) for v in args.variants],
+            args.interval).run()